@@ -1,18 +1,25 @@
 import os
 import uuid
+import json
 import asyncio
 import shutil
 import logging
-from typing import List, Dict
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException
+from typing import List
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 from dotenv import load_dotenv
-from aiolimiter import AsyncLimiter
 
-from modules.llm import get_client, summarise_paper, identify_gaps
-from modules.db import init_db
+from modules.db import (
+    init_db, close_db, create_job, get_job, get_job_events, get_cached_summaries, hash_fileobj, HASH_CHUNK_SIZE,
+    count_jobs, get_metrics_snapshots,
+)
+from modules.telemetry import JOBS, METRICS_MAX_AGE, render_metrics, span
+from modules.agents import DEFAULT_STAGE_TOKEN_BUDGET
+from modules.index import DEFAULT_TOP_K
+from modules.llm import SUMMARY_PROMPT_VERSION
 
 # Load environment variables
 load_dotenv()
@@ -24,6 +31,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# How often an open event stream checks the job store for new events
+EVENT_POLL_INTERVAL = 0.25
+TERMINAL_STATUSES = ("completed", "failed")
+JOB_STATUSES = ("pending", "processing", *TERMINAL_STATUSES)
+UPLOAD_DIR = "temp_uploads"
+
 app = FastAPI(title="Research Gap Identifier API")
 
 # CORS configuration
@@ -35,99 +48,229 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory task store (Use Redis/Database for production)
-tasks: Dict[str, Dict] = {}
-
 class AnalysisRequest(BaseModel):
     subject: str = "the provided topics"
     model: str = "gemini-2.5-flash"
-    rate_limit: int = 5
-    concurrent_requests: int = 5
+    # Hints only: the workers' scheduler owns the API key's quota, and these can just lower a job's share
+    rate_limit: int | None = None
+    concurrent_requests: int | None = None
+    hierarchical: bool = False
+    token_budget: int = DEFAULT_STAGE_TOKEN_BUDGET
+    no_agent_cache: bool = False
+    corpus: str | None = None
+    extract_text: bool = False
+    dedup: bool = False
+    context_cache: bool = False
+    summary_model: str | None = None
+    reasoning_model: str | None = None
+    hedge: bool = False
+    # Weight of the job's share of the quota (1-10)
+    priority: int = 1
+    # Analyse this many cached summaries most relevant to the subject instead of uploaded PDFs
+    top_k: int | None = None
 
 @app.on_event("startup")
 async def startup_event():
     await init_db()
     # Ensure temp directory exists
-    os.makedirs("temp_uploads", exist_ok=True)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-async def run_analysis(task_id: str, subject: str, model: str, rate_limit: int, concurrent_requests: int, file_paths: List[str]):
-    tasks[task_id]["status"] = "processing"
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_db()
+
+def _hash_upload(file: UploadFile) -> str:
+    with span("hash_file", filename=file.filename):
+        file.file.seek(0)
+        return hash_fileobj(file.file)
+
+def _persist_upload(file: UploadFile, path: str):
+    """Copies an upload's spooled body to `path` through a partial file that is linked into
+    place once complete, so a job sharing the file never sees it half-written (and an
+    existing copy is never rewritten under it)."""
+    partial_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
     try:
-        client = get_client()
-        limiter = AsyncLimiter(rate_limit, 60)
-        semaphore = asyncio.Semaphore(concurrent_requests)
-
-        async def bounded_summarise(pdf_path: str) -> str:
-            async with semaphore:
-                return await summarise_paper(client, model, pdf_path, limiter)
-
-        # Process all PDFs
-        process_tasks = [bounded_summarise(pdf) for pdf in file_paths]
-        
-        paper_summaries = []
-        for f in asyncio.as_completed(process_tasks):
-            summary = await f
-            paper_summaries.append(summary)
-
-        valid_summaries = [s for s in paper_summaries if not s.startswith("Error summarising")]
-
-        if not valid_summaries:
-            tasks[task_id]["status"] = "failed"
-            tasks[task_id]["error"] = "No valid summaries generated."
-            return
-
-        logger.info(f"Task {task_id}: Analysing research gaps...")
-        report = await identify_gaps(client, model, valid_summaries, subject, limiter)
-
-        tasks[task_id]["status"] = "completed"
-        tasks[task_id]["result"] = {
-            "report": report,
-            "summaries": valid_summaries
-        }
-    except Exception as e:
-        logger.error(f"Task {task_id} failed: {e}")
-        tasks[task_id]["status"] = "failed"
-        tasks[task_id]["error"] = str(e)
+        file.file.seek(0)
+        with open(partial_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer, HASH_CHUNK_SIZE)
+        try:
+            os.link(partial_path, path)
+        except FileExistsError:
+            pass
     finally:
-        # Cleanup temp files
-        for path in file_paths:
-            if os.path.exists(path):
-                os.remove(path)
+        _discard(partial_path)
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 @app.post("/analyse")
 async def analyse(
-    background_tasks: BackgroundTasks,
     subject: str = "the provided topics",
     model: str = "gemini-2.5-flash",
-    rate_limit: int = 5,
-    concurrent_requests: int = 5,
+    rate_limit: int | None = None,
+    concurrent_requests: int | None = None,
+    hierarchical: bool = False,
+    token_budget: int = DEFAULT_STAGE_TOKEN_BUDGET,
+    no_agent_cache: bool = False,
+    corpus: str | None = None,
+    extract_text: bool = False,
+    dedup: bool = False,
+    context_cache: bool = False,
+    summary_model: str | None = None,
+    reasoning_model: str | None = None,
+    hedge: bool = False,
+    priority: int = 1,
     files: List[UploadFile] = File(...)
 ):
+    """Queues an analysis job.
+
+    Uploads are content-addressed: each body is hashed from the request's spooled copy
+    (off the event loop) before anything is written, byte-identical PDFs are kept once,
+    and the file is stored as `temp_uploads/<hash>.pdf` only when its summary is not
+    already cached and no queued job has stored it yet. Cached papers never touch the disk.
+
+    `rate_limit` and `concurrent_requests` are hints that can only lower the job's rate
+    and concurrency: the workers' scheduler owns the API key's quota and shares it fairly
+    across running jobs, weighted by `priority` (1-10) and favouring small jobs.
+    """
     task_id = str(uuid.uuid4())
-    file_paths = []
-    
+    uploads = {}
     for file in files:
         if not file.filename.endswith(".pdf"):
             continue
-        
-        file_path = f"temp_uploads/{uuid.uuid4()}_{file.filename}"
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        file_paths.append(file_path)
+        file_hash = await asyncio.to_thread(_hash_upload, file)
+        if file_hash in uploads:
+            logger.info(f"Skipping {file.filename}: identical to another uploaded PDF.")
+            continue
+        uploads[file_hash] = file
+    return await _queue_upload_job(task_id, uploads, len(files), AnalysisRequest(
+        subject=subject,
+        model=model,
+        rate_limit=rate_limit,
+        concurrent_requests=concurrent_requests,
+        hierarchical=hierarchical,
+        token_budget=token_budget,
+        no_agent_cache=no_agent_cache,
+        corpus=corpus,
+        extract_text=extract_text,
+        dedup=dedup,
+        context_cache=context_cache,
+        summary_model=summary_model,
+        reasoning_model=reasoning_model,
+        hedge=hedge,
+        priority=priority,
+    ))
 
-    if not file_paths:
+async def _queue_upload_job(task_id: str, uploads: dict, uploaded: int, params: AnalysisRequest) -> dict:
+    """Stores an upload job: writes the uploads still to be summarised to UPLOAD_DIR and
+    records the job, for a worker process (see worker.py) to claim and run."""
+    if not uploads:
         raise HTTPException(status_code=400, detail="No valid PDF files uploaded.")
 
-    tasks[task_id] = {"status": "pending", "subject": subject}
-    background_tasks.add_task(run_analysis, task_id, subject, model, rate_limit, concurrent_requests, file_paths)
+    cached = await get_cached_summaries(
+        list(uploads), params.summary_model or params.model, SUMMARY_PROMPT_VERSION
+    )
+    papers = [
+        (os.path.join(UPLOAD_DIR, f"{file_hash}.pdf"), file_hash, file.filename)
+        for file_hash, file in uploads.items()
+    ]
+    missing = [(file_path, file_hash) for file_path, file_hash, _ in papers if file_hash not in cached]
+    for file_path, file_hash in missing:
+        if not os.path.exists(file_path):
+            await asyncio.to_thread(_persist_upload, uploads[file_hash], file_path)
+    await create_job(task_id, params.model_dump(), papers)
+    # A job sharing one of these files may have finished (and deleted it) before this job
+    # was recorded; now that this job holds a reference, restore any such file
+    for file_path, file_hash in missing:
+        if not os.path.exists(file_path):
+            await asyncio.to_thread(_persist_upload, uploads[file_hash], file_path)
+    logger.info(
+        f"Job {task_id}: {len(papers)} unique PDFs ({len(missing)} to summarise) "
+        f"from {uploaded} uploads."
+    )
     
     return {"task_id": task_id}
 
+@app.post("/analyse/cached")
+async def analyse_cached(request: AnalysisRequest):
+    """Queues an analysis of previously summarised papers, without uploading any PDFs.
+
+    The worker embeds any summaries not yet in the semantic index, then runs the agents on
+    the `top_k` (default DEFAULT_TOP_K) cached summaries most relevant to `subject`.
+    """
+    if request.subject == AnalysisRequest.model_fields["subject"].default:
+        raise HTTPException(status_code=400, detail="A subject is needed to search the cached papers.")
+    if request.top_k is None:
+        request.top_k = DEFAULT_TOP_K
+    if request.top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1.")
+    task_id = str(uuid.uuid4())
+    await create_job(task_id, request.model_dump(), [])
+    logger.info(f"Job {task_id}: top {request.top_k} cached papers for '{request.subject}'.")
+    return {"task_id": task_id}
+
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    if task_id not in tasks:
+    """Lightweight job metadata; the report and summaries are served by /result."""
+    job = await get_job(task_id, include_result=False)
+    if job is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    return tasks[task_id]
+    return {
+        "status": job["status"],
+        "subject": job["params"]["subject"],
+        "error": job["error"],
+        "papers": job["papers"],
+    }
+
+@app.get("/result/{task_id}")
+async def get_result(task_id: str):
+    job = await get_job(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Task is {job['status']}")
+    return job["result"]
+
+def _sse(event_id: int | None, event_type: str, data: str) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event_type}", f"data: {data}"]
+    return "\n".join(lines) + "\n\n"
+
+@app.get("/events/{task_id}")
+async def stream_events(task_id: str, last_event_id: int = Header(0)):
+    """Server-Sent Events stream of a job's progress: "status", "paper", "duplicate", "stage"
+    and "token" events as the worker publishes them, "routing" statistics at the end, then a
+    final "done" event with the job's status. Reconnecting clients resume after their
+    `Last-Event-ID`."""
+    if await get_job(task_id, include_result=False) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def events():
+        after_id = last_event_id
+        while True:
+            # Read the status before the events: finish_job commits all events before the final status
+            job = await get_job(task_id, include_result=False)
+            for event_id, event_type, data in await get_job_events(task_id, after_id):
+                after_id = event_id
+                yield _sse(event_id, event_type, data)
+            if job["status"] in TERMINAL_STATUSES:
+                yield _sse(None, "done", json.dumps({"status": job["status"], "error": job["error"]}))
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics of the API process and every worker (which publish theirs to the
+    job store), plus the number of jobs per status."""
+    counts = await count_jobs()
+    for status in JOB_STATUSES:
+        JOBS.set(counts.get(status, 0), status=status)
+    return PlainTextResponse(render_metrics(await get_metrics_snapshots(METRICS_MAX_AGE)), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
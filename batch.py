@@ -0,0 +1,245 @@
+import os
+import re
+import glob
+import json
+import argparse
+import asyncio
+import logging
+from typing import Dict, List
+
+from dotenv import load_dotenv
+from tqdm.asyncio import tqdm
+
+try:
+    import yaml
+except ImportError:  # YAML manifests are optional; JSON always works
+    yaml = None
+
+from modules.ratelimit import AdaptiveLimiter
+from modules.llm import ModelRouter, get_client, resolve_cached_papers, summarise_paper, identify_gaps
+from modules.agents import DEFAULT_STAGE_TOKEN_BUDGET
+from modules.dedup import collapse_duplicates
+from modules.db import init_db, close_db, hash_files
+from modules.extract import shutdown_extraction_pool
+from modules.models import DuplicateDecision, PaperSummary, SummarySuccess
+from modules.report import write_report, silence_ssl_errors
+from modules.telemetry import render_metrics
+
+# Load environment variables
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+)
+logger = logging.getLogger("batch")
+
+# Per-analysis options a manifest may set (in "defaults" or on each analysis), with their defaults
+ANALYSIS_OPTIONS = {
+    "hierarchical": False,
+    "token_budget": DEFAULT_STAGE_TOKEN_BUDGET,
+    "no_agent_cache": False,
+    "corpus": None,
+    "context_cache": False,
+}
+
+class ManifestError(ValueError):
+    pass
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_") or "analysis"
+
+def load_manifest(path: str) -> List[dict]:
+    """Reads a batch manifest (JSON, or YAML when PyYAML is installed) and returns its analyses
+    with their options filled in and their paper sets resolved to absolute PDF paths.
+
+    Each analysis needs a `subject` and a `folder` and/or `papers` (paths or glob patterns).
+    Relative paths are relative to the manifest. `output` defaults to
+    `research_gap_report_<subject>.md` next to the manifest.
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ManifestError("YAML manifests need PyYAML (pip install pyyaml); use JSON instead.")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    if not isinstance(data, dict) or not data.get("analyses"):
+        raise ManifestError("The manifest needs a non-empty 'analyses' list.")
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = {**ANALYSIS_OPTIONS, **data.get("defaults", {})}
+
+    analyses = []
+    outputs = set()
+    for i, entry in enumerate(data["analyses"]):
+        if not entry.get("subject"):
+            raise ManifestError(f"Analysis {i + 1} has no subject.")
+        unknown = set(entry) - set(ANALYSIS_OPTIONS) - {"subject", "folder", "papers", "output"}
+        if unknown:
+            raise ManifestError(f"Analysis {i + 1} has unknown options: {sorted(unknown)}")
+        patterns = list(entry.get("papers", []))
+        if entry.get("folder"):
+            patterns.append(os.path.join(entry["folder"], "*.pdf"))
+        if not patterns:
+            raise ManifestError(f"Analysis {i + 1} ({entry['subject']}) lists no folder or papers.")
+        pdf_files = sorted({
+            os.path.abspath(match)
+            for pattern in patterns
+            for match in glob.glob(os.path.join(base, pattern))
+            if match.lower().endswith(".pdf")
+        })
+        if not pdf_files:
+            logger.warning(f"No PDF files found for '{entry['subject']}'.")
+        output = os.path.join(base, entry.get("output") or f"research_gap_report_{_slug(entry['subject'])}.md")
+        if output in outputs:
+            raise ManifestError(f"Two analyses write to {output}.")
+        outputs.add(output)
+        options = {name: entry.get(name, defaults[name]) for name in ANALYSIS_OPTIONS}
+        analyses.append({"subject": entry["subject"], "pdf_files": pdf_files, "output": output, **options})
+    return analyses
+
+def _canonical(file_hash: str, duplicate_of: Dict[str, str]) -> str:
+    while file_hash in duplicate_of:
+        file_hash = duplicate_of[file_hash]
+    return file_hash
+
+async def run_batch(args: argparse.Namespace) -> None:
+    """Summarises the union of every analysis' papers once, then runs all the agent
+    pipelines concurrently under one limiter and writes each analysis' report."""
+    try:
+        analyses = load_manifest(args.manifest)
+        client = get_client()
+    except (OSError, ValueError) as e:
+        logger.error(str(e))
+        return
+
+    # Every PDF is hashed and looked up once, however many analyses include it
+    union = sorted({pdf for analysis in analyses for pdf in analysis["pdf_files"]})
+    logger.info(f"{len(analyses)} analyses over {len(union)} unique PDFs.")
+    file_hashes = dict(zip(union, await hash_files(union)))
+
+    # One limiter and router for the whole batch, so summaries and agents share the quota
+    limiter = AdaptiveLimiter(args.rate_limit, 60)
+    semaphore = asyncio.Semaphore(args.concurrent_requests)
+    router = ModelRouter(args.model, args.summary_model, args.reasoning_model, hedge=args.hedge)
+
+    paper_summaries, misses = await resolve_cached_papers(
+        union, router.summary_model, [file_hashes[pdf] for pdf in union]
+    )
+    duplicates: List[DuplicateDecision] = []
+    if args.dedup:
+        paper_summaries, misses, duplicates = await collapse_duplicates(
+            paper_summaries, misses, router.summary_model,
+            cached_paths={file_hash: pdf for pdf, file_hash in file_hashes.items()},
+        )
+
+    async def bounded_summarise(pdf_path: str, file_hash: str):
+        async with semaphore:
+            return await summarise_paper(
+                client, args.model, pdf_path, limiter, file_hash, extract_text=args.extract_text, router=router
+            )
+
+    tasks = [asyncio.create_task(bounded_summarise(pdf, file_hash)) for pdf, file_hash in misses]
+    try:
+        if tasks:
+            for f in tqdm.as_completed(tasks, total=len(tasks), desc="Summarising Papers"):
+                paper_summaries.append(await f)
+    finally:
+        # Cancelled tasks still delete their uploads before the batch exits
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Summaries are shared in memory by every analysis that includes the paper (or a near-duplicate of it)
+    summaries: Dict[str, PaperSummary] = {
+        outcome.file_hash: outcome.summary for outcome in paper_summaries if isinstance(outcome, SummarySuccess)
+    }
+    duplicate_of = {decision.file_hash: decision.duplicate_of_hash for decision in duplicates}
+
+    async def analyse(analysis: dict) -> bool:
+        hashes = {file_hashes[pdf] for pdf in analysis["pdf_files"]}
+        canonical = list(dict.fromkeys(_canonical(file_hashes[pdf], duplicate_of) for pdf in analysis["pdf_files"]))
+        valid_summaries = [summaries[file_hash] for file_hash in canonical if file_hash in summaries]
+        if not valid_summaries:
+            logger.error(f"No valid summaries for '{analysis['subject']}'; no report written.")
+            return False
+        logger.info(f"Analysing research gaps for '{analysis['subject']}' ({len(valid_summaries)} papers)...")
+        report = await identify_gaps(
+            client, args.model, valid_summaries, analysis["subject"], limiter,
+            hierarchical=analysis["hierarchical"], token_budget=analysis["token_budget"],
+            use_agent_cache=not analysis["no_agent_cache"], corpus_id=analysis["corpus"],
+            context_cache=analysis["context_cache"], router=router, stream_tokens=False,
+        )
+        write_report(
+            analysis["output"], analysis["subject"], report, valid_summaries,
+            [decision for decision in duplicates if decision.file_hash in hashes],
+        )
+        logger.info(f"Report for '{analysis['subject']}' saved to {analysis['output']}")
+        return True
+
+    results = await asyncio.gather(*(analyse(analysis) for analysis in analyses))
+    router.log_stats()
+    logger.info(f"Batch complete: {sum(results)} of {len(analyses)} reports written.")
+
+async def _main_async(args):
+    await init_db()
+    try:
+        await run_batch(args)
+    finally:
+        shutdown_extraction_pool()
+        await close_db()
+        if args.metrics_file:
+            with open(args.metrics_file, "w") as f:
+                f.write(render_metrics())
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Run several research gap analyses (subjects and paper sets) from one manifest, summarising each paper once"
+    )
+    parser.add_argument("manifest", help="Path to the batch manifest (.json, or .yaml/.yml with PyYAML installed)")
+    parser.add_argument("--model", help="Gemini model ID to use", default="gemini-2.5-flash")
+    parser.add_argument(
+        "--summary-model", help="Model for the per-paper summaries (defaults to --model)", default=None
+    )
+    parser.add_argument(
+        "--reasoning-model", help="Model for the Critic and Innovator stages (defaults to --model)", default=None
+    )
+    parser.add_argument(
+        "--hedge",
+        help="Race a second request against calls still running after their tier's p95 latency",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rate-limit", help="Max requests per minute, shared by all analyses", type=int, default=5
+    )
+    parser.add_argument(
+        "--concurrent-requests", help="Max concurrent summarisations", type=int, default=5
+    )
+    parser.add_argument(
+        "--extract-text",
+        help="Extract PDF text locally and send it inline; only scanned PDFs are uploaded to the File API",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dedup",
+        help="Detect near-duplicate PDFs across all analyses and summarise each work once",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write the batch's metrics in Prometheus text format to this file",
+        default=None,
+    )
+    return parser
+
+def main():
+    silence_ssl_errors()
+    args = build_parser().parse_args()
+    try:
+        asyncio.run(_main_async(args))
+    except KeyboardInterrupt:
+        logger.info("Batch interrupted by user.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import resource
+import tempfile
+import tracemalloc
+from typing import List
+
+import httpx
+
+# The benchmark always runs against the offline fake backend (see modules/fake_llm.py)
+os.environ["LLM_BACKEND"] = "fake"
+
+import main as cli
+import api
+import worker
+from modules import db, llm, ratelimit
+from modules.db import init_db, close_db, claim_job
+from modules.extract import shutdown_extraction_pool
+
+logger = logging.getLogger("benchmark")
+
+DEFAULT_SIZES = (10, 100, 1000)
+# The stall probe expects to wake up this often; any extra delay means the event loop was blocked
+STALL_PROBE_INTERVAL = 0.01
+# Delays below this are scheduler noise rather than stalls
+STALL_THRESHOLD = 0.005
+WORDS = (
+    "soil microbial yield nitrogen drought transformer attention corpus cohort randomised trial "
+    "variance estimator bias sampling protocol baseline ablation benchmark replication effect"
+).split()
+
+def make_pdf(lines: List[str]) -> bytes:
+    """Builds a minimal single-page PDF with one text line per entry (enough for pypdf to extract)."""
+    content = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(content)} >>\nstream\n{content}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+def generate_corpus(folder: str, papers: int, seed: int = 0) -> List[str]:
+    """Writes `papers` distinct synthetic PDFs (deterministic for a given seed) and returns their paths."""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(papers):
+        rng = random.Random(f"{seed}:{i}")
+        lines = [f"Synthetic paper {i}: a study of {rng.choice(WORDS)} and {rng.choice(WORDS)}"]
+        lines += [" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(70)]
+        lines += ["References"] + [f"Author {j} et al. {2000 + j}" for j in range(10)]
+        path = os.path.join(folder, f"paper_{i:04d}.pdf")
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(make_pdf(lines))
+        paths.append(path)
+    return paths
+
+class StallMonitor:
+    """Measures event-loop stalls by timing a task that should wake every STALL_PROBE_INTERVAL."""
+
+    def __init__(self):
+        self.max_stall = 0.0
+        self.total_stall = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def _probe(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + STALL_PROBE_INTERVAL
+            await asyncio.sleep(STALL_PROBE_INTERVAL)
+            delay = loop.time() - expected
+            if delay > STALL_THRESHOLD:
+                self.max_stall = max(self.max_stall, delay)
+                self.total_stall += delay
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._probe())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def results(self) -> dict:
+        return {"max_stall_ms": round(self.max_stall * 1000, 1), "total_stall_ms": round(self.total_stall * 1000, 1)}
+
+async def bench_cli(folder: str, papers: int, args: argparse.Namespace) -> dict:
+    """Runs main.py's pipeline on the corpus twice (cold, then fully cached)."""
+    cli_args = cli.build_parser().parse_args([
+        folder, "--output", os.path.join(args.workdir, f"report_cli_{papers}.md"),
+        "--rate-limit", str(args.rate_limit), "--concurrent-requests", str(args.concurrent_requests),
+        *(["--extract-text"] if args.extract_text else []),
+        *(["--hedge"] if args.hedge else []),
+    ])
+    summarise_paper = cli.summarise_paper
+    done_at = []
+
+    async def timed_summarise(*a, **kw):
+        outcome = await summarise_paper(*a, **kw)
+        done_at.append(time.perf_counter())
+        return outcome
+
+    cli.summarise_paper = timed_summarise
+    try:
+        runs = {}
+        for run in ("cold", "warm"):
+            done_at.clear()
+            start = time.perf_counter()
+            await cli.process_pdfs(cli_args)
+            runs[run] = _run_metrics(papers, start, time.perf_counter(), done_at)
+    finally:
+        cli.summarise_paper = summarise_paper
+    return runs
+
+async def bench_api(paths: List[str], papers: int, args: argparse.Namespace) -> dict:
+    """Submits the corpus to POST /analyse and runs the job on an in-process worker, twice (cold, then cached)."""
+    await api.startup_event()
+    scheduler = ratelimit.Scheduler(args.rate_limit, args.upload_rate_limit, args.concurrent_requests)
+    params = {
+        "rate_limit": args.rate_limit, "concurrent_requests": args.concurrent_requests, "extract_text": args.extract_text,
+        "hedge": args.hedge,
+    }
+    runs = {}
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for run in ("cold", "warm"):
+            files = [("files", (os.path.basename(p), open(p, "rb"), "application/pdf")) for p in paths]
+            start, wall_start = time.perf_counter(), time.time()
+            try:
+                response = await client.post("/analyse", params=params, files=files)
+            finally:
+                for _, (_, f, _) in files:
+                    f.close()
+            response.raise_for_status()
+            task_id = response.json()["task_id"]
+            job = await claim_job("benchmark")
+            await worker.run_claimed_job(job, scheduler)
+            end = time.perf_counter()
+            done_at = await _paper_event_times(task_id, start, wall_start)
+            status = (await client.get(f"/status/{task_id}")).json()
+            runs[run] = {**_run_metrics(papers, start, end, done_at), "status": status["status"]}
+    scheduler.close()
+    return runs
+
+async def _paper_event_times(task_id: str, start: float, wall_start: float) -> List[float]:
+    """When each paper of a job finished, from its job events (wall-clock, moved onto the perf_counter timeline)."""
+    conn = await db.get_connection()
+    async with conn.execute(
+        "SELECT created_at FROM job_events WHERE job_id = ? AND type = 'paper' ORDER BY event_id", (task_id,)
+    ) as cursor:
+        return [start + created_at - wall_start for (created_at,) in await cursor.fetchall()]
+
+def _run_metrics(papers: int, start: float, end: float, done_at: List[float]) -> dict:
+    metrics = {"seconds": round(end - start, 3)}
+    if done_at:
+        metrics["time_to_first_summary_s"] = round(min(done_at) - start, 3)
+        summarise_seconds = max(done_at) - start
+        metrics["summaries_per_s"] = round(len(done_at) / summarise_seconds, 2) if summarise_seconds > 0 else None
+    metrics["papers_per_s"] = round(papers / (end - start), 2)
+    return metrics
+
+async def bench_one(flow: str, papers: int, args: argparse.Namespace) -> dict:
+    folder = os.path.join(args.workdir, f"corpus_{papers}")
+    paths = generate_corpus(folder, papers, args.seed)
+    db.DB_PATH = os.path.join(args.workdir, f"bench_{flow}_{papers}_{os.getpid()}.db")
+    # Each flow starts cold: no summaries memoised in-process by the previous one
+    llm._summary_memo.clear()
+    await init_db()
+    tracemalloc.start()
+    try:
+        async with StallMonitor() as monitor:
+            if flow == "cli":
+                runs = await bench_cli(folder, papers, args)
+            else:
+                runs = await bench_api(paths, papers, args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        shutdown_extraction_pool()
+        await close_db()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db.DB_PATH + suffix):
+                os.remove(db.DB_PATH + suffix)
+    result = {
+        "flow": flow,
+        "papers": papers,
+        **runs,
+        **monitor.results(),
+        "peak_traced_memory_mb": round(peak / 2**20, 1),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if runs["warm"]["seconds"] > 0:
+        result["cache_hit_speedup"] = round(runs["cold"]["seconds"] / runs["warm"]["seconds"], 1)
+    return result
+
+async def run_benchmarks(args: argparse.Namespace) -> List[dict]:
+    results = []
+    for papers in args.sizes:
+        for flow in args.flows:
+            logger.warning(f"Benchmarking {flow} with {papers} papers...")
+            result = await bench_one(flow, papers, args)
+            logger.warning(json.dumps(result))
+            results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark against the fake LLM backend")
+    parser.add_argument("--sizes", help="Corpus sizes to benchmark", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--flows", help="Flows to benchmark", nargs="+", choices=("cli", "api"), default=["cli", "api"])
+    parser.add_argument("--output", help="JSON file for the results", default="benchmark_results.json")
+    parser.add_argument("--workdir", help="Directory for corpora, databases and reports (default: a temp dir)")
+    parser.add_argument("--seed", help="Seed for the synthetic corpora and the fake backend", type=int, default=0)
+    parser.add_argument("--latency", help="Fake generate latency in seconds", type=float, default=0.05)
+    parser.add_argument("--upload-latency", help="Fake upload latency in seconds", type=float, default=0.02)
+    parser.add_argument("--error-rate", help="Fraction of fake calls failing with a 503", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", help="Fraction of fake calls failing with a 429", type=float, default=0.0)
+    parser.add_argument("--slow-rate", help="Fraction of fake calls taking 10x the latency", type=float, default=0.0)
+    parser.add_argument("--hedge", help="Hedge calls slower than their tier's p95 latency", action="store_true")
+    parser.add_argument("--rate-limit", help="Requests per minute given to the limiter", type=int, default=100_000)
+    parser.add_argument(
+        "--upload-rate-limit", help="File API uploads per minute given to the limiter", type=int,
+        default=ratelimit.DEFAULT_UPLOAD_RATE,
+    )
+    parser.add_argument("--concurrent-requests", help="Max concurrent summarisations", type=int, default=32)
+    parser.add_argument("--extract-text", help="Benchmark the local text-extraction mode", action="store_true")
+    args = parser.parse_args()
+
+    os.environ.update({
+        "FAKE_LLM_LATENCY": str(args.latency),
+        "FAKE_LLM_UPLOAD_LATENCY": str(args.upload_latency),
+        "FAKE_LLM_ERROR_RATE": str(args.error_rate),
+        "FAKE_LLM_THROTTLE_RATE": str(args.throttle_rate),
+        "FAKE_LLM_SLOW_RATE": str(args.slow_rate),
+        "FAKE_LLM_SEED": str(args.seed),
+    })
+    ratelimit.DEFAULT_UPLOAD_RATE = args.upload_rate_limit
+    # Per-paper INFO logs would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    args.output = os.path.abspath(args.output)
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="research_gaps_bench_"))
+    os.makedirs(args.workdir, exist_ok=True)
+    # The API stores uploads relative to the working directory
+    os.chdir(args.workdir)
+
+    results = asyncio.run(run_benchmarks(args))
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
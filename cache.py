@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import logging
+import time
+
+from modules.llm import SUMMARY_PROMPT_VERSION
+from modules.db import (
+    init_db, close_db, evict_summaries, claim_legacy_summaries, get_summary_stats, get_connection, LEGACY_VERSION,
+)
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+)
+logger = logging.getLogger("cache")
+
+async def show_stats():
+    rows = await get_summary_stats()
+    if not rows:
+        print("No cached summaries.")
+        return
+    now = time.time()
+    print(f"Current summary prompt version: {SUMMARY_PROMPT_VERSION}")
+    for model_id, prompt_version, count, size, input_tokens, output_tokens, oldest, newest in rows:
+        if prompt_version == LEGACY_VERSION:
+            version = "legacy (unclaimed, not served)"
+        elif prompt_version == SUMMARY_PROMPT_VERSION:
+            version = f"{prompt_version} (current)"
+        else:
+            version = f"{prompt_version} (stale, not served)"
+        tokens = f", {input_tokens or 0} tokens in / {output_tokens or 0} out" if input_tokens else ""
+        print(
+            f"{model_id} @ {version}: {count} summaries, {size / 1024:.1f} KiB compressed{tokens}; "
+            f"last used {(now - newest) / 86400:.1f} to {(now - oldest) / 86400:.1f} days ago"
+        )
+
+async def _vacuum():
+    # Returns the freed pages to the filesystem, so the database file actually shrinks
+    db = await get_connection()
+    await db.execute('VACUUM')
+
+async def run(args: argparse.Namespace):
+    await init_db()
+    try:
+        if args.command == "stats":
+            await show_stats()
+        elif args.command == "evict":
+            await evict_summaries(
+                max_age_days=args.max_age_days, max_entries=args.max_entries,
+                keep_prompt_version=SUMMARY_PROMPT_VERSION if args.stale_prompts else None,
+            )
+            if args.vacuum:
+                await _vacuum()
+        elif args.command == "migrate":
+            # init_db has already moved the table to the current schema
+            if args.legacy_model:
+                claimed = await claim_legacy_summaries(args.legacy_model, SUMMARY_PROMPT_VERSION)
+                logger.info(f"Attributed {claimed} legacy summaries to {args.legacy_model} and the current prompt.")
+            logger.info("The summary cache is on the current schema.")
+    finally:
+        await close_db()
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Inspect and maintain the summary cache in research_cache.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="Cached summaries, size and tokens per model and prompt version")
+    evict = commands.add_parser("evict", help="Delete old or least recently used summaries")
+    evict.add_argument("--max-age-days", help="Delete summaries not used for this many days", type=float)
+    evict.add_argument(
+        "--max-entries", help="Keep at most this many summaries, deleting the least recently used", type=int
+    )
+    evict.add_argument(
+        "--stale-prompts",
+        help="Delete summaries made from an earlier summary prompt (or migrated without one)",
+        action="store_true",
+    )
+    evict.add_argument("--vacuum", help="Shrink the database file afterwards", action="store_true")
+    migrate = commands.add_parser("migrate", help="Move an existing database to the current summary schema")
+    migrate.add_argument(
+        "--legacy-model",
+        help="Attribute summaries cached before models and prompts were recorded to this model and the "
+             "current prompt, so they are served again",
+        default=None,
+    )
+    return parser
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.command == "evict" and args.max_age_days is None and args.max_entries is None and not args.stale_prompts:
+        parser.error("evict needs --max-age-days, --max-entries and/or --stale-prompts")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -27,11 +27,23 @@ interface TaskStatus {
   error?: string;
 }
 
+interface Progress {
+  total: number;
+  done: number;
+  cached: number;
+  failed: number;
+  stages: Record<string, 'started' | 'finished' | 'failed'>;
+  streamed: Record<string, string>;
+}
+
+const emptyProgress = (): Progress => ({ total: 0, done: 0, cached: 0, failed: 0, stages: {}, streamed: {} });
+
 function App() {
   const [files, setFiles] = useState<File[]>([]);
   const [subject, setSubject] = useState('');
   const [taskId, setTaskId] = useState<string | null>(null);
   const [taskStatus, setTaskStatus] = useState<TaskStatus | null>(null);
+  const [progress, setProgress] = useState<Progress>(emptyProgress());
   const [loading, setLoading] = useState(false);
   const [isDragging, setIsDragging] = useState(false);
 
@@ -71,6 +83,7 @@ function App() {
     setLoading(true);
     setTaskId(null);
     setTaskStatus(null);
+    setProgress(emptyProgress());
 
     const formData = new FormData();
     files.forEach(file => formData.append('files', file));
@@ -81,6 +94,7 @@ function App() {
         headers: { 'Content-Type': 'multipart/form-data' }
       });
       setTaskId(response.data.task_id);
+      setTaskStatus({ status: 'pending', subject });
     } catch (err) {
       console.error(err);
       setTaskStatus({ status: 'failed', subject, error: 'Failed to start analysis.' });
@@ -90,25 +104,60 @@ function App() {
   };
 
   useEffect(() => {
-    let interval: number;
-
-    if (taskId && (!taskStatus || (taskStatus.status !== 'completed' && taskStatus.status !== 'failed'))) {
-      interval = window.setInterval(async () => {
-        try {
-          const response = await axios.get(`${API_BASE_URL}/status/${taskId}`);
-          setTaskStatus(response.data);
-          if (response.data.status === 'completed' || response.data.status === 'failed') {
-            clearInterval(interval);
-          }
-        } catch (err) {
-          console.error(err);
-          clearInterval(interval);
-        }
-      }, 2000);
-    }
+    if (!taskId) return;
 
-    return () => clearInterval(interval);
-  }, [taskId, taskStatus]);
+    // The worker pushes progress over Server-Sent Events; the report is fetched once at the end
+    const source = new EventSource(`${API_BASE_URL}/events/${taskId}`);
+
+    source.addEventListener('status', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      setTaskStatus(prev => ({ ...(prev ?? { subject }), status: data.status }));
+      // A job requeued after a worker restart runs again from the top and reports every paper again
+      setProgress({ ...emptyProgress(), total: data.papers });
+    });
+
+    source.addEventListener('paper', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      setProgress(prev => ({
+        ...prev,
+        done: prev.done + (data.status === 'done' ? 1 : 0),
+        failed: prev.failed + (data.status === 'failed' ? 1 : 0),
+        cached: prev.cached + (data.cached ? 1 : 0),
+      }));
+    });
+
+    source.addEventListener('stage', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      setProgress(prev => ({ ...prev, stages: { ...prev.stages, [data.stage]: data.state } }));
+    });
+
+    source.addEventListener('token', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      setProgress(prev => {
+        // `offset` discards text from an earlier, retried attempt of the same call
+        const text = (prev.streamed[data.stage] ?? '').slice(0, data.offset) + data.text;
+        return { ...prev, streamed: { ...prev.streamed, [data.stage]: text } };
+      });
+    });
+
+    source.addEventListener('done', async (e) => {
+      source.close();
+      const data = JSON.parse((e as MessageEvent).data);
+      if (data.status !== 'completed') {
+        setTaskStatus(prev => ({ ...(prev ?? { subject }), status: 'failed', error: data.error }));
+        return;
+      }
+      try {
+        const response = await axios.get(`${API_BASE_URL}/result/${taskId}`);
+        setTaskStatus(prev => ({ ...(prev ?? { subject }), status: 'completed', result: response.data }));
+      } catch (err) {
+        console.error(err);
+        setTaskStatus(prev => ({ ...(prev ?? { subject }), status: 'failed', error: 'Failed to fetch the report.' }));
+      }
+    });
+
+    return () => source.close();
+  }, [taskId]);
 
   return (
     <div className="min-h-screen bg-background text-text selection:bg-primary/20 font-sans">
@@ -208,6 +257,33 @@ function App() {
             <p className="text-text/70 text-lg">
               The multi-agent pipeline is currently synthesising your documents. This typically takes 30-60 seconds.
             </p>
+            {progress.total > 0 && (
+              <p className="mt-4 text-text/80 font-semibold">
+                {progress.done + progress.failed} / {progress.total} papers summarised
+                {progress.cached > 0 && ` (${progress.cached} from cache)`}
+                {progress.failed > 0 && `, ${progress.failed} failed`}
+              </p>
+            )}
+            {Object.keys(progress.stages).length > 0 && (
+              <div className="mt-6 flex flex-wrap justify-center gap-2">
+                {Object.entries(progress.stages).map(([stage, state]) => (
+                  <span
+                    key={stage}
+                    className={`text-sm px-3 py-1 rounded-full border ${state === 'finished'
+                      ? 'border-cta/40 text-cta'
+                      : state === 'failed' ? 'border-red-300 text-red-600' : 'border-primary/30 text-primary'
+                      }`}
+                  >
+                    {stage}
+                  </span>
+                ))}
+              </div>
+            )}
+            {Object.entries(progress.streamed).map(([stage, text]) => (
+              <pre key={stage} className="mt-6 text-left text-xs text-text/60 bg-background/50 p-4 rounded-xl max-h-40 overflow-y-auto whitespace-pre-wrap">
+                {text}
+              </pre>
+            ))}
           </div>
         )}
 
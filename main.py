@@ -3,13 +3,23 @@ import argparse
 import glob
 import asyncio
 import logging
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
 from typing import List
 
 from dotenv import load_dotenv
 from tqdm.asyncio import tqdm
-from aiolimiter import AsyncLimiter
 
-from modules.llm import get_client, summarise_paper, identify_gaps
+from modules.ratelimit import AdaptiveLimiter
+from modules.llm import ModelRouter, get_client, run_prepasses, summarise_paper, identify_gaps
+from modules.agents import DEFAULT_STAGE_TOKEN_BUDGET
+from modules.index import find_relevant_papers
+from modules.models import PaperOutcome, SummarySuccess
+from modules.db import init_db, close_db, hash_files, create_run, get_run, update_run, update_run_papers
+from modules.extract import shutdown_extraction_pool
+from modules.report import write_report, silence_ssl_errors
+from modules.telemetry import render_metrics
 
 # Setup logging
 logging.basicConfig(
@@ -22,6 +32,30 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# A paper that has failed this many times stays failed when its run is resumed
+MAX_PAPER_ATTEMPTS = 3
+# Top-level agent stages recorded in the run manifest as they finish
+PIPELINE_STAGES = ("synthesiser", "critic", "innovator")
+# Arguments of one invocation rather than of the run it starts or resumes
+INVOCATION_ARGS = ("resume", "metrics_file")
+# Pacing arguments, with their defaults: a resumed run takes them from the new invocation when
+# given there, so it can adapt to the quota at hand, and otherwise keeps its own
+PACING_ARGS = {"rate_limit": 5, "concurrent_requests": 5}
+LATEST_RUN = "latest"
+
+@asynccontextmanager
+async def run_status(run_id: str):
+    """Marks the run as interrupted (e.g. by Ctrl+C) or failed if the block does not finish."""
+    try:
+        yield
+    except asyncio.CancelledError:
+        await update_run(run_id, status="interrupted")
+        logger.info(f"Run {run_id} interrupted. Continue it with --resume {run_id}")
+        raise
+    except Exception:
+        await update_run(run_id, status="failed")
+        raise
+
 async def process_pdfs(args: argparse.Namespace) -> None:
     try:
         client = get_client()
@@ -29,71 +63,161 @@ async def process_pdfs(args: argparse.Namespace) -> None:
         logger.error(str(e))
         return
 
-    pdf_files = glob.glob(os.path.join(args.folder, "*.pdf"))
+    run = None
+    if args.resume:
+        run = await get_run(None if args.resume == LATEST_RUN else args.resume)
+        if run is None:
+            logger.error(f"No run to resume ({args.resume}).")
+            return
+        # The resumed run keeps its own arguments, except for pacing given again
+        for name, value in run["params"].items():
+            if name in INVOCATION_ARGS:
+                continue
+            if name in PACING_ARGS and getattr(args, name) is not None:
+                logger.info(f"Resuming with --{name.replace('_', '-')} {getattr(args, name)} instead of {value}.")
+                continue
+            setattr(args, name, value)
+        states = Counter(paper["state"] for paper in run["papers"].values())
+        logger.info(f"Resuming run {run['run_id']} ({run['status']}): {dict(states)}")
+    run_id = run["run_id"] if run else uuid.uuid4().hex[:12]
+    for name, default in PACING_ARGS.items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
 
-    if not pdf_files:
-        logger.warning(f"No PDF files found in {args.folder}")
-        return
+    file_hashes = []
+    paper_summaries = []
+    if args.top_k:
+        # No PDFs: analyse the cached summaries most relevant to the subject
+        pdf_files = []
+        retrieved = await find_relevant_papers(client, args.subject, args.summary_model or args.model, args.top_k)
+        paper_summaries = [paper for paper, _ in retrieved]
+    elif run is not None:
+        # Papers that keep failing are not retried forever
+        retryable = {
+            path: paper for path, paper in run["papers"].items()
+            if paper["state"] != "failed" or paper["attempts"] < MAX_PAPER_ATTEMPTS
+        }
+        pdf_files = list(retryable)
+        file_hashes = [paper["file_hash"] for paper in retryable.values()]
+        if len(retryable) < len(run["papers"]):
+            logger.warning(f"Skipping {len(run['papers']) - len(retryable)} papers that failed {MAX_PAPER_ATTEMPTS} times.")
+    else:
+        pdf_files = glob.glob(os.path.join(args.folder, "*.pdf"))
+
+        if not pdf_files:
+            logger.warning(f"No PDF files found in {args.folder}")
+            return
+
+        logger.info(f"Found {len(pdf_files)} PDFs. Processing...")
+        file_hashes = await hash_files(pdf_files)
 
-    logger.info(f"Found {len(pdf_files)} PDFs. Processing...")
+    if run is None:
+        params = {name: value for name, value in vars(args).items() if name not in INVOCATION_ARGS}
+        await create_run(run_id, params, list(zip(pdf_files, file_hashes)))
+        logger.info(f"Started run {run_id}. If it is interrupted, continue it with --resume {run_id}")
+    else:
+        await update_run(run_id, status="running")
 
+    async with run_status(run_id):
+        await _run_pipeline(args, client, run_id, run, pdf_files, file_hashes, paper_summaries)
+
+async def _run_pipeline(
+    args: argparse.Namespace, client, run_id: str, run: dict | None,
+    pdf_files: List[str], file_hashes: List[str], paper_summaries: List[PaperOutcome],
+) -> None:
     # Rate Limiter
-    # Limiter allows max rates per period. We define rate_limit requests per 60 seconds.
-    limiter = AsyncLimiter(args.rate_limit, 60)
+    # Starts at rate_limit requests per 60 seconds, then adapts to the real quota (halving on 429s, probing upward on success).
+    limiter = AdaptiveLimiter(args.rate_limit, 60)
     
     # Semaphore to limit max concurrent active requests to not overwhelm local connections
     semaphore = asyncio.Semaphore(args.concurrent_requests)
 
-    async def bounded_summarise(pdf_path: str) -> str:
+    # Picks each call's model tier, and hedges slow calls with --hedge
+    router = ModelRouter(args.model, args.summary_model, args.reasoning_model, hedge=args.hedge)
+
+    misses = []
+    duplicates = []
+    if pdf_files:
+        paper_summaries, misses, duplicates = await run_prepasses(
+            pdf_files, router.summary_model, file_hashes, dedup=args.dedup,
+            on_done=lambda paths: update_run_papers(run_id, paths, "done"),
+        )
+
+    async def bounded_summarise(pdf_path: str, file_hash: str) -> PaperOutcome:
         async with semaphore:
-            return await summarise_paper(client, args.model, pdf_path, limiter)
+            await update_run_papers(run_id, [pdf_path], "in-flight", new_attempt=True)
+            outcome = await summarise_paper(
+                client, args.model, pdf_path, limiter, file_hash, extract_text=args.extract_text, router=router
+            )
+        if isinstance(outcome, SummarySuccess):
+            await update_run_papers(run_id, [pdf_path], "done")
+        else:
+            await update_run_papers(run_id, [pdf_path], "failed", error=outcome.error)
+        return outcome
 
-    # Process all PDFs concurrently but gated by both limiter and semaphore
+    # Process all uncached PDFs concurrently but gated by both limiter and semaphore
     tasks = [
-        bounded_summarise(pdf)
-        for pdf in pdf_files
+        asyncio.create_task(bounded_summarise(pdf, file_hash))
+        for pdf, file_hash in misses
     ]
     
-    paper_summaries = []
-    
-    # Use tqdm wrapper for asyncio to show progress bar
-    for f in tqdm.as_completed(tasks, total=len(tasks), desc="Summarising Papers"):
-        summary = await f
-        paper_summaries.append(summary)
+    try:
+        # Use tqdm wrapper for asyncio to show progress bar
+        if tasks:
+            for f in tqdm.as_completed(tasks, total=len(tasks), desc="Summarising Papers"):
+                paper_summaries.append(await f)
+    finally:
+        # Structured cancellation: an interrupted run cancels every summarisation and waits
+        # for them, so each one deletes its uploaded file before the run exits
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    # Filter out exact error messages if any (optional, but good for clean output)
-    valid_summaries = [s for s in paper_summaries if not s.startswith("Error summarising")]
+    valid_summaries = [s.summary for s in paper_summaries if isinstance(s, SummarySuccess)]
 
     if not valid_summaries:
+        router.log_stats()
+        await update_run(run_id, status="failed")
         logger.error("No valid summaries generated.")
         return
 
-    logger.info("Analysing research gaps...")
-    report = await identify_gaps(client, args.model, valid_summaries, args.subject, limiter)
-
-    with open(args.output, "w") as f:
-        f.write(f"# Research Gap Analysis: {args.subject}\n\n")
-        f.write(report)
-        f.write("\n\n## Source Paper Summaries\n\n")
-        for i, summary in enumerate(valid_summaries):
-            f.write(f"### Paper {i + 1}\n{summary}\n\n")
+    # Agent outputs are cached per stage, so a resumed run picks up after its last finished stage
+    resume_stages = run is not None and run["stage"] is not None
+    if resume_stages:
+        logger.info(f"Resuming the agent pipeline after the {run['stage']} stage.")
 
-    logger.info(f"Analysis complete! Report saved to {args.output}")
+    async def record_stage(event_type: str, data: dict):
+        if event_type == "stage" and data["state"] == "finished" and data["stage"] in PIPELINE_STAGES:
+            await update_run(run_id, stage=data["stage"])
 
-from modules.db import init_db
+    logger.info("Analysing research gaps...")
+    await update_run(run_id, status="analysing")
+    report = await identify_gaps(
+        client, args.model, valid_summaries, args.subject, limiter,
+        hierarchical=args.hierarchical, token_budget=args.token_budget,
+        use_agent_cache=not args.no_agent_cache or resume_stages, corpus_id=args.corpus,
+        on_event=record_stage, context_cache=args.context_cache, router=router, stream_tokens=False,
+    )
+    router.log_stats()
 
-# ... (keep existing process_pdfs and imports above) ...
-def _silence_ssl_errors():
-    logging.getLogger('asyncio').setLevel(logging.CRITICAL)
+    write_report(args.output, args.subject, report, valid_summaries, duplicates)
+    await update_run(run_id, status="completed")
+    logger.info(f"Analysis complete! Report saved to {args.output}")
 
 async def _main_async(args):
     await init_db()
-    await process_pdfs(args)
+    try:
+        await process_pdfs(args)
+    finally:
+        shutdown_extraction_pool()
+        await close_db()
+        if args.metrics_file:
+            with open(args.metrics_file, "w") as f:
+                f.write(render_metrics())
 
-def main():
-    _silence_ssl_errors()
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Academic Research Gap Identifier")
-    parser.add_argument("folder", help="Path to the folder containing PDF papers")
+    parser.add_argument("folder", help="Path to the folder containing PDF papers (omit with --top-k or --resume)", nargs="?")
     parser.add_argument(
         "--subject",
         help="The general subject matter (optional, inferred if skipped)",
@@ -106,14 +230,95 @@ def main():
         "--model", help="Gemini model ID to use", default="gemini-2.5-flash"
     )
     parser.add_argument(
-        "--rate-limit", help="Max requests per minute", type=int, default=5
+        "--summary-model", help="Model for the per-paper summaries (defaults to --model)", default=None
+    )
+    parser.add_argument(
+        "--reasoning-model", help="Model for the Critic and Innovator stages (defaults to --model)", default=None
+    )
+    parser.add_argument(
+        "--hedge",
+        help="Race a second request against calls still running after their tier's p95 latency",
+        action="store_true",
     )
     parser.add_argument(
-        "--concurrent-requests", help="Max concurrent requests", type=int, default=5
+        "--rate-limit",
+        help=f"Max requests per minute (default: {PACING_ARGS['rate_limit']}; overrides a resumed run's)",
+        type=int,
+        default=None,
     )
+    parser.add_argument(
+        "--concurrent-requests",
+        help=f"Max concurrent requests (default: {PACING_ARGS['concurrent_requests']}; overrides a resumed run's)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--hierarchical",
+        help="Synthesise and critique summaries in map-reduce chunks (for corpora that exceed the context window)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--token-budget",
+        help="Max summary tokens per agent prompt (the chunk size in hierarchical mode)",
+        type=int,
+        default=DEFAULT_STAGE_TOKEN_BUDGET,
+    )
+    parser.add_argument(
+        "--no-agent-cache",
+        help="Re-run every agent stage instead of reusing cached Synthesiser/Critic/Innovator outputs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--corpus",
+        help="Name of a persistent corpus; later runs only send newly added papers to the agents",
+        default=None,
+    )
+    parser.add_argument(
+        "--top-k",
+        help="Instead of a folder of PDFs, analyse the K previously summarised papers most relevant to --subject",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--extract-text",
+        help="Extract PDF text locally and send it inline; only scanned PDFs are uploaded to the File API",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dedup",
+        help="Detect near-duplicate PDFs (e.g. preprint and published versions) from their text and summarise each work once",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--context-cache",
+        help="Register the summaries as Gemini cached content shared by the Synthesiser and Critic stages",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue an interrupted run with its original arguments: the given run ID, or the latest unfinished run",
+        nargs="?",
+        const=LATEST_RUN,
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write the run's metrics in Prometheus text format to this file (e.g. for node_exporter's textfile collector)",
+        default=None,
+    )
+    return parser
 
+def main():
+    silence_ssl_errors()
+    parser = build_parser()
     args = parser.parse_args()
-    
+    if args.resume is None and (args.folder is None) == (args.top_k is None):
+        parser.error("pass either a folder of PDFs or --top-k (or --resume a run)")
+    if args.top_k is not None and args.top_k < 1:
+        parser.error("--top-k must be at least 1")
+    if args.top_k is not None and args.subject == parser.get_default("subject"):
+        parser.error("--top-k needs a --subject to search for")
+
     # Run the async main loop
     try:
         asyncio.run(_main_async(args))
@@ -1,17 +1,91 @@
+import asyncio
+import hashlib
 import logging
-from typing import List
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable, List, Tuple
 
 from google import genai
 from google.genai import types
 
-from modules.models import SynthesisResult, CriticResult, InnovatorResult
+from modules.models import PaperSummary, SynthesisResult, CriticResult, CriticAspectResult, InnovatorResult, ResearchProposal
+from modules.db import get_cached_agent_output, cache_agent_output, get_corpus, save_corpus
+from modules.dag import Stage, run_dag
+from modules.tokens import (
+    CHARS_PER_TOKEN, StageInput, estimate_tokens, summary_hash, count_summary_tokens, compact_stage_input,
+    log_token_savings,
+)
+from modules.telemetry import record_cache
+from modules.context_cache import MIN_CONTEXT_CACHE_TOKENS, CACHED_CORPUS_NOTE, corpus_context_cache, with_cached_content
 
 logger = logging.getLogger(__name__)
 
+# Default per-stage budget for the summary content of a single prompt (the chunk size in hierarchical mode)
+DEFAULT_STAGE_TOKEN_BUDGET = 200_000
+SUMMARY_SEPARATOR = "\n\n---\n\n"
+
+# Bump a stage's version whenever its prompt changes so cached outputs for it (and the stages after it) are ignored
+PROMPT_VERSIONS = {
+    "synthesiser": "2",
+    "critic": "3",
+    "innovator": "2",
+}
+
+# The Critic's sub-analyses; each can run as its own concurrent stage, and the Innovator
+# writes one proposal per aspect
+CRITIC_ASPECTS = tuple(CriticResult.model_fields)
+
+# The summary fields each stage's prompt receives (see modules.tokens.compact_stage_input)
+STAGE_FIELDS = {
+    "synthesiser": ("title", "core_research_question", "methodology", "key_findings"),
+    "critic": ("title", "key_findings", "limitations"),
+    "critic.unexplored_territories": ("title", "core_research_question", "limitations"),
+    "critic.methodological_limitations": ("title", "methodology", "limitations"),
+    "critic.contradictions": ("title", "key_findings"),
+}
+
+def _stage_cache_key(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+def corpus_cache_key(summaries: List[str], subject: str, model_id: str) -> str:
+    """Content-addressed key for a corpus: the sorted hashes of its summaries plus subject and model."""
+    summary_hashes = sorted(summary_hash(s) for s in summaries)
+    return _stage_cache_key(*summary_hashes, subject, model_id)
+
+def chunk_texts(texts: List[str], token_budget: int) -> List[List[str]]:
+    """Greedily packs texts, in order, into chunks whose estimated size fits the token budget.
+
+    Each text is truncated to half the budget so every chunk holds at least two of them,
+    which guarantees that repeated reduce rounds converge.
+    """
+    max_chars = (token_budget // 2 - 1) * CHARS_PER_TOKEN
+    chunks, current, current_tokens = [], [], 0
+    for text in texts:
+        text = text[:max_chars]
+        tokens = estimate_tokens(text)
+        if current and current_tokens + tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def format_synthesis(synthesis: SynthesisResult) -> str:
+    return f"Narrative: {synthesis.narrative}\nMethodologies: {synthesis.dominant_methodologies}"
+
+def format_critique(critic: CriticResult) -> str:
+    return (
+        f"Unexplored Territories: {critic.unexplored_territories}\n"
+        f"Methodological Limitations: {critic.methodological_limitations}\n"
+        f"Contradictions: {critic.contradictions}"
+    )
+
 async def run_synthesiser_agent(client: genai.Client, model_id: str, summaries: List[str], subject: str, generate_func) -> SynthesisResult:
     """Agent 1: Reads all summaries and creates a cohesive state of the field."""
     logger.info("Agent 1 (Synthesiser) is analysing summaries...")
-    combined_summaries = "\n\n---\n\n".join(summaries)
+    combined_summaries = SUMMARY_SEPARATOR.join(summaries)
     prompt = f"""
     You are the Synthesiser Agent. You have been provided with summaries of recent academic papers on "{subject}".
     
@@ -34,7 +108,7 @@ async def run_synthesiser_agent(client: genai.Client, model_id: str, summaries:
 async def run_critic_agent(client: genai.Client, model_id: str, summaries: List[str], synthesis: SynthesisResult, generate_func) -> CriticResult:
     """Agent 2: Reads the synthesis and raw summaries to find deep research gaps."""
     logger.info("Agent 2 (Critic) is finding research gaps...")
-    combined_summaries = "\n\n---\n\n".join(summaries)
+    combined_summaries = SUMMARY_SEPARATOR.join(summaries)
     
     prompt = f"""
     You are the Critic Agent. You have been provided with raw paper summaries and a synthesised 'State of the Field'.
@@ -59,14 +133,42 @@ async def run_critic_agent(client: genai.Client, model_id: str, summaries: List[
     response = await generate_func(client, model_id, contents=prompt, config=config)
     return CriticResult.model_validate_json(response.text)
 
-async def run_innovator_agent(client: genai.Client, model_id: str, critic_result: CriticResult, generate_func) -> InnovatorResult:
-    """Agent 3: Takes the gaps from the Critic and generates novel proposals."""
-    logger.info("Agent 3 (Innovator) is formulating research proposals...")
+async def run_critic_aspect_agent(client: genai.Client, model_id: str, summaries: List[str], synthesis: SynthesisResult, aspect: str, generate_func) -> str:
+    """Agent 2 (fan-out): Analyses a single aspect of the research gaps, concurrently with the others."""
+    logger.info(f"Agent 2 (Critic) is analysing {aspect.replace('_', ' ')}...")
+    combined_summaries = SUMMARY_SEPARATOR.join(summaries)
+    
+    prompt = f"""
+    You are the Critic Agent. You have been provided with raw paper summaries and a synthesised 'State of the Field'.
+    
+    Your goal is to strictly identify systemic Research Gaps of one kind only: {CriticResult.model_fields[aspect].description}
+    Do not be polite; be highly critical and analytical.
+    
+    State of the Field Synthesis:
+    Narrative: {synthesis.narrative}
+    Methodologies: {synthesis.dominant_methodologies}
+    
+    Raw Summaries for reference:
+    {combined_summaries}
+    """
+
+    config = types.GenerateContentConfig(
+        system_instruction="You are a ruthless academic Critic analysing research gaps.",
+        response_mime_type="application/json",
+        response_schema=CriticAspectResult,
+    )
+    
+    response = await generate_func(client, model_id, contents=prompt, config=config)
+    return CriticAspectResult.model_validate_json(response.text).analysis
+
+async def run_innovator_proposal_agent(client: genai.Client, model_id: str, critic_result: CriticResult, aspect: str, generate_func) -> ResearchProposal:
+    """Agent 3 (fan-out): Formulates one proposal targeting a single kind of gap, concurrently with the others."""
+    logger.info(f"Agent 3 (Innovator) is formulating a proposal for {aspect.replace('_', ' ')}...")
     
     prompt = f"""
     You are the Innovator Agent. Your colleague, the Critic Agent, has identified several severe research gaps in the literature.
     
-    Your goal is to invent 3 highly novel, specific research proposals that directly address these gaps.
+    Your goal is to invent one highly novel, specific research proposal that directly addresses the {aspect.replace('_', ' ').title()} below.
     
     Identified Research Gaps:
     Unexplored Territories: {critic_result.unexplored_territories}
@@ -77,18 +179,352 @@ async def run_innovator_agent(client: genai.Client, model_id: str, critic_result
     config = types.GenerateContentConfig(
         system_instruction="You are a brilliant academic Innovator formulating new studies.",
         response_mime_type="application/json",
-        response_schema=InnovatorResult,
+        response_schema=ResearchProposal,
+    )
+    
+    response = await generate_func(client, model_id, contents=prompt, config=config)
+    return ResearchProposal.model_validate_json(response.text)
+
+async def run_synthesis_reducer_agent(client: genai.Client, model_id: str, partials: List[str], subject: str, generate_func) -> SynthesisResult:
+    """Agent 1 (reduce step): Merges partial syntheses of paper subsets into one state of the field."""
+    logger.info(f"Agent 1 (Synthesiser) is merging {len(partials)} partial syntheses...")
+    combined_partials = SUMMARY_SEPARATOR.join(partials)
+    prompt = f"""
+    You are the Synthesiser Agent. Your colleagues have each synthesised a different subset of recent academic papers on "{subject}".
+    
+    Your goal is to merge their partial syntheses into a single cohesive state of the art.
+    Reconcile overlapping claims, keep points that are only supported by one subset, and identify the dominant methodologies across all subsets.
+    
+    Partial Syntheses:
+    {combined_partials}
+    """
+    
+    config = types.GenerateContentConfig(
+        system_instruction="You are an expert academic Synthesiser.",
+        response_mime_type="application/json",
+        response_schema=SynthesisResult,
+    )
+    
+    response = await generate_func(client, model_id, contents=prompt, config=config)
+    return SynthesisResult.model_validate_json(response.text)
+
+async def run_critic_reducer_agent(client: genai.Client, model_id: str, partials: List[str], synthesis: SynthesisResult, generate_func) -> CriticResult:
+    """Agent 2 (reduce step): Merges the research gaps found in each paper subset."""
+    logger.info(f"Agent 2 (Critic) is merging {len(partials)} partial critiques...")
+    combined_partials = SUMMARY_SEPARATOR.join(partials)
+    prompt = f"""
+    You are the Critic Agent. Your colleagues have each critiqued a different subset of papers against the same 'State of the Field'.
+    
+    Your goal is to merge their findings into one list of systemic Research Gaps. Gaps raised by several subsets are systemic; keep them prominent.
+    Do not be polite; be highly critical and analytical.
+    
+    State of the Field Synthesis:
+    Narrative: {synthesis.narrative}
+    Methodologies: {synthesis.dominant_methodologies}
+    
+    Partial Critiques:
+    {combined_partials}
+    """
+
+    config = types.GenerateContentConfig(
+        system_instruction="You are a ruthless academic Critic analysing research gaps.",
+        response_mime_type="application/json",
+        response_schema=CriticResult,
+    )
+    
+    response = await generate_func(client, model_id, contents=prompt, config=config)
+    return CriticResult.model_validate_json(response.text)
+
+async def run_incremental_synthesiser_agent(client: genai.Client, model_id: str, prior: SynthesisResult, new_summaries: List[str], subject: str, generate_func) -> SynthesisResult:
+    """Agent 1 (incremental): Updates an existing state of the field with newly added papers only."""
+    logger.info(f"Agent 1 (Synthesiser) is updating the synthesis with {len(new_summaries)} new summaries...")
+    combined_summaries = SUMMARY_SEPARATOR.join(new_summaries)
+    prompt = f"""
+    You are the Synthesiser Agent. You previously synthesised the state of the art for academic papers on "{subject}".
+    New papers have since been added to the corpus.
+    
+    Your goal is to update the existing synthesis so that it reflects the whole corpus. Integrate what the new papers establish,
+    revise claims they challenge, and keep everything from the existing synthesis that still stands.
+    
+    Existing Synthesis:
+    Narrative: {prior.narrative}
+    Methodologies: {prior.dominant_methodologies}
+    
+    Summaries of the newly added papers:
+    {combined_summaries}
+    """
+    
+    config = types.GenerateContentConfig(
+        system_instruction="You are an expert academic Synthesiser.",
+        response_mime_type="application/json",
+        response_schema=SynthesisResult,
     )
     
     response = await generate_func(client, model_id, contents=prompt, config=config)
-    return InnovatorResult.model_validate_json(response.text)
+    return SynthesisResult.model_validate_json(response.text)
 
-async def run_multi_agent_pipeline(client: genai.Client, model_id: str, summaries: List[str], subject: str, generate_func) -> str:
-    """Orchestrates the 3-step sequential agent pipeline and formats the final Markdown report."""
+async def run_incremental_critic_agent(client: genai.Client, model_id: str, prior: CriticResult, new_summaries: List[str], synthesis: SynthesisResult, generate_func) -> CriticResult:
+    """Agent 2 (incremental): Updates existing research gaps with newly added papers only."""
+    logger.info(f"Agent 2 (Critic) is updating research gaps with {len(new_summaries)} new summaries...")
+    combined_summaries = SUMMARY_SEPARATOR.join(new_summaries)
+    prompt = f"""
+    You are the Critic Agent. You previously identified systemic Research Gaps in a corpus of papers. New papers have since been added.
     
-    synthesis = await run_synthesiser_agent(client, model_id, summaries, subject, generate_func)
-    critic = await run_critic_agent(client, model_id, summaries, synthesis, generate_func)
-    innovator = await run_innovator_agent(client, model_id, critic, generate_func)
+    Your goal is to update the gaps: drop gaps the new papers close, add gaps they reveal, and record new contradictions.
+    Do not be polite; be highly critical and analytical.
+    
+    Updated State of the Field Synthesis:
+    Narrative: {synthesis.narrative}
+    Methodologies: {synthesis.dominant_methodologies}
+    
+    Existing Research Gaps:
+    {format_critique(prior)}
+    
+    Raw Summaries of the newly added papers:
+    {combined_summaries}
+    """
+
+    config = types.GenerateContentConfig(
+        system_instruction="You are a ruthless academic Critic analysing research gaps.",
+        response_mime_type="application/json",
+        response_schema=CriticResult,
+    )
+    
+    response = await generate_func(client, model_id, contents=prompt, config=config)
+    return CriticResult.model_validate_json(response.text)
+
+async def _map_reduce(texts: List[str], map_func: Callable, reduce_func: Callable, format_func: Callable, token_budget: int):
+    """Runs map_func over budget-sized chunks concurrently, then reduces the partial results
+    level by level until they fit in a single reduce_func call."""
+    chunks = chunk_texts(texts, token_budget)
+    if len(chunks) == 1:
+        return await map_func(chunks[0])
+    logger.info(f"Processing {len(texts)} summaries in {len(chunks)} chunks...")
+    partials = await asyncio.gather(*(map_func(chunk) for chunk in chunks))
+    while True:
+        chunks = chunk_texts([format_func(p) for p in partials], token_budget)
+        if len(chunks) == 1:
+            return await reduce_func(chunks[0])
+        partials = await asyncio.gather(*(reduce_func(chunk) for chunk in chunks))
+
+async def run_hierarchical_synthesiser(client: genai.Client, model_id: str, summaries: List[str], subject: str, generate_func, token_budget: int) -> SynthesisResult:
+    """Agent 1 in hierarchical mode: synthesises budget-sized chunks concurrently, then merges them."""
+    return await _map_reduce(
+        summaries,
+        lambda chunk: run_synthesiser_agent(client, model_id, chunk, subject, generate_func),
+        lambda partials: run_synthesis_reducer_agent(client, model_id, partials, subject, generate_func),
+        format_synthesis,
+        token_budget,
+    )
+
+async def run_hierarchical_critic(client: genai.Client, model_id: str, summaries: List[str], synthesis: SynthesisResult, generate_func, token_budget: int) -> CriticResult:
+    """Agent 2 in hierarchical mode: critiques budget-sized chunks concurrently, then merges them."""
+    return await _map_reduce(
+        summaries,
+        lambda chunk: run_critic_agent(client, model_id, chunk, synthesis, generate_func),
+        lambda partials: run_critic_reducer_agent(client, model_id, partials, synthesis, generate_func),
+        format_critique,
+        token_budget,
+    )
+
+async def _resolved(result):
+    return result
+
+def _corpus_delta(corpus: dict | None, summaries: List[str], subject: str, model_id: str, hierarchical: bool, token_budget: int) -> List[int] | None:
+    """Returns the indices of the summaries added since the corpus was last analysed, or None if a full run is needed."""
+    if corpus is None:
+        return None
+    if corpus["subject"] != subject or corpus["model_id"] != model_id:
+        logger.info("Corpus subject or model changed; re-synthesising from scratch.")
+        return None
+    current = {summary_hash(s): i for i, s in enumerate(summaries)}
+    if not corpus["members"] <= current.keys():
+        logger.info("Papers were removed from the corpus; re-synthesising from scratch.")
+        return None
+    new_indices = [i for h, i in current.items() if h not in corpus["members"]]
+    if hierarchical and len(chunk_texts([summaries[i] for i in new_indices], token_budget)) > 1:
+        logger.info("New papers exceed one hierarchical chunk; re-synthesising from scratch.")
+        return None
+    logger.info(f"Incremental corpus update: {len(new_indices)} new of {len(summaries)} papers.")
+    return new_indices
+
+def _stage_keys(base_key: str, mode: str) -> Tuple[str, str, str]:
+    """The Synthesiser, Critic and Innovator cache keys, each chained from the one before."""
+    synthesis_key = _stage_cache_key(base_key, mode, PROMPT_VERSIONS["synthesiser"])
+    critic_key = _stage_cache_key(synthesis_key, PROMPT_VERSIONS["critic"])
+    return synthesis_key, critic_key, _stage_cache_key(critic_key, PROMPT_VERSIONS["innovator"])
+
+async def _load_cached_stages(keys: Tuple[str, str, str]) -> dict:
+    synthesis_key, critic_key, innovator_key = keys
+    return {
+        "synthesiser": await _load_cached_stage("synthesiser", synthesis_key, SynthesisResult),
+        "critic": await _load_cached_stage("critic", critic_key, CriticResult),
+        "innovator": await _load_cached_stage("innovator", innovator_key, InnovatorResult),
+    }
+
+async def _load_cached_stage(stage: str, cache_key: str, result_model):
+    cached_json = await get_cached_agent_output(cache_key)
+    record_cache("agent", int(bool(cached_json)), int(not cached_json))
+    if not cached_json:
+        return None
+    logger.info(f"Loaded {stage} output from agent cache.")
+    return result_model.model_validate_json(cached_json)
+
+def _caching(stage: str, cache_key: str, run):
+    """Wraps a stage function so its result is stored in the agent cache."""
+    async def run_and_cache(*inputs):
+        result = await run(*inputs)
+        await cache_agent_output(cache_key, stage, result.model_dump_json())
+        return result
+    return run_and_cache
+
+async def run_multi_agent_pipeline(
+    client: genai.Client, model_id: str, papers: List[PaperSummary], subject: str, generate_func,
+    hierarchical: bool = False, token_budget: int = DEFAULT_STAGE_TOKEN_BUDGET, use_cache: bool = True,
+    corpus_id: str | None = None, on_event=None, context_cache: bool = False, model_key: str | None = None,
+) -> str:
+    """Runs the Synthesiser -> Critic -> Innovator pipeline as a stage DAG and formats the final Markdown report.
+
+    Independent stages run concurrently: the Critic fans out into one stage per gap aspect
+    (except in hierarchical or incremental mode), and the Innovator writes one proposal per
+    aspect in parallel. Every agent call takes its own limiter slot through `generate_func`,
+    and each stage logs its own timing and token usage.
+
+    Each stage receives only the summary fields it needs (STAGE_FIELDS), with near-duplicates
+    dropped; in flat mode the summaries are truncated to fit `token_budget` (counted exactly
+    with count_tokens), and the tokens saved are logged. In hierarchical mode the Synthesiser
+    and Critic instead map over chunks of at most `token_budget` estimated tokens and reduce
+    the partial results, so corpora larger than the model's context window still finish in a
+    bounded number of rounds.
+
+    Each stage's output is cached under a key chained from the corpus key and the prompt
+    versions of that stage and every stage before it, so a changed Innovator prompt resumes
+    from the cached Critic output. `use_cache=False` skips cache reads (results are still stored).
+
+    With a `corpus_id`, the last synthesis/critique of that corpus is stored, and when papers
+    have only been added since, the Synthesiser and Critic receive the prior result plus the
+    delta summaries instead of the whole corpus.
+
+    With `context_cache`, a flat full run registers the combined summaries as Gemini cached
+    content for the duration of the run, and the Synthesiser and Critic stages reference it
+    instead of resending the summaries (corpora below MIN_CONTEXT_CACHE_TOKENS are sent inline).
+
+    `on_event` is passed to `run_dag` to report stage transitions.
+
+    `model_key` identifies the stages' models in cache keys and stored corpora when
+    `generate_func` routes some stages away from `model_id` (see modules.llm.ModelRouter).
+    """
+    model_key = model_key or model_id
+    # Render each summary's full prompt text once; cache keys and token counts work on these
+    summaries = [paper.to_prompt() for paper in papers]
+    mode = f"hierarchical:{token_budget}" if hierarchical else f"flat:{token_budget}"
+    corpus_key = corpus_cache_key(summaries, subject, model_key)
+    synthesis_key, critic_key, innovator_key = _stage_keys(corpus_key, mode)
+    cached = await _load_cached_stages((synthesis_key, critic_key, innovator_key)) if use_cache else {}
+
+    counts = None
+    if not (cached.get("synthesiser") and cached.get("critic")):
+        counts = await count_summary_tokens(client, model_id, summaries)
+    stage_inputs = []
+    # Name of the Gemini cached content holding the whole corpus, while one is registered
+    cached_content = None
+
+    def stage_texts(stage: str, indices: List[int] | None = None) -> List[str]:
+        """The compacted summaries for a stage (of all papers, or only those at `indices`).
+        In hierarchical mode chunking enforces the budget, so nothing is truncated here."""
+        if cached_content and indices is None:
+            stage_inputs.append(StageInput(stage, [CACHED_CORPUS_NOTE], sum(counts), 0, cached=True))
+            return [CACHED_CORPUS_NOTE]
+        indices = range(len(papers)) if indices is None else indices
+        stage_input = compact_stage_input(
+            stage, [papers[i] for i in indices], [summaries[i] for i in indices], [counts[i] for i in indices],
+            STAGE_FIELDS[stage], None if hierarchical else token_budget,
+        )
+        stage_inputs.append(stage_input)
+        return stage_input.texts
+
+    if hierarchical:
+        run_synthesiser = lambda: run_hierarchical_synthesiser(client, model_id, stage_texts("synthesiser"), subject, generate_func, token_budget)
+        run_critic = lambda synthesis: run_hierarchical_critic(client, model_id, stage_texts("critic"), synthesis, generate_func, token_budget)
+    else:
+        run_synthesiser = lambda: run_synthesiser_agent(client, model_id, stage_texts("synthesiser"), subject, corpus_generate_func())
+        run_critic = None
+
+    def corpus_generate_func():
+        """generate_func for stages that read the full corpus, referencing the context cache when there is one."""
+        return with_cached_content(generate_func, cached_content) if cached_content else generate_func
+
+    new_indices = None
+    if corpus_id and not (cached.get("synthesiser") and cached.get("critic")):
+        corpus = await get_corpus(corpus_id)
+        new_indices = _corpus_delta(corpus, summaries, subject, model_key, hierarchical, token_budget)
+    if new_indices is not None:
+        # An incremental result builds on the corpus' stored analysis, so it is cached apart from
+        # a full analysis of the same papers, under a key that includes that prior analysis
+        prior_key = _stage_cache_key(corpus["synthesis_json"], corpus["critic_json"])
+        synthesis_key, critic_key, innovator_key = _stage_keys(_stage_cache_key(corpus_key, "incremental", prior_key), mode)
+        cached = await _load_cached_stages((synthesis_key, critic_key, innovator_key)) if use_cache else {}
+        prior_synthesis = SynthesisResult.model_validate_json(corpus["synthesis_json"])
+        prior_critic = CriticResult.model_validate_json(corpus["critic_json"])
+        if new_indices:
+            run_synthesiser = lambda: run_incremental_synthesiser_agent(client, model_id, prior_synthesis, stage_texts("synthesiser", new_indices), subject, generate_func)
+            run_critic = lambda synthesis: run_incremental_critic_agent(client, model_id, prior_critic, stage_texts("critic", new_indices), synthesis, generate_func)
+        else:
+            run_synthesiser = lambda: _resolved(prior_synthesis)
+            run_critic = lambda synthesis: _resolved(prior_critic)
+
+    stages = []
+    if cached.get("synthesiser"):
+        stages.append(Stage("synthesiser", partial(_resolved, cached["synthesiser"])))
+    else:
+        stages.append(Stage("synthesiser", _caching("synthesiser", synthesis_key, run_synthesiser)))
+
+    if cached.get("critic"):
+        stages.append(Stage("critic", partial(_resolved, cached["critic"])))
+    elif run_critic is not None:
+        stages.append(Stage("critic", _caching("critic", critic_key, run_critic), ["synthesiser"]))
+    else:
+        for aspect in CRITIC_ASPECTS:
+            stages.append(Stage(
+                f"critic.{aspect}",
+                lambda synthesis, aspect=aspect: run_critic_aspect_agent(
+                    client, model_id, stage_texts(f"critic.{aspect}"), synthesis, aspect, corpus_generate_func()
+                ),
+                ["synthesiser"],
+            ))
+        merge_critic = lambda *analyses: _resolved(CriticResult(**dict(zip(CRITIC_ASPECTS, analyses))))
+        stages.append(Stage("critic", _caching("critic", critic_key, merge_critic), [f"critic.{a}" for a in CRITIC_ASPECTS]))
+
+    if cached.get("innovator"):
+        stages.append(Stage("innovator", partial(_resolved, cached["innovator"])))
+    else:
+        for aspect in CRITIC_ASPECTS:
+            stages.append(Stage(
+                f"innovator.{aspect}",
+                partial(run_innovator_proposal_agent, client, model_id, aspect=aspect, generate_func=generate_func),
+                ["critic"],
+            ))
+        merge_innovator = lambda *proposals: _resolved(InnovatorResult(proposals=list(proposals)))
+        stages.append(Stage("innovator", _caching("innovator", innovator_key, merge_innovator), [f"innovator.{a}" for a in CRITIC_ASPECTS]))
+
+    use_context_cache = (
+        context_cache and not hierarchical and new_indices is None
+        and counts is not None and sum(counts) >= MIN_CONTEXT_CACHE_TOKENS
+    )
+    cache_scope = (
+        corpus_context_cache(client, model_id, SUMMARY_SEPARATOR.join(summaries), corpus_key)
+        if use_context_cache else nullcontext()
+    )
+    async with cache_scope as cached_content:
+        results, _ = await run_dag(stages, on_event=on_event)
+    log_token_savings(stage_inputs)
+    synthesis, critic, innovator = results["synthesiser"], results["critic"], results["innovator"]
+
+    if corpus_id:
+        await save_corpus(
+            corpus_id, subject, model_key, synthesis.model_dump_json(), critic.model_dump_json(),
+            [summary_hash(s) for s in summaries],
+        )
     
     logger.info("Multi-Agent pipeline successfully completed.")
     
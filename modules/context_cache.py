@@ -0,0 +1,61 @@
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List
+
+from google import genai
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+# Gemini rejects caches below a model-dependent minimum size (up to 4096 tokens), and
+# smaller corpora gain little from caching anyway
+MIN_CONTEXT_CACHE_TOKENS = 4096
+# Safety net only: the cache is deleted as soon as the pipeline finishes
+CONTEXT_CACHE_TTL = "1800s"
+# Stands in for the summaries in prompts whose stage reads them from the cached context
+CACHED_CORPUS_NOTE = "(The paper summaries are provided in the cached context above.)"
+
+@asynccontextmanager
+async def corpus_context_cache(
+    client: genai.Client, model_id: str, corpus_text: str, corpus_key: str,
+) -> AsyncIterator[str | None]:
+    """Registers the combined summaries as a Gemini cached content object for the duration
+    of the block, yielding its name, and deletes it in a `finally` like uploaded files.
+
+    Yields None (so callers inline the summaries as usual) if the cache cannot be created.
+    """
+    cached_content = None
+    try:
+        try:
+            cached_content = await client.aio.caches.create(
+                model=model_id,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"corpus-{corpus_key[:16]}",
+                    contents=[f"Paper summaries:\n\n{corpus_text}"],
+                    ttl=CONTEXT_CACHE_TTL,
+                ),
+            )
+            logger.info(f"Registered the summary corpus as cached content {cached_content.name}.")
+        except Exception as e:
+            logger.warning(f"Could not create a context cache, sending summaries inline: {e}")
+        yield cached_content.name if cached_content else None
+    finally:
+        if cached_content:
+            try:
+                logger.debug(f"Deleting cached content {cached_content.name}...")
+                await client.aio.caches.delete(name=cached_content.name)
+            except Exception as cleanup_e:
+                logger.error(f"Failed to delete cached content {cached_content.name}: {cleanup_e}")
+
+def with_cached_content(generate_func, cached_content: str):
+    """Wraps `generate_func` so requests reference the cached corpus.
+
+    Gemini does not accept a system instruction alongside cached content, so the stage's
+    system instruction is sent as the first part of the prompt instead.
+    """
+    async def generate(client: genai.Client, model_id: str, contents, config: types.GenerateContentConfig):
+        instruction = config.system_instruction
+        config = config.model_copy(update={"cached_content": cached_content, "system_instruction": None})
+        parts: List = [instruction, contents] if instruction else [contents]
+        return await generate_func(client, model_id, contents=parts, config=config)
+    return generate
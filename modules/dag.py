@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple
+
+from modules.telemetry import span
+
+logger = logging.getLogger(__name__)
+
+class StageMetrics:
+    """Wall-clock time and Gemini token usage of a single pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def __str__(self) -> str:
+        return (
+            f"Stage {self.name}: {self.seconds:.2f}s, {self.calls} calls, "
+            f"{self.input_tokens} tokens in / {self.output_tokens} tokens out"
+        )
+
+# Metrics of the stage whose task is currently running (each stage runs in its own task)
+_current_stage: ContextVar[StageMetrics | None] = ContextVar("current_stage", default=None)
+
+def current_stage_name() -> str | None:
+    """Name of the stage whose task is currently running, if any."""
+    metrics = _current_stage.get()
+    return metrics.name if metrics is not None else None
+
+def record_usage(response) -> None:
+    """Adds a Gemini response's token usage to the currently running stage, if any."""
+    metrics = _current_stage.get()
+    if metrics is None:
+        return
+    metrics.calls += 1
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        metrics.input_tokens += usage.prompt_token_count or 0
+        metrics.output_tokens += usage.candidates_token_count or 0
+
+class Stage:
+    """A node in the pipeline DAG: `func` is awaited with the results of `deps`, in order."""
+
+    def __init__(self, name: str, func: Callable[..., Awaitable[Any]], deps: Sequence[str] = ()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+async def run_dag(
+    stages: List[Stage], on_event: Callable[[str, dict], Awaitable[None]] | None = None,
+) -> Tuple[Dict[str, Any], List[StageMetrics]]:
+    """Runs every stage as soon as its dependencies have finished, so independent stages
+    run concurrently. Stages must be listed after the stages they depend on.
+
+    Returns the result of each stage by name, plus per-stage metrics. If any stage fails,
+    the stages still running are cancelled and the error is raised. `on_event` is awaited
+    with a "stage" event whenever a stage starts, finishes or fails.
+    """
+    tasks: Dict[str, asyncio.Task] = {}
+    metrics: Dict[str, StageMetrics] = {}
+
+    async def run(stage: Stage):
+        inputs = [await tasks[dep] for dep in stage.deps]
+        stage_metrics = metrics[stage.name] = StageMetrics(stage.name)
+        _current_stage.set(stage_metrics)
+        await notify(stage_metrics, "started")
+        start = time.perf_counter()
+        try:
+            with span(f"agent.{stage.name}", stage=stage.name):
+                result = await stage.func(*inputs)
+        except Exception:
+            stage_metrics.seconds = time.perf_counter() - start
+            await notify(stage_metrics, "failed")
+            raise
+        stage_metrics.seconds = time.perf_counter() - start
+        await notify(stage_metrics, "finished")
+        return result
+
+    async def notify(stage_metrics: StageMetrics, state: str):
+        if on_event is not None:
+            await on_event("stage", {
+                "stage": stage_metrics.name, "state": state, "seconds": round(stage_metrics.seconds, 2),
+            })
+
+    seen = set()
+    for stage in stages:
+        unknown = [dep for dep in stage.deps if dep not in seen]
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on unknown or later stages: {unknown}")
+        seen.add(stage.name)
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.create_task(run(stage))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    for stage in stages:
+        logger.info(str(metrics[stage.name]))
+    return {name: task.result() for name, task in tasks.items()}, [metrics[stage.name] for stage in stages]
@@ -1,50 +1,982 @@
+import os
+import json
+import time
+import asyncio
 import hashlib
 import sqlite3
+import zlib
 import aiosqlite
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import BinaryIO, Dict, List, Tuple
+
+try:
+    import zstandard
+except ImportError:  # Summaries are compressed with zlib instead
+    zstandard = None
+
+from modules.telemetry import span
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = "research_cache.db"
 
+# Pending cache writes are committed together once this many have queued up,
+# or after WRITE_FLUSH_INTERVAL seconds, whichever comes first.
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 1.0
+
+# Large reads keep hashing I/O-bound; hashlib releases the GIL on big buffers so threads scale.
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+# Agent-stage outputs older than this, or beyond this many entries (least recently used first), are evicted
+AGENT_CACHE_MAX_AGE_DAYS = 30
+AGENT_CACHE_MAX_ENTRIES = 1000
+
+# Progress events (see add_job_event) are committed in batches at most this many seconds apart
+EVENT_FLUSH_INTERVAL = 0.2
+# Progress events (most of them the agents' streamed tokens) of jobs finished longer ago than this
+# many seconds are deleted; their outcome stays available as the job's status and result
+JOB_EVENTS_MAX_AGE = 3600
+
+# Summary payloads are stored compressed: zstd when the zstandard package is installed, otherwise zlib.
+# Rows remember their codec, so either can read a cache written by the other (zstd rows need zstandard).
+SUMMARY_CODEC = "zstd" if zstandard is not None else "zlib"
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+# Model and prompt version of summaries migrated from before they were recorded; never served
+# unless claimed with claim_legacy_summaries
+LEGACY_VERSION = "legacy"
+MIGRATION_BATCH_SIZE = 500
+# A summary's last use is recorded at most this often (in seconds), through the batched writes,
+# so cache reads never take the write lock themselves
+SUMMARY_TOUCH_INTERVAL = 3600
+# Bound on the recorded last uses this process remembers; forgetting one only costs an extra update
+MAX_TRACKED_TOUCHES = 100_000
+
+# Stay under SQLite's default limit on bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+# Summaries are keyed by paper, model and prompt version, so a new model or prompt never serves a stale summary
+SUMMARIES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        file_hash TEXT NOT NULL,
+        model_id TEXT NOT NULL,
+        prompt_version TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        codec TEXT NOT NULL,
+        payload BLOB NOT NULL,
+        input_tokens INTEGER,
+        output_tokens INTEGER,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL,
+        PRIMARY KEY (file_hash, model_id, prompt_version)
+    )
+'''
+
+# Long-lived connection shared by the CLI and the FastAPI app (see init_db/close_db)
+_connection: aiosqlite.Connection | None = None
+_pending_writes: dict[tuple[str, str, str], tuple] = {}
+_write_lock = asyncio.Lock()
+_pending_touches: dict[tuple[str, str, str], float] = {}
+_last_touched: dict[tuple[str, str, str], float] = {}
+_flush_task: asyncio.Task | None = None
+_pending_events: list[tuple[str, str, str, float]] = []
+_event_flush_task: asyncio.Task | None = None
+
 async def init_db():
-    """Initializes the SQLite database with the required tables."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS summaries (
-                file_hash TEXT PRIMARY KEY,
-                filename TEXT NOT NULL,
-                json_data TEXT NOT NULL
-            )
-        ''')
-        await db.commit()
+    """Opens the shared SQLite connection (WAL mode) and creates the required tables."""
+    global _connection
+    if _connection is not None:
+        return
+    _connection = await aiosqlite.connect(DB_PATH)
+    for pragma in PRAGMAS:
+        await _connection.execute(pragma)
+    await _migrate_summaries()
+    await _connection.execute(SUMMARIES_SCHEMA.format(table="summaries"))
+    await _connection.execute('CREATE INDEX IF NOT EXISTS idx_summaries_last_used ON summaries (last_used_at)')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS extracted_texts (
+            file_hash TEXT PRIMARY KEY,
+            text TEXT NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS paper_signatures (
+            file_hash TEXT PRIMARY KEY,
+            signature BLOB NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS signature_keys (
+            band_key INTEGER NOT NULL,
+            file_hash TEXT NOT NULL,
+            PRIMARY KEY (band_key, file_hash)
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS token_counts (
+            summary_hash TEXT NOT NULL,
+            model_id TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (summary_hash, model_id)
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS summary_embeddings (
+            embedding_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_hash TEXT NOT NULL,
+            model_id TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            UNIQUE (file_hash, model_id)
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS agent_outputs (
+            cache_key TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            json_data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS corpora (
+            corpus_id TEXT PRIMARY KEY,
+            subject TEXT NOT NULL,
+            model_id TEXT NOT NULL,
+            synthesis_json TEXT NOT NULL,
+            critic_json TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS corpus_members (
+            corpus_id TEXT NOT NULL,
+            summary_hash TEXT NOT NULL,
+            PRIMARY KEY (corpus_id, summary_hash)
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            worker_id TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            heartbeat_at REAL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS job_papers (
+            job_id TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            status TEXT NOT NULL,
+            file_hash TEXT,
+            filename TEXT,
+            PRIMARY KEY (job_id, file_path)
+        )
+    ''')
+    await _add_missing_columns("job_papers", {"file_hash": "TEXT", "filename": "TEXT"})
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS job_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    await _connection.execute('CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events (job_id, event_id)')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS metric_snapshots (
+            source TEXT PRIMARY KEY,
+            snapshot TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS worker_demands (
+            worker_id TEXT PRIMARY KEY,
+            demand REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL,
+            stage TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    await _connection.execute('''
+        CREATE TABLE IF NOT EXISTS run_papers (
+            run_id TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (run_id, file_path)
+        )
+    ''')
+    await _connection.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+    await _connection.commit()
+    await evict_agent_outputs()
     logger.info("Database initialized.")
 
+async def _add_missing_columns(table: str, columns: Dict[str, str]):
+    """Adds columns introduced after `table` was first created in an existing database."""
+    async with _connection.execute(f'PRAGMA table_info({table})') as cursor:
+        existing = {row[1] for row in await cursor.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            await _connection.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+async def _migrate_summaries():
+    """Moves a `summaries` table from the original schema (one plain-JSON row per file hash)
+    to the versioned, compressed one. Existing rows are kept under LEGACY_VERSION, as the
+    model and prompt that produced them were never recorded."""
+    async with _connection.execute('PRAGMA table_info(summaries)') as cursor:
+        if "json_data" not in {row[1] for row in await cursor.fetchall()}:
+            return
+    # Take the write lock first, so concurrent workers opening the same database migrate it once
+    await _connection.execute('BEGIN IMMEDIATE')
+    try:
+        async with _connection.execute('PRAGMA table_info(summaries)') as cursor:
+            if "json_data" not in {row[1] for row in await cursor.fetchall()}:
+                await _connection.rollback()
+                return
+        logger.info("Migrating cached summaries to the versioned, compressed schema...")
+        await _connection.execute(SUMMARIES_SCHEMA.format(table="summaries_migrated"))
+        now = time.time()
+        migrated = 0
+        async with _connection.execute('SELECT file_hash, filename, json_data FROM summaries') as cursor:
+            while rows := await cursor.fetchmany(MIGRATION_BATCH_SIZE):
+                await _connection.executemany('''
+                    INSERT INTO summaries_migrated
+                    (file_hash, model_id, prompt_version, filename, codec, payload, created_at, last_used_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (file_hash, LEGACY_VERSION, LEGACY_VERSION, filename, *_compress(json_data), now, now)
+                    for file_hash, filename, json_data in rows
+                ])
+                migrated += len(rows)
+        await _connection.execute('DROP TABLE summaries')
+        await _connection.execute('ALTER TABLE summaries_migrated RENAME TO summaries')
+        await _connection.commit()
+    except BaseException:
+        await _connection.rollback()
+        raise
+    # Return the space of the uncompressed rows to the filesystem
+    await _connection.execute('VACUUM')
+    logger.warning(
+        f"Migrated {migrated} cached summaries. Their model and prompt were not recorded, so they are "
+        f"not served; if they came from the current prompt, claim them with "
+        f"`python cache.py migrate --legacy-model MODEL`."
+    )
+
+async def get_connection() -> aiosqlite.Connection:
+    """Returns the shared connection, opening it on first use."""
+    if _connection is None:
+        await init_db()
+    return _connection
+
+async def close_db():
+    """Flushes any pending writes and closes the shared connection."""
+    global _connection, _flush_task, _event_flush_task
+    if _connection is None:
+        return
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    if _event_flush_task is not None:
+        _event_flush_task.cancel()
+        _event_flush_task = None
+    await flush_pending_writes()
+    await flush_job_events()
+    await _connection.close()
+    _connection = None
+    logger.info("Database connection closed.")
+
+@asynccontextmanager
+async def transaction():
+    """Serialises writes on the shared connection and commits them as one unit (rolling back on error),
+    so concurrent coroutines never commit each other's half-finished work."""
+    db = await get_connection()
+    async with _write_lock:
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+def hash_fileobj(fileobj: BinaryIO) -> str:
+    """Calculates the SHA-256 hash of an open binary file from its current position, synchronously."""
+    sha256_hash = hashlib.sha256()
+    # Read and update hash in chunks of 1M
+    for byte_block in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b""):
+        sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
 def get_file_hash(filepath: str) -> str:
     """Calculates the SHA-256 hash of a file synchronously.
        To be run via asyncio.to_thread in the main loop to prevent blocking.
     """
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+    with span("hash_file", path=filepath), open(filepath, "rb") as f:
+        return hash_fileobj(f)
 
-async def get_cached_summary(file_hash: str) -> str | None:
-    """Retrieves the JSON string of a cached summary if it exists."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT json_data FROM summaries WHERE file_hash = ?', (file_hash,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return row[0]
+async def hash_files(filepaths: List[str]) -> List[str]:
+    """Hashes many files in parallel across a bounded thread pool, preserving input order."""
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        return await asyncio.gather(
+            *(loop.run_in_executor(pool, get_file_hash, path) for path in filepaths)
+        )
+
+def _compress(json_data: str) -> Tuple[str, bytes]:
+    data = json_data.encode("utf-8")
+    if SUMMARY_CODEC == "zstd":
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, ZLIB_LEVEL)
+
+def _decompress(codec: str, payload: bytes) -> str | None:
+    """Decodes a stored summary payload, or returns None if its codec is unavailable here."""
+    if codec == "zlib":
+        return zlib.decompress(payload).decode("utf-8")
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(payload).decode("utf-8")
+    logger.warning(f"Cannot read a summary compressed with {codec}; install zstandard to use it.")
     return None
 
-async def cache_summary(file_hash: str, filename: str, json_data: str):
-    """Stores the summary JSON string in the database."""
-    async with aiosqlite.connect(DB_PATH) as db:
+async def get_cached_summaries(file_hashes: List[str], model_id: str, prompt_version: str) -> Dict[str, str]:
+    """Resolves many cache lookups at once with `WHERE file_hash IN (...)` queries.
+
+    Only summaries made by `model_id` from the summary prompt `prompt_version` match.
+    Hits are marked as recently used (see touch_summaries and evict_summaries).
+    """
+    found = {
+        h: _pending_writes[(h, model_id, prompt_version)][6] for h in file_hashes
+        if (h, model_id, prompt_version) in _pending_writes
+    }
+    remaining = [h for h in dict.fromkeys(file_hashes) if h not in found]
+    last_used = {}
+    db = await get_connection()
+    with span("summary_cache_lookup", papers=len(remaining)):
+        for i in range(0, len(remaining), MAX_QUERY_PARAMS):
+            chunk = remaining[i:i + MAX_QUERY_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            query = f'''
+                SELECT file_hash, codec, payload, last_used_at FROM summaries
+                WHERE model_id = ? AND prompt_version = ? AND file_hash IN ({placeholders})
+            '''
+            async with db.execute(query, [model_id, prompt_version, *chunk]) as cursor:
+                async for file_hash, codec, payload, last_used_at in cursor:
+                    json_data = _decompress(codec, payload)
+                    if json_data is not None:
+                        found[file_hash] = json_data
+                        last_used[file_hash] = last_used_at
+    await touch_summaries(list(last_used), model_id, prompt_version, last_used)
+    return found
+
+async def touch_summaries(
+    file_hashes: List[str], model_id: str, prompt_version: str, last_used: Dict[str, float] | None = None,
+):
+    """Marks cached summaries as used now, so eviction removes the least recently used first.
+
+    The update is queued for the next batched write, and skipped for summaries whose last
+    use (from `last_used`, or recorded by this process) is within SUMMARY_TOUCH_INTERVAL.
+    """
+    now = time.time()
+    last_used = last_used or {}
+    if len(_last_touched) > MAX_TRACKED_TOUCHES:
+        _last_touched.clear()
+    for file_hash in file_hashes:
+        key = (file_hash, model_id, prompt_version)
+        previous = max(last_used.get(file_hash, 0.0), _last_touched.get(key, 0.0))
+        if now - previous < SUMMARY_TOUCH_INTERVAL:
+            _last_touched[key] = previous
+            continue
+        _last_touched[key] = now
+        _pending_touches[key] = now
+    if _pending_touches:
+        _schedule_flush()
+
+def _schedule_flush():
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_later())
+
+async def cache_summary(
+    file_hash: str, filename: str, json_data: str, model_id: str, prompt_version: str,
+    input_tokens: int | None = None, output_tokens: int | None = None,
+):
+    """Queues the summary JSON string for the next batched write to the database, with the
+    model and prompt version that produced it and the call's token counts."""
+    _pending_writes[(file_hash, model_id, prompt_version)] = (
+        file_hash, model_id, prompt_version, filename, input_tokens, output_tokens, json_data, time.time(),
+    )
+    if len(_pending_writes) >= WRITE_BATCH_SIZE:
+        await flush_pending_writes()
+    else:
+        _schedule_flush()
+
+async def _flush_later():
+    await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+    await flush_pending_writes()
+
+async def flush_pending_writes():
+    """Commits all queued summary writes and last-use updates in a single transaction."""
+    if not _pending_writes and not _pending_touches:
+        return
+    rows = list(_pending_writes.values())
+    values = [(*row[:6], *_compress(row[6]), row[7], row[7]) for row in rows]
+    # Last uses are best-effort: a failed update is not retried
+    touches = [(used_at, *key) for key, used_at in _pending_touches.items()]
+    _pending_touches.clear()
+    try:
+        with span("summary_cache_write", papers=len(rows)):
+            async with transaction() as db:
+                await db.executemany('''
+                    INSERT OR REPLACE INTO summaries (
+                        file_hash, model_id, prompt_version, filename, input_tokens, output_tokens,
+                        codec, payload, created_at, last_used_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', values)
+                await db.executemany(
+                    'UPDATE summaries SET last_used_at = ? WHERE file_hash = ? AND model_id = ? AND prompt_version = ?',
+                    touches,
+                )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to write {len(rows)} cached summaries: {e}")
+        return
+    for row in rows:
+        # Keep any newer write for the same key that was queued during the commit
+        if _pending_writes.get(row[:3]) is row:
+            del _pending_writes[row[:3]]
+    logger.debug(f"Committed {len(rows)} cached summaries.")
+
+async def evict_summaries(
+    max_age_days: float | None = None, max_entries: int | None = None, keep_prompt_version: str | None = None,
+) -> int:
+    """Deletes cached summaries not used for `max_age_days`, those beyond the `max_entries`
+    most recently used, and (with `keep_prompt_version`) those made from any other prompt
+    version. Embeddings left without a summary are deleted too. Returns the number of
+    summaries removed.
+    """
+    await flush_pending_writes()
+    removed = 0
+    async with transaction() as db:
+        if max_age_days is not None:
+            cursor = await db.execute(
+                'DELETE FROM summaries WHERE last_used_at < ?', (time.time() - max_age_days * 86400,)
+            )
+            removed += cursor.rowcount
+        if keep_prompt_version is not None:
+            cursor = await db.execute('DELETE FROM summaries WHERE prompt_version != ?', (keep_prompt_version,))
+            removed += cursor.rowcount
+        if max_entries is not None:
+            cursor = await db.execute('''
+                DELETE FROM summaries WHERE rowid NOT IN (
+                    SELECT rowid FROM summaries ORDER BY last_used_at DESC LIMIT ?
+                )
+            ''', (max_entries,))
+            removed += cursor.rowcount
+        await db.execute('''
+            DELETE FROM summary_embeddings WHERE NOT EXISTS (
+                SELECT 1 FROM summaries s WHERE s.file_hash = summary_embeddings.file_hash
+            )
+        ''')
+    logger.info(f"Evicted {removed} cached summaries.")
+    return removed
+
+async def claim_legacy_summaries(model_id: str, prompt_version: str) -> int:
+    """Attributes the summaries migrated without a model or prompt version to the given ones,
+    so they are served again. Rows that already have a summary under that key are left as they
+    are. Returns the number claimed."""
+    await flush_pending_writes()
+    async with transaction() as db:
+        cursor = await db.execute(
+            'UPDATE OR IGNORE summaries SET model_id = ?, prompt_version = ? WHERE model_id = ? AND prompt_version = ?',
+            (model_id, prompt_version, LEGACY_VERSION, LEGACY_VERSION),
+        )
+        return cursor.rowcount
+
+async def get_summary_stats() -> List[Tuple[str, str, int, int, int | None, int | None, float, float]]:
+    """Per model and prompt version: `(model_id, prompt_version, summaries, payload_bytes,
+    input_tokens, output_tokens, oldest_use, newest_use)`."""
+    await flush_pending_writes()
+    db = await get_connection()
+    async with db.execute('''
+        SELECT model_id, prompt_version, COUNT(*), SUM(LENGTH(payload)), SUM(input_tokens), SUM(output_tokens),
+               MIN(last_used_at), MAX(last_used_at)
+        FROM summaries GROUP BY model_id, prompt_version ORDER BY MAX(last_used_at) DESC
+    ''') as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+
+async def get_cached_text(file_hash: str) -> str | None:
+    """Retrieves the locally extracted text of a PDF ("" if it had no usable text layer)."""
+    db = await get_connection()
+    async with db.execute('SELECT text FROM extracted_texts WHERE file_hash = ?', (file_hash,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def cache_text(file_hash: str, text: str):
+    """Stores the locally extracted text of a PDF so it is never re-parsed."""
+    async with transaction() as db:
+        await db.execute(
+            'INSERT OR REPLACE INTO extracted_texts (file_hash, text) VALUES (?, ?)', (file_hash, text)
+        )
+
+async def get_signatures(file_hashes: List[str]) -> Dict[str, bytes]:
+    """Returns the stored near-duplicate signatures of the given hashes (b"" for papers without text)."""
+    found = {}
+    db = await get_connection()
+    remaining = list(dict.fromkeys(file_hashes))
+    for i in range(0, len(remaining), MAX_QUERY_PARAMS):
+        chunk = remaining[i:i + MAX_QUERY_PARAMS]
+        placeholders = ",".join("?" * len(chunk))
+        query = f'SELECT file_hash, signature FROM paper_signatures WHERE file_hash IN ({placeholders})'
+        async with db.execute(query, chunk) as cursor:
+            async for file_hash, signature in cursor:
+                found[file_hash] = signature
+    return found
+
+async def save_signatures(signatures: Dict[str, Tuple[bytes, List[int]]]):
+    """Stores each paper's signature with the lookup keys its near-duplicates are found by."""
+    async with transaction() as db:
+        await db.executemany(
+            'INSERT OR REPLACE INTO paper_signatures (file_hash, signature) VALUES (?, ?)',
+            [(file_hash, signature) for file_hash, (signature, _) in signatures.items()],
+        )
+        await db.executemany(
+            'INSERT OR IGNORE INTO signature_keys (band_key, file_hash) VALUES (?, ?)',
+            [(key, file_hash) for file_hash, (_, keys) in signatures.items() for key in keys],
+        )
+
+async def find_summarised_candidates(
+    keys: List[int], model_id: str, prompt_version: str,
+) -> Dict[str, Tuple[str, bytes]]:
+    """Returns the filename and signature of each paper summarised by `model_id` from
+    `prompt_version` that shares at least one lookup key with `keys`."""
+    found = {}
+    db = await get_connection()
+    remaining = list(dict.fromkeys(keys))
+    for i in range(0, len(remaining), MAX_QUERY_PARAMS):
+        chunk = remaining[i:i + MAX_QUERY_PARAMS]
+        placeholders = ",".join("?" * len(chunk))
+        query = f'''
+            SELECT DISTINCT p.file_hash, s.filename, p.signature FROM signature_keys k
+            JOIN paper_signatures p ON p.file_hash = k.file_hash
+            JOIN summaries s ON s.file_hash = k.file_hash AND s.model_id = ? AND s.prompt_version = ?
+            WHERE k.band_key IN ({placeholders})
+        '''
+        async with db.execute(query, [model_id, prompt_version, *chunk]) as cursor:
+            async for file_hash, filename, signature in cursor:
+                found[file_hash] = (filename, signature)
+    return found
+
+async def get_token_counts(summary_hashes: List[str], model_id: str) -> Dict[str, int]:
+    """Returns the cached token counts of the given summary hashes for a model."""
+    found = {}
+    db = await get_connection()
+    remaining = list(dict.fromkeys(summary_hashes))
+    for i in range(0, len(remaining), MAX_QUERY_PARAMS):
+        chunk = remaining[i:i + MAX_QUERY_PARAMS]
+        placeholders = ",".join("?" * len(chunk))
+        query = f'SELECT summary_hash, tokens FROM token_counts WHERE model_id = ? AND summary_hash IN ({placeholders})'
+        async with db.execute(query, [model_id, *chunk]) as cursor:
+            async for summary_hash, tokens in cursor:
+                found[summary_hash] = tokens
+    return found
+
+async def cache_token_counts(counts: Dict[str, int], model_id: str):
+    async with transaction() as db:
+        await db.executemany(
+            'INSERT OR REPLACE INTO token_counts (summary_hash, model_id, tokens) VALUES (?, ?, ?)',
+            [(summary_hash, model_id, tokens) for summary_hash, tokens in counts.items()],
+        )
+
+async def get_unembedded_summaries(model_id: str) -> List[Tuple[str, str]]:
+    """Returns `(file_hash, json_data)` of every cached paper without an embedding from `model_id`,
+    using the paper's most recent summary."""
+    await flush_pending_writes()
+    db = await get_connection()
+    latest = {}
+    async with db.execute('''
+        SELECT s.file_hash, s.codec, s.payload FROM summaries s
+        LEFT JOIN summary_embeddings e ON e.file_hash = s.file_hash AND e.model_id = ?
+        WHERE e.file_hash IS NULL ORDER BY s.created_at
+    ''', (model_id,)) as cursor:
+        async for file_hash, codec, payload in cursor:
+            json_data = _decompress(codec, payload)
+            if json_data is not None:
+                latest[file_hash] = json_data
+    return list(latest.items())
+
+async def cache_embeddings(vectors: Dict[str, bytes], model_id: str):
+    """Stores summary embeddings (packed float32 vectors) by file hash."""
+    with span("embedding_write", papers=len(vectors)):
+        async with transaction() as db:
+            await db.executemany(
+                'INSERT OR REPLACE INTO summary_embeddings (file_hash, model_id, vector) VALUES (?, ?, ?)',
+                [(file_hash, model_id, vector) for file_hash, vector in vectors.items()],
+            )
+
+async def get_embeddings(model_id: str, after_id: int = 0) -> List[Tuple[int, str, str, bytes]]:
+    """Returns `(embedding_id, file_hash, filename, vector)` of the summaries embedded with
+    `model_id` since `after_id`, in insertion order (a re-embedded summary gets a new id)."""
+    db = await get_connection()
+    async with db.execute('''
+        SELECT e.embedding_id, e.file_hash, MAX(s.filename), e.vector FROM summary_embeddings e
+        JOIN summaries s ON s.file_hash = e.file_hash
+        WHERE e.model_id = ? AND e.embedding_id > ? GROUP BY e.embedding_id ORDER BY e.embedding_id
+    ''', (model_id, after_id)) as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+
+async def get_cached_agent_output(cache_key: str) -> str | None:
+    """Retrieves a cached agent-stage result (JSON) and marks it as recently used."""
+    db = await get_connection()
+    with span("agent_cache_lookup"):
+        async with db.execute('SELECT json_data FROM agent_outputs WHERE cache_key = ?', (cache_key,)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    async with transaction() as db:
+        await db.execute('UPDATE agent_outputs SET last_used_at = ? WHERE cache_key = ?', (time.time(), cache_key))
+    return row[0]
+
+async def cache_agent_output(cache_key: str, stage: str, json_data: str):
+    """Stores an agent-stage result (JSON) under its content-addressed key."""
+    now = time.time()
+    with span("agent_cache_write", stage=stage):
+        async with transaction() as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO agent_outputs (cache_key, stage, json_data, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (cache_key, stage, json_data, now, now))
+
+async def evict_agent_outputs(
+    max_age_days: float = AGENT_CACHE_MAX_AGE_DAYS, max_entries: int = AGENT_CACHE_MAX_ENTRIES
+) -> int:
+    """Deletes agent-stage results that are too old or beyond the size cap. Returns the number removed."""
+    cutoff = time.time() - max_age_days * 86400
+    async with transaction() as db:
+        cursor = await db.execute('DELETE FROM agent_outputs WHERE last_used_at < ?', (cutoff,))
+        removed = cursor.rowcount
+        cursor = await db.execute('''
+            DELETE FROM agent_outputs WHERE cache_key NOT IN (
+                SELECT cache_key FROM agent_outputs ORDER BY last_used_at DESC LIMIT ?
+            )
+        ''', (max_entries,))
+        removed += cursor.rowcount
+    if removed:
+        logger.info(f"Evicted {removed} cached agent outputs.")
+    return removed
+
+async def get_corpus(corpus_id: str) -> dict | None:
+    """Retrieves a corpus's last synthesis/critique (JSON) and the summary hashes they covered."""
+    db = await get_connection()
+    async with db.execute(
+        'SELECT subject, model_id, synthesis_json, critic_json FROM corpora WHERE corpus_id = ?', (corpus_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    async with db.execute('SELECT summary_hash FROM corpus_members WHERE corpus_id = ?', (corpus_id,)) as cursor:
+        members = {member for (member,) in await cursor.fetchall()}
+    return {
+        "subject": row[0],
+        "model_id": row[1],
+        "synthesis_json": row[2],
+        "critic_json": row[3],
+        "members": members,
+    }
+
+async def save_corpus(
+    corpus_id: str, subject: str, model_id: str, synthesis_json: str, critic_json: str, members: List[str]
+):
+    """Replaces a corpus's stored synthesis/critique and membership in a single transaction."""
+    async with transaction() as db:
         await db.execute('''
-            INSERT OR REPLACE INTO summaries (file_hash, filename, json_data)
-            VALUES (?, ?, ?)
-        ''', (file_hash, filename, json_data))
-        await db.commit()
+            INSERT OR REPLACE INTO corpora (corpus_id, subject, model_id, synthesis_json, critic_json, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (corpus_id, subject, model_id, synthesis_json, critic_json, time.time()))
+        await db.execute('DELETE FROM corpus_members WHERE corpus_id = ?', (corpus_id,))
+        await db.executemany(
+            'INSERT OR IGNORE INTO corpus_members (corpus_id, summary_hash) VALUES (?, ?)',
+            [(corpus_id, member) for member in members],
+        )
+
+async def create_job(job_id: str, params: dict, papers: List[Tuple[str, str, str]]):
+    """Persists a new pending job and its `(file_path, file_hash, filename)` papers so any
+    worker process can claim it."""
+    now = time.time()
+    async with transaction() as db:
+        await db.execute(
+            'INSERT INTO jobs (job_id, status, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (job_id, "pending", json.dumps(params), now, now),
+        )
+        await db.executemany(
+            'INSERT OR IGNORE INTO job_papers (job_id, file_path, status, file_hash, filename) VALUES (?, ?, ?, ?, ?)',
+            [(job_id, path, "pending", file_hash, filename) for path, file_hash, filename in papers],
+        )
+
+async def claim_job(worker_id: str) -> dict | None:
+    """Atomically moves the oldest pending job to `processing` for this worker and returns it,
+    with its papers as `(file_path, file_hash, filename)` tuples."""
+    now = time.time()
+    async with transaction() as db:
+        async with db.execute('''
+            UPDATE jobs SET status = 'processing', worker_id = ?, updated_at = ?, heartbeat_at = ?
+            WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'pending' ORDER BY created_at LIMIT 1)
+            RETURNING job_id, params
+        ''', (worker_id, now, now)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    db = await get_connection()
+    async with db.execute(
+        'SELECT file_path, file_hash, filename FROM job_papers WHERE job_id = ?', (row[0],)
+    ) as cursor:
+        papers = [tuple(paper) for paper in await cursor.fetchall()]
+    return {"job_id": row[0], "params": json.loads(row[1]), "papers": papers}
+
+async def heartbeat_job(job_id: str):
+    async with transaction() as db:
+        await db.execute('UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?', (time.time(), job_id))
+
+async def requeue_job(job_id: str):
+    """Returns a job to the queue (e.g. when its worker shuts down mid-run)."""
+    async with transaction() as db:
+        await db.execute(
+            "UPDATE jobs SET status = 'pending', worker_id = NULL, updated_at = ? WHERE job_id = ? AND status = 'processing'",
+            (time.time(), job_id),
+        )
+
+async def requeue_stale_jobs(stale_after: float) -> int:
+    """Requeues processing jobs whose worker stopped sending heartbeats. Returns the number requeued."""
+    now = time.time()
+    async with transaction() as db:
+        cursor = await db.execute(
+            "UPDATE jobs SET status = 'pending', worker_id = NULL, updated_at = ? WHERE status = 'processing' AND heartbeat_at < ?",
+            (now, now - stale_after),
+        )
+    if cursor.rowcount:
+        logger.info(f"Requeued {cursor.rowcount} stale jobs.")
+    return cursor.rowcount
+
+async def release_job_files(job_id: str) -> List[str]:
+    """Returns the files of a job that no other pending or processing job still uses,
+    i.e. the ones that are safe to delete once it has finished (uploads are shared by content)."""
+    db = await get_connection()
+    async with db.execute('''
+        SELECT file_path FROM job_papers WHERE job_id = ? AND file_path NOT IN (
+            SELECT p.file_path FROM job_papers p JOIN jobs j ON j.job_id = p.job_id
+            WHERE p.job_id != ? AND j.status IN ('pending', 'processing')
+        )
+    ''', (job_id, job_id)) as cursor:
+        return [path for (path,) in await cursor.fetchall()]
+
+async def update_job_papers(job_id: str, file_paths: List[str], status: str):
+    """Records the status (done/failed) of some of a job's papers."""
+    async with transaction() as db:
+        await db.executemany(
+            'UPDATE job_papers SET status = ? WHERE job_id = ? AND file_path = ?',
+            [(status, job_id, path) for path in file_paths],
+        )
+
+async def finish_job(job_id: str, status: str, result: dict | None = None, error: str | None = None):
+    """Marks a job as completed or failed and stores its result or error.
+
+    Queued progress events are committed first, so a stream that sees the final status
+    has already seen every event of the job. The events of jobs that finished more than
+    JOB_EVENTS_MAX_AGE seconds ago are deleted.
+    """
+    await flush_job_events()
+    now = time.time()
+    async with transaction() as db:
+        await db.execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ?',
+            (status, json.dumps(result) if result is not None else None, error, now, job_id),
+        )
+        await db.execute('''
+            DELETE FROM job_events WHERE job_id IN (
+                SELECT job_id FROM jobs WHERE status IN ('completed', 'failed') AND updated_at < ?
+            )
+        ''', (now - JOB_EVENTS_MAX_AGE,))
+
+async def get_job(job_id: str, include_result: bool = True) -> dict | None:
+    """Retrieves a job's status, parameters, result/error and per-paper progress.
+    With `include_result=False` the (potentially large) result is not read at all."""
+    db = await get_connection()
+    columns = "status, params, error, result" if include_result else "status, params, error"
+    async with db.execute(f'SELECT {columns} FROM jobs WHERE job_id = ?', (job_id,)) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    async with db.execute(
+        'SELECT status, COUNT(*) FROM job_papers WHERE job_id = ? GROUP BY status', (job_id,)
+    ) as cursor:
+        paper_counts = dict(await cursor.fetchall())
+    job = {
+        "status": row[0],
+        "params": json.loads(row[1]),
+        "error": row[2],
+        "papers": paper_counts,
+    }
+    if include_result:
+        job["result"] = json.loads(row[3]) if row[3] else None
+    return job
+
+async def add_job_event(job_id: str, event_type: str, data: dict):
+    """Queues a progress event of a job for the next batched write (see EVENT_FLUSH_INTERVAL)."""
+    global _event_flush_task
+    _pending_events.append((job_id, event_type, json.dumps(data), time.time()))
+    if _event_flush_task is None or _event_flush_task.done():
+        _event_flush_task = asyncio.create_task(_flush_events_later())
+
+async def _flush_events_later():
+    await asyncio.sleep(EVENT_FLUSH_INTERVAL)
+    await flush_job_events()
+
+async def flush_job_events():
+    """Commits all queued progress events in a single transaction."""
+    if not _pending_events:
+        return
+    rows = _pending_events[:]
+    del _pending_events[:len(rows)]
+    try:
+        async with transaction() as db:
+            await db.executemany(
+                'INSERT INTO job_events (job_id, type, data, created_at) VALUES (?, ?, ?, ?)', rows
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to write {len(rows)} job events: {e}")
+
+async def get_job_events(job_id: str, after_id: int = 0) -> List[tuple[int, str, str]]:
+    """Returns a job's events newer than `after_id` as `(event_id, type, json_data)` tuples, oldest first."""
+    db = await get_connection()
+    async with db.execute(
+        'SELECT event_id, type, data FROM job_events WHERE job_id = ? AND event_id > ? ORDER BY event_id',
+        (job_id, after_id),
+    ) as cursor:
+        return await cursor.fetchall()
+
+async def create_run(run_id: str, params: dict, papers: List[Tuple[str, str]]):
+    """Records a new CLI run and its `(file_path, file_hash)` papers, all pending."""
+    now = time.time()
+    async with transaction() as db:
+        await db.execute(
+            'INSERT INTO runs (run_id, status, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (run_id, "running", json.dumps(params), now, now),
+        )
+        await db.executemany(
+            'INSERT OR IGNORE INTO run_papers (run_id, file_path, file_hash, state) VALUES (?, ?, ?, ?)',
+            [(run_id, path, file_hash, "pending") for path, file_hash in papers],
+        )
+
+async def get_run(run_id: str | None = None) -> dict | None:
+    """Retrieves a run's manifest (the latest unfinished run if `run_id` is None), with its
+    papers as `{file_path: {"file_hash", "state", "attempts", "error"}}`."""
+    db = await get_connection()
+    if run_id is None:
+        query = "SELECT run_id, status, params, stage FROM runs WHERE status != 'completed' ORDER BY created_at DESC LIMIT 1"
+        args = ()
+    else:
+        query = 'SELECT run_id, status, params, stage FROM runs WHERE run_id = ?'
+        args = (run_id,)
+    async with db.execute(query, args) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    async with db.execute(
+        'SELECT file_path, file_hash, state, attempts, error FROM run_papers WHERE run_id = ?', (row[0],)
+    ) as cursor:
+        papers = {
+            path: {"file_hash": file_hash, "state": state, "attempts": attempts, "error": error}
+            for path, file_hash, state, attempts, error in await cursor.fetchall()
+        }
+    return {"run_id": row[0], "status": row[1], "params": json.loads(row[2]), "stage": row[3], "papers": papers}
+
+async def update_run(run_id: str, status: str | None = None, stage: str | None = None):
+    """Updates a run's status (running/analysing/completed/failed/interrupted) and/or its
+    last finished agent stage."""
+    async with transaction() as db:
+        await db.execute(
+            'UPDATE runs SET status = COALESCE(?, status), stage = COALESCE(?, stage), updated_at = ? WHERE run_id = ?',
+            (status, stage, time.time(), run_id),
+        )
+
+async def update_run_papers(
+    run_id: str, file_paths: List[str], state: str, error: str | None = None, new_attempt: bool = False,
+):
+    """Records the state (pending/in-flight/done/failed) of some of a run's papers;
+    `new_attempt` counts one more summarisation attempt."""
+    async with transaction() as db:
+        await db.executemany(
+            'UPDATE run_papers SET state = ?, error = ?, attempts = attempts + ? WHERE run_id = ? AND file_path = ?',
+            [(state, error, int(new_attempt), run_id, path) for path in file_paths],
+        )
+
+async def count_jobs() -> Dict[str, int]:
+    """Number of jobs per status (the pending ones are the queue depth)."""
+    db = await get_connection()
+    async with db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status') as cursor:
+        return dict(await cursor.fetchall())
+
+async def save_metrics_snapshot(source: str, snapshot: str, max_age: float):
+    """Stores a process's metrics (see modules.telemetry.snapshot) for the API's /metrics,
+    and deletes the snapshots of processes that have not published for `max_age` seconds."""
+    now = time.time()
+    async with transaction() as db:
+        await db.execute(
+            'INSERT OR REPLACE INTO metric_snapshots (source, snapshot, updated_at) VALUES (?, ?, ?)',
+            (source, snapshot, now),
+        )
+        await db.execute('DELETE FROM metric_snapshots WHERE updated_at < ?', (now - max_age,))
+
+async def get_metrics_snapshots(max_age: float) -> List[str]:
+    """The metrics snapshots published in the last `max_age` seconds, i.e. of live processes."""
+    db = await get_connection()
+    async with db.execute(
+        'SELECT snapshot FROM metric_snapshots WHERE updated_at >= ?', (time.time() - max_age,)
+    ) as cursor:
+        return [snapshot for (snapshot,) in await cursor.fetchall()]
+
+async def save_worker_demand(worker_id: str, demand: float, max_age: float) -> Dict[str, float]:
+    """Publishes a worker process's claim on the API key's quota (the summed weights of its
+    jobs) and returns the claims of all live workers, this one included, by worker ID.
+    Claims not refreshed in the last `max_age` seconds belong to exited workers and are deleted."""
+    now = time.time()
+    async with transaction() as db:
+        await db.execute(
+            'INSERT OR REPLACE INTO worker_demands (worker_id, demand, updated_at) VALUES (?, ?, ?)',
+            (worker_id, demand, now),
+        )
+        await db.execute('DELETE FROM worker_demands WHERE updated_at < ?', (now - max_age,))
+        async with db.execute('SELECT worker_id, demand FROM worker_demands') as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+async def remove_worker_demand(worker_id: str):
+    """Withdraws an exiting worker's claim, so the others take over its share at once."""
+    async with transaction() as db:
+        await db.execute('DELETE FROM worker_demands WHERE worker_id = ?', (worker_id,))
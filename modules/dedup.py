@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import os
+import re
+from array import array
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from modules.models import DuplicateDecision, SummarySuccess
+from modules.db import get_signatures, save_signatures, find_summarised_candidates
+from modules.extract import get_paper_text, run_in_extraction_pool
+from modules.llm import SUMMARY_PROMPT_VERSION, load_summaries
+from modules.telemetry import span
+
+logger = logging.getLogger(__name__)
+
+# Papers are compared as sets of overlapping word 5-grams
+SHINGLE_WORDS = 5
+# Bottom-k MinHash: a signature is the SIGNATURE_SIZE smallest shingle hashes
+SIGNATURE_SIZE = 128
+# The smallest hashes double as lookup keys; near-duplicates almost always share some of them
+LOOKUP_KEYS = 16
+# Estimated Jaccard similarity from which two papers count as the same work. Preprints and
+# publisher versions typically score well above this; distinct papers on one topic far below.
+NEAR_DUPLICATE_THRESHOLD = 0.7
+# Lookup keys shared by more papers than this come from boilerplate (licences, headers) and are ignored
+MAX_KEY_PAPERS = 50
+HASH_MASK = (1 << 63) - 1
+
+def minhash_signature(text: str) -> bytes:
+    """Bottom-k MinHash signature of a text's word shingles, as sorted int64 values.
+       CPU-bound; run it in the extraction process pool.
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = (
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") & HASH_MASK
+        for shingle in shingles if shingle
+    )
+    return array("q", sorted(heapq.nsmallest(SIGNATURE_SIZE, hashes))).tobytes()
+
+def similarity(a: List[int], b: List[int]) -> float:
+    """Estimated Jaccard similarity of two signatures: the share of the union's k smallest
+    hashes that appear in both."""
+    k = min(SIGNATURE_SIZE, len(a), len(b))
+    if k == 0:
+        return 0.0
+    both = set(a) & set(b)
+    return sum(1 for h in heapq.nsmallest(k, set(a) | set(b)) if h in both) / k
+
+async def _signature(pdf_path: str, file_hash: str) -> bytes:
+    text = await get_paper_text(pdf_path, file_hash)
+    if text is None:
+        # Scanned PDFs have no text to compare; they are never treated as duplicates
+        return b""
+    with span("minhash", path=pdf_path):
+        return await run_in_extraction_pool(minhash_signature, text)
+
+async def collapse_duplicates(
+    cached: List[SummarySuccess], misses: List[Tuple[str, str]], model_id: str,
+    filenames: Dict[str, str] | None = None, cached_paths: Dict[str, str] | None = None,
+) -> Tuple[List[SummarySuccess], List[Tuple[str, str]], List[DuplicateDecision]]:
+    """Dedup pre-pass run after the cache pre-pass and before any Gemini call.
+
+    Computes (or loads) a MinHash signature of each paper's locally extracted text, then
+    collapses near-duplicates, keeping one paper per work:
+
+    - within the batch, a cached paper is kept over uncached ones, otherwise the first;
+    - an uncached paper that near-duplicates a paper summarised (by the summary model
+      `model_id`, from the current prompt) in an earlier run reuses that summary instead of
+      being summarised again.
+
+    `cached_paths` maps cached papers' hashes to their PDFs, so papers summarised without
+    dedup get a signature too; a cached paper whose PDF is not given or no longer exists is
+    only compared if an earlier dedup pass stored its signature. `filenames` maps the misses'
+    paths to display names (default: basenames). Returns the cached summaries and misses left,
+    plus one decision per collapsed paper.
+    """
+    filenames = filenames or {}
+    names = {paper.file_hash: paper.filename for paper in cached}
+    names.update({file_hash: filenames.get(pdf, os.path.basename(pdf)) for pdf, file_hash in misses})
+    signatures = await get_signatures(list(names))
+    cached_pdfs = [
+        (pdf, file_hash) for file_hash, pdf in (cached_paths or {}).items()
+        if file_hash in names and os.path.exists(pdf)
+    ]
+    missing = [(pdf, file_hash) for pdf, file_hash in cached_pdfs + misses if file_hash not in signatures]
+    if missing:
+        new = await asyncio.gather(*(_signature(pdf, file_hash) for pdf, file_hash in missing))
+        new_signatures = {file_hash: signature for (_, file_hash), signature in zip(missing, new)}
+        await save_signatures({
+            file_hash: (signature, list(array("q", signature))[:LOOKUP_KEYS])
+            for file_hash, signature in new_signatures.items()
+        })
+        signatures.update(new_signatures)
+    values = {file_hash: list(array("q", signature)) for file_hash, signature in signatures.items() if signature}
+
+    # Cluster the batch: candidates share a lookup key, and are merged above the threshold
+    order = [paper.file_hash for paper in cached] + [file_hash for _, file_hash in misses]
+    parent = {file_hash: file_hash for file_hash in order}
+    position = {file_hash: i for i, file_hash in enumerate(order)}
+
+    def find(file_hash: str) -> str:
+        while parent[file_hash] != file_hash:
+            parent[file_hash] = parent[parent[file_hash]]
+            file_hash = parent[file_hash]
+        return file_hash
+
+    by_key = defaultdict(list)
+    for file_hash in order:
+        for key in values.get(file_hash, [])[:LOOKUP_KEYS]:
+            by_key[key].append(file_hash)
+    compared = set()
+    for members in by_key.values():
+        if len(members) > MAX_KEY_PAPERS:
+            continue
+        for i, a in enumerate(members):
+            for b in members[i + 1:]:
+                if (a, b) in compared:
+                    continue
+                compared.add((a, b))
+                if similarity(values[a], values[b]) >= NEAR_DUPLICATE_THRESHOLD:
+                    # `order` lists cached papers first, so the earlier root is the one kept
+                    root_a, root_b = find(a), find(b)
+                    if root_a != root_b:
+                        keep, drop = sorted((root_a, root_b), key=position.get)
+                        parent[drop] = keep
+
+    decisions = []
+    for file_hash in order:
+        keep = find(file_hash)
+        if keep != file_hash:
+            decisions.append(DuplicateDecision(
+                filename=names[file_hash], file_hash=file_hash, duplicate_of=names[keep],
+                duplicate_of_hash=keep, similarity=round(similarity(values[file_hash], values[keep]), 3),
+            ))
+    collapsed = {decision.file_hash for decision in decisions}
+
+    # Match the remaining misses against papers summarised in earlier runs
+    remaining = [(pdf, file_hash) for pdf, file_hash in misses if file_hash not in collapsed]
+    keys = [key for _, file_hash in remaining for key in values.get(file_hash, [])[:LOOKUP_KEYS]]
+    library = {
+        file_hash: (filename, list(array("q", signature)))
+        for file_hash, (filename, signature) in (await find_summarised_candidates(keys, model_id, SUMMARY_PROMPT_VERSION)).items()
+        if file_hash not in parent
+    }
+    reused = {}
+    for pdf, file_hash in remaining:
+        if file_hash not in values:
+            continue
+        own_keys = set(values[file_hash][:LOOKUP_KEYS])
+        scores = [
+            (similarity(values[file_hash], candidate), candidate_hash, filename)
+            for candidate_hash, (filename, candidate) in library.items()
+            if own_keys.intersection(candidate[:LOOKUP_KEYS])
+        ]
+        best = max(scores, default=None)
+        if best is None or best[0] < NEAR_DUPLICATE_THRESHOLD:
+            continue
+        score, candidate_hash, filename = best
+        decisions.append(DuplicateDecision(
+            filename=names[file_hash], file_hash=file_hash, duplicate_of=filename,
+            duplicate_of_hash=candidate_hash, similarity=round(score, 3),
+        ))
+        collapsed.add(file_hash)
+        reused.setdefault(candidate_hash, names[file_hash])
+
+    summaries = await load_summaries(list(reused), model_id)
+    unavailable = set(reused) - set(summaries)
+    if unavailable:
+        # The candidate's summary went away (e.g. evicted) since it was matched: summarise the paper after all
+        restored = {d.file_hash for d in decisions if d.duplicate_of_hash in unavailable}
+        logger.warning(f"{len(restored)} near-duplicates matched summaries no longer cached; summarising them instead.")
+        decisions = [d for d in decisions if d.file_hash not in restored]
+        collapsed -= restored
+    kept = [paper for paper in cached if paper.file_hash not in collapsed] + [
+        SummarySuccess(filename=filename, file_hash=candidate_hash, summary=summaries[candidate_hash], cached=True)
+        for candidate_hash, filename in reused.items() if candidate_hash in summaries
+    ]
+    kept_misses = [(pdf, file_hash) for pdf, file_hash in misses if file_hash not in collapsed]
+    for decision in decisions:
+        logger.info(
+            f"Near-duplicate: {decision.filename} collapsed into {decision.duplicate_of} "
+            f"(similarity {decision.similarity:.2f})."
+        )
+    logger.info(
+        f"Dedup pre-pass: {len(decisions)} near-duplicates collapsed, {len(kept_misses)} papers to summarise."
+    )
+    return kept, kept_misses, decisions
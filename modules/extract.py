@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+from modules.db import get_cached_text, cache_text
+from modules.telemetry import record_cache, span
+
+logger = logging.getLogger(__name__)
+
+# Below this many characters a PDF is treated as scanned/unextractable and uploaded instead
+MIN_EXTRACTED_CHARS = 2000
+# Hard cap on inline text (~100k tokens) so one paper never dominates a request
+MAX_INLINE_CHARS = 400_000
+# Back-matter headings are only trusted past this fraction of the text, so a table of
+# contents or an early "Appendix A" reference does not cut the paper short
+BACK_MATTER_MIN_POSITION = 0.5
+EXTRACTION_WORKERS = 4
+
+BACK_MATTER_HEADING = re.compile(
+    r"^\s*(?:[0-9IVX]+\.?\s*)?"
+    r"(?:references|bibliography|works cited|literature cited|acknowledge?ments|"
+    r"appendix(?:\s+[a-z0-9]+)?|appendices|supplementary (?:materials?|information))"
+    r"\s*:?\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+_pool: ProcessPoolExecutor | None = None
+
+def trim_back_matter(text: str) -> str:
+    """Drops references, acknowledgements and appendices by cutting at the first
+    back-matter heading in the latter part of the paper."""
+    min_position = int(len(text) * BACK_MATTER_MIN_POSITION)
+    match = BACK_MATTER_HEADING.search(text, min_position)
+    if match:
+        text = text[:match.start()]
+    return text[:MAX_INLINE_CHARS].strip()
+
+def extract_pdf_text(pdf_path: str) -> str:
+    """Extracts and trims the text of a PDF synchronously. Returns "" if it has no usable text layer.
+       To be run in the extraction process pool.
+    """
+    try:
+        reader = PdfReader(pdf_path)
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)
+    except Exception as e:
+        logger.warning(f"Could not extract text from {pdf_path}: {e}")
+        return ""
+    text = trim_back_matter(text)
+    return text if len(text) >= MIN_EXTRACTED_CHARS else ""
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+    return _pool
+
+def shutdown_extraction_pool():
+    """Stops the extraction worker processes, if any were started."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+async def run_in_extraction_pool(func, *args):
+    """Runs a CPU-bound function (e.g. one over extracted text) in the extraction process pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), func, *args)
+
+async def get_paper_text(pdf_path: str, file_hash: str) -> str | None:
+    """Returns the trimmed text of a paper, parsing it in the process pool on a cache miss.
+
+    Returns None for scanned or unextractable PDFs (the result is cached too, so they are
+    never re-parsed).
+    """
+    text = await get_cached_text(file_hash)
+    record_cache("extracted_text", int(text is not None), int(text is None))
+    if text is None:
+        with span("extract_text", path=pdf_path):
+            text = await run_in_extraction_pool(extract_pdf_text, pdf_path)
+        await cache_text(file_hash, text)
+    return text or None
@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+from typing import List, get_args, get_origin
+
+from google.genai import errors, types
+from pydantic import BaseModel
+
+from modules.db import get_file_hash
+
+# Words the fake draws its deterministic "summaries" and "analyses" from
+VOCABULARY = (
+    "model data method results evidence sample analysis bias effect baseline benchmark dataset "
+    "cohort protocol variance signal framework evaluation limitation replication trial metric "
+    "robustness generalisation causal observational controlled longitudinal theory mechanism"
+).split()
+STREAM_CHUNK_CHARS = 40
+# Latency multiplier of the "slow" calls that make up the fake's latency tail
+SLOW_CALL_FACTOR = 10
+EMBEDDING_DIMENSIONS = 768
+
+def _key(*parts) -> str:
+    return hashlib.sha256("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def _fake_text(rng: random.Random, min_words: int = 20, max_words: int = 60) -> str:
+    return " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(min_words, max_words))).capitalize() + "."
+
+def _fake_instance(schema: type[BaseModel], rng: random.Random) -> dict:
+    """Fills every field of a response schema: strings get generated text, lists of models get three items."""
+    data = {}
+    for name, field in schema.model_fields.items():
+        annotation = field.annotation
+        if get_origin(annotation) in (list, List):
+            (item_type,) = get_args(annotation)
+            data[name] = [_fake_instance(item_type, rng) for _ in range(3)]
+        elif isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            data[name] = _fake_instance(annotation, rng)
+        else:
+            data[name] = _fake_text(rng)
+    return data
+
+def _fake_embedding(text: str, dimensions: int) -> List[float]:
+    """A hashed bag of words, so texts that share words get similar vectors."""
+    values = [0.0] * dimensions
+    for word in text.lower().split():
+        digest = hashlib.sha256(word.strip(".,:;").encode("utf-8")).digest()
+        values[int.from_bytes(digest[:4], "big") % dimensions] += 1.0 if digest[4] % 2 else -1.0
+    return values
+
+def _describe(contents) -> str:
+    """A stable description of request contents (uploaded files by name, everything else by value)."""
+    if isinstance(contents, list):
+        return "|".join(_describe(c) for c in contents)
+    if isinstance(contents, types.File):
+        return contents.name
+    return str(contents)
+
+class _FakeFiles:
+    def __init__(self, backend: "FakeClient"):
+        self._backend = backend
+
+    async def upload(self, *, file: str, config=None) -> types.File:
+        file_hash = await asyncio.to_thread(get_file_hash, file)
+        await self._backend._call("upload", file_hash, self._backend.upload_latency)
+        return types.File(name=f"files/{file_hash[:16]}", uri=f"fake://files/{file_hash[:16]}", mime_type="application/pdf")
+
+    async def delete(self, *, name: str, config=None):
+        await asyncio.sleep(0)
+
+class _FakeModels:
+    def __init__(self, backend: "FakeClient"):
+        self._backend = backend
+
+    async def generate_content(self, *, model: str, contents, config: types.GenerateContentConfig | None = None):
+        request = _describe(contents) + ((config.cached_content or "") if config else "")
+        await self._backend._call("generate", _key(model, request), self._backend.latency)
+        return self._backend._response(model, request, config)
+
+    async def generate_content_stream(self, *, model: str, contents, config: types.GenerateContentConfig | None = None):
+        request = _describe(contents) + ((config.cached_content or "") if config else "")
+        await self._backend._call("generate", _key(model, request), self._backend.latency / 2)
+        response = self._backend._response(model, request, config)
+
+        async def chunks():
+            text = response.text
+            for i in range(0, len(text), STREAM_CHUNK_CHARS):
+                await asyncio.sleep(self._backend.latency / 20)
+                last = i + STREAM_CHUNK_CHARS >= len(text)
+                yield types.GenerateContentResponse(
+                    candidates=[types.Candidate(content=types.Content(
+                        role="model", parts=[types.Part(text=text[i:i + STREAM_CHUNK_CHARS])]
+                    ))],
+                    usage_metadata=response.usage_metadata if last else None,
+                )
+        return chunks()
+
+    async def embed_content(self, *, model: str, contents, config: types.EmbedContentConfig | None = None):
+        await self._backend._call("embed", _key(model, _describe(contents)), self._backend.latency / 5)
+        dimensions = (config.output_dimensionality if config else None) or EMBEDDING_DIMENSIONS
+        texts = contents if isinstance(contents, list) else [contents]
+        return types.EmbedContentResponse(
+            embeddings=[types.ContentEmbedding(values=_fake_embedding(str(text), dimensions)) for text in texts]
+        )
+
+    async def count_tokens(self, *, model: str, contents, config=None) -> types.CountTokensResponse:
+        await asyncio.sleep(0)
+        return types.CountTokensResponse(total_tokens=len(_describe(contents)) // 4 + 1)
+
+class _FakeCaches:
+    def __init__(self, backend: "FakeClient"):
+        self._backend = backend
+
+    async def create(self, *, model: str, config=None) -> types.CachedContent:
+        await self._backend._call("cache", _key(model, _describe(config.contents)), self._backend.upload_latency)
+        return types.CachedContent(name=f"cachedContents/{_key(model, _describe(config.contents))[:16]}", model=model)
+
+    async def delete(self, *, name: str, config=None):
+        await asyncio.sleep(0)
+
+class _FakeAio:
+    def __init__(self, backend: "FakeClient"):
+        self.files = _FakeFiles(backend)
+        self.models = _FakeModels(backend)
+        self.caches = _FakeCaches(backend)
+
+class FakeClient:
+    """Deterministic offline stand-in for `genai.Client`, implementing the part of the
+    async surface this project uses (files, models incl. streaming, embeddings and count_tokens, caches).
+
+    Responses are valid instances of the requested response schema, generated from a hash
+    of the request, so the same request always gets the same answer. Each call waits about
+    `latency` seconds (uploads `upload_latency`), or SLOW_CALL_FACTOR times that with
+    probability `slow_rate`, and fails with a 429 carrying a RetryInfo delay with
+    probability `throttle_rate`, or with a 503 with probability `error_rate`. Latencies and
+    failures are decided per request and attempt, so retries of a request are reproducible too.
+    """
+
+    def __init__(
+        self, latency: float = 0.05, upload_latency: float = 0.02, error_rate: float = 0.0,
+        throttle_rate: float = 0.0, retry_after: float = 1.0, slow_rate: float = 0.0, seed: int = 0,
+    ):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.seed = seed
+        self.calls = {"upload": 0, "generate": 0, "embed": 0, "cache": 0, "throttled": 0, "failed": 0}
+        self._attempts = {}
+        self.aio = _FakeAio(self)
+
+    @classmethod
+    def from_env(cls) -> "FakeClient":
+        """Configures the fake from FAKE_LLM_* environment variables (see README)."""
+        return cls(
+            latency=float(os.getenv("FAKE_LLM_LATENCY", 0.05)),
+            upload_latency=float(os.getenv("FAKE_LLM_UPLOAD_LATENCY", 0.02)),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", 0.0)),
+            throttle_rate=float(os.getenv("FAKE_LLM_THROTTLE_RATE", 0.0)),
+            retry_after=float(os.getenv("FAKE_LLM_RETRY_AFTER", 1.0)),
+            slow_rate=float(os.getenv("FAKE_LLM_SLOW_RATE", 0.0)),
+            seed=int(os.getenv("FAKE_LLM_SEED", 0)),
+        )
+
+    async def _call(self, kind: str, request_key: str, latency: float):
+        """Simulates one API call: deterministic jittered latency plus injected failures."""
+        self.calls[kind] += 1
+        attempt = self._attempts.get(request_key, 0)
+        self._attempts[request_key] = attempt + 1
+        rng = random.Random(_key(self.seed, request_key, attempt))
+        roll = rng.random()
+        if roll < self.throttle_rate:
+            self.calls["throttled"] += 1
+            await asyncio.sleep(latency / 10)
+            raise errors.ClientError(429, {"error": {
+                "code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Fake quota exceeded.",
+                "details": [{
+                    "@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{self.retry_after}s",
+                }],
+            }})
+        if rng.random() < self.slow_rate:
+            latency *= SLOW_CALL_FACTOR
+        await asyncio.sleep(latency * (0.5 + rng.random()))
+        if roll < self.throttle_rate + self.error_rate:
+            self.calls["failed"] += 1
+            raise errors.ServerError(503, {"error": {"code": 503, "status": "UNAVAILABLE", "message": "Fake outage."}})
+
+    def _response(self, model: str, request: str, config: types.GenerateContentConfig | None) -> types.GenerateContentResponse:
+        rng = random.Random(_key(self.seed, model, request))
+        schema = config.response_schema if config else None
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            text = json.dumps(_fake_instance(schema, rng))
+        else:
+            text = _fake_text(rng, 100, 300)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=len(request) // 4 + 1, candidates_token_count=len(text) // 4 + 1,
+            ),
+        )
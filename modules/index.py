@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import logging
+import math
+from array import array
+from typing import Dict, List, Tuple
+
+from google import genai
+from google.genai import types
+
+try:
+    import numpy as np
+except ImportError:  # The index falls back to pure-Python dot products
+    np = None
+
+from modules.models import PaperSummary, SummarySuccess
+from modules.db import get_unembedded_summaries, cache_embeddings, get_embeddings
+from modules.llm import embed_with_retry, load_summaries
+from modules.telemetry import span
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "gemini-embedding-001"
+EMBEDDING_DIMENSIONS = 768
+# Embeddings are stored per model and size, so changing either re-embeds the cache
+EMBEDDING_KEY = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}"
+# Texts per embed_content request, and concurrent requests while backfilling the index
+EMBED_BATCH_SIZE = 100
+EMBED_CONCURRENCY = 4
+DEFAULT_TOP_K = 50
+
+def _pack(values: List[float]) -> bytes:
+    """Normalises a vector to unit length (so cosine similarity is a dot product) as float32 bytes."""
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return array("f", (v / norm for v in values)).tobytes()
+
+async def _embed(client: genai.Client, texts: List[str], task_type: str) -> List[bytes]:
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    config = types.EmbedContentConfig(task_type=task_type, output_dimensionality=EMBEDDING_DIMENSIONS)
+
+    async def embed_batch(batch: List[str]) -> List[bytes]:
+        async with semaphore:
+            response = await embed_with_retry(client, EMBEDDING_MODEL, batch, config)
+        return [_pack(embedding.values) for embedding in response.embeddings]
+
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    return [vector for vectors in await asyncio.gather(*map(embed_batch, batches)) for vector in vectors]
+
+async def index_summaries(client: genai.Client) -> int:
+    """Embeds every cached summary that has no embedding yet. Returns the number embedded.
+
+    Each summary is embedded once (per embedding model) and stored next to it in SQLite.
+    """
+    rows = await get_unembedded_summaries(EMBEDDING_KEY)
+    if not rows:
+        return 0
+    texts = [PaperSummary.model_validate_json(json_data).to_prompt() for _, json_data in rows]
+    vectors = await _embed(client, texts, "RETRIEVAL_DOCUMENT")
+    await cache_embeddings({file_hash: vector for (file_hash, _), vector in zip(rows, vectors)}, EMBEDDING_KEY)
+    logger.info(f"Embedded {len(rows)} new summaries.")
+    return len(rows)
+
+class SummaryIndex:
+    """In-memory brute-force index over the stored summary embeddings.
+
+    Loads only the embeddings added since its last refresh, so long-lived processes keep one
+    index up to date cheaply. Scores are cosine similarities, computed with numpy when it is
+    installed.
+    """
+
+    def __init__(self, model_id: str = EMBEDDING_KEY):
+        self.model_id = model_id
+        self.file_hashes: List[str] = []
+        self.filenames: List[str] = []
+        self._vectors: List[bytes] = []
+        self._positions: Dict[str, int] = {}
+        self._last_id = 0
+        self._matrix = None
+
+    def __len__(self) -> int:
+        return len(self.file_hashes)
+
+    async def refresh(self):
+        for embedding_id, file_hash, filename, vector in await get_embeddings(self.model_id, self._last_id):
+            self._last_id = embedding_id
+            self._matrix = None
+            if file_hash in self._positions:
+                self._vectors[self._positions[file_hash]] = vector
+                continue
+            self._positions[file_hash] = len(self.file_hashes)
+            self.file_hashes.append(file_hash)
+            self.filenames.append(filename)
+            self._vectors.append(vector)
+
+    def search(self, query: bytes, top_k: int) -> List[Tuple[int, float]]:
+        """The `top_k` most similar entries to a packed query vector, as `(position, score)`, best first."""
+        top_k = min(top_k, len(self))
+        if top_k <= 0:
+            return []
+        if np is not None:
+            if self._matrix is None:
+                self._matrix = np.frombuffer(b"".join(self._vectors), dtype=np.float32).reshape(len(self), -1)
+            scores = self._matrix @ np.frombuffer(query, dtype=np.float32)
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            return sorted(((int(i), float(scores[i])) for i in best), key=lambda item: -item[1])
+        query_values = array("f", query)
+        scores = (
+            (i, sum(a * b for a, b in zip(array("f", vector), query_values)))
+            for i, vector in enumerate(self._vectors)
+        )
+        return heapq.nlargest(top_k, scores, key=lambda item: item[1])
+
+# One index per process, refreshed before each search
+_index = SummaryIndex()
+
+async def find_relevant_papers(
+    client: genai.Client, subject: str, model_id: str, top_k: int = DEFAULT_TOP_K,
+) -> List[Tuple[SummarySuccess, float]]:
+    """Retrieves the `top_k` cached summaries most relevant to `subject`, with their cosine
+    similarity, best first. Summaries not yet embedded are embedded first (see index_summaries),
+    so the whole summary cache is searched without re-supplying any PDFs.
+
+    Only papers with a summary by the summary model `model_id` from the current prompt are
+    returned; the search widens until it finds `top_k` of them or runs out of papers.
+    """
+    with span("retrieve", top_k=top_k):
+        await index_summaries(client)
+        await _index.refresh()
+        (query,) = await _embed(client, [subject], "RETRIEVAL_QUERY")
+        k = top_k
+        while True:
+            hits = _index.search(query, k)
+            summaries = await load_summaries([_index.file_hashes[i] for i, _ in hits], model_id)
+            if len(summaries) >= top_k or k >= len(_index):
+                break
+            k *= 2
+    results = [
+        (SummarySuccess(
+            filename=_index.filenames[i], file_hash=_index.file_hashes[i],
+            summary=summaries[_index.file_hashes[i]], cached=True,
+        ), score)
+        for i, score in hits if _index.file_hashes[i] in summaries
+    ][:top_k]
+    logger.info(
+        f"Retrieved {len(results)} of {len(_index)} cached papers for '{subject}'"
+        + (f" (similarity {results[-1][1]:.3f} to {results[0][1]:.3f})." if results else ".")
+    )
+    return results
@@ -1,104 +1,528 @@
 import os
+import time
 import asyncio
+import hashlib
 import logging
 import json
-from typing import List
+from functools import partial
+from collections import Counter, OrderedDict, defaultdict, deque
+from typing import Awaitable, Callable, Dict, List, Tuple
 
 from google import genai
 from google.genai import types
-from aiolimiter import AsyncLimiter
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
-from modules.models import PaperSummary
+from modules.models import DuplicateDecision, PaperSummary, PaperOutcome, SummarySuccess, SummaryFailure
 from modules.prompts import get_summary_prompt
-from modules.db import get_cached_summary, cache_summary, get_file_hash
-from modules.agents import run_multi_agent_pipeline
+from modules.db import get_cached_summaries, cache_summary, touch_summaries, get_file_hash, hash_files
+from modules.extract import get_paper_text
+from modules.dag import record_usage, current_stage_name
+from modules.ratelimit import AdaptiveLimiter, AdaptiveRate, classify_error, get_retry_after, INVALID, THROTTLED
+from modules.fake_llm import FakeClient
+from modules.telemetry import RETRIES, TOKENS, record_cache, span
+from modules.agents import run_multi_agent_pipeline, DEFAULT_STAGE_TOKEN_BUDGET
 
 logger = logging.getLogger(__name__)
 
+# Validated summaries kept in memory (least recently used evicted first), so long-lived
+# processes such as the API workers don't re-parse cached JSON on every job
+SUMMARY_MEMO_SIZE = 10_000
+_summary_memo: "OrderedDict[Tuple[str, str], PaperSummary]" = OrderedDict()
+
+SUMMARY_SYSTEM_INSTRUCTION = "You are an expert academic researcher."
+# Identifies the summary prompt, system instruction and schema; cached summaries only match
+# the version they were made with, so editing any of them re-summarises papers on demand
+SUMMARY_PROMPT_VERSION = hashlib.sha256("\x00".join((
+    get_summary_prompt("{filename}"), SUMMARY_SYSTEM_INSTRUCTION,
+    json.dumps(PaperSummary.model_json_schema(), sort_keys=True),
+)).encode("utf-8")).hexdigest()[:16]
+
+# Model tiers: per-paper summaries, the Synthesiser (and its reducers), and the Critic/Innovator stages
+SUMMARY_TIER = "summary"
+SYNTHESIS_TIER = "synthesis"
+REASONING_TIER = "reasoning"
+REASONING_STAGES = ("critic", "innovator")
+# Hedging starts once a tier has this many latency samples, and uses the latest HEDGE_WINDOW of them
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+HEDGE_PERCENTILE = 0.95
+# At most this fraction of a tier's calls is hedged, so a slow backend never sees double the load
+MAX_HEDGE_FRACTION = 0.1
+
 def get_client() -> genai.Client:
+    """Returns the Gemini client, or the deterministic offline fake when LLM_BACKEND=fake
+    (configured through FAKE_LLM_* variables, see modules/fake_llm.py)."""
+    backend = os.getenv("LLM_BACKEND", "gemini")
+    if backend == "fake":
+        logger.info("Using the offline fake LLM backend.")
+        return FakeClient.from_env()
+    if backend != "gemini":
+        raise ValueError(f"Unknown LLM_BACKEND {backend!r} (expected 'gemini' or 'fake')")
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
         logger.error("GOOGLE_API_KEY not found in environment variables.")
         raise ValueError("GOOGLE_API_KEY missing")
     return genai.Client(api_key=api_key)
 
+def _percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class ModelRouter:
+    """Chooses the model for each generation by tier, and optionally hedges slow calls.
+
+    Paper summaries (calls made outside an agent stage) go to `summary_model`, the Critic
+    and Innovator stages to `reasoning_model`, and the Synthesiser to `default_model`;
+    unset tiers use `default_model`. Calls that reference a context cache stay on the
+    model the cache was created for.
+
+    With `hedge`, a non-streamed call still running after its tier's p95 latency is raced
+    against a second, identical request (which takes its own limiter slot), and whichever
+    finishes first is used. Routing decisions, hedges, hedge wins and latencies are
+    recorded per tier; see `stats`.
+    """
+
+    def __init__(
+        self, default_model: str, summary_model: str | None = None, reasoning_model: str | None = None,
+        hedge: bool = False,
+    ):
+        self.models = {
+            SUMMARY_TIER: summary_model or default_model,
+            SYNTHESIS_TIER: default_model,
+            REASONING_TIER: reasoning_model or default_model,
+        }
+        self.hedge = hedge
+        self.decisions: Counter = Counter()
+        self.hedges: Counter = Counter()
+        self.hedge_wins: Counter = Counter()
+        self._latencies = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+
+    @property
+    def summary_model(self) -> str:
+        return self.models[SUMMARY_TIER]
+
+    @property
+    def agent_model_key(self) -> str:
+        """Identifies the agent stages' models in cache keys (just the model ID when they share one)."""
+        if self.models[REASONING_TIER] == self.models[SYNTHESIS_TIER]:
+            return self.models[SYNTHESIS_TIER]
+        return f"{self.models[SYNTHESIS_TIER]}+{REASONING_TIER}:{self.models[REASONING_TIER]}"
+
+    def route(self, model_id: str, config: types.GenerateContentConfig) -> Tuple[str, str]:
+        """Returns the `(tier, model)` for a call from the current agent stage, and records the decision."""
+        stage = current_stage_name()
+        if stage is None:
+            tier = SUMMARY_TIER
+        elif stage.split(".")[0] in REASONING_STAGES:
+            tier = REASONING_TIER
+        else:
+            tier = SYNTHESIS_TIER
+        model = model_id if config.cached_content else self.models[tier]
+        self.decisions[(tier, model)] += 1
+        logger.debug(f"Routing {stage or 'paper summary'} to {model} ({tier} tier).")
+        return tier, model
+
+    def hedge_after(self, tier: str) -> float | None:
+        """Seconds after which a call of `tier` gets a hedge request, or None not to hedge it."""
+        samples = self._latencies[tier]
+        if not self.hedge or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        calls = sum(n for (t, _), n in self.decisions.items() if t == tier)
+        if self.hedges[tier] >= MAX_HEDGE_FRACTION * calls:
+            return None
+        return _percentile(samples, HEDGE_PERCENTILE)
+
+    def record_latency(self, tier: str, seconds: float):
+        self._latencies[tier].append(seconds)
+
+    def stats(self) -> Dict[str, dict]:
+        """Per-tier calls by model, hedges, hedge wins and p50/p95 latency of the recent calls."""
+        stats = {}
+        for (tier, model), calls in sorted(self.decisions.items()):
+            tier_stats = stats.setdefault(tier, {
+                "calls": {}, "hedges": self.hedges[tier], "hedge_wins": self.hedge_wins[tier],
+            })
+            tier_stats["calls"][model] = calls
+            samples = self._latencies[tier]
+            if samples:
+                tier_stats["p50_s"] = round(_percentile(samples, 0.5), 3)
+                tier_stats["p95_s"] = round(_percentile(samples, HEDGE_PERCENTILE), 3)
+        return stats
+
+    def log_stats(self):
+        for tier, tier_stats in self.stats().items():
+            models = ", ".join(f"{n} to {model}" for model, n in tier_stats["calls"].items())
+            latency = f", p50 {tier_stats['p50_s']}s / p95 {tier_stats['p95_s']}s" if "p50_s" in tier_stats else ""
+            logger.info(
+                f"Routing {tier}: {models}; {tier_stats['hedges']} hedged "
+                f"({tier_stats['hedge_wins']} won by the hedge){latency}."
+            )
+
+def _discard_result(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
+
+async def _routed_call(router: ModelRouter, tier: str, rate: AdaptiveRate | None, func, hedge: bool, **kwargs):
+    """One attempt of a routed call: records its latency and, past the tier's hedge
+    threshold, races it against a second request, returning whichever succeeds first."""
+
+    async def hedge_request():
+        if rate is not None:
+            await rate.acquire()
+        try:
+            return await func(**kwargs)
+        except Exception as e:
+            if rate is not None and classify_error(e) == THROTTLED:
+                rate.record_throttle(get_retry_after(e))
+            raise
+
+    start = time.perf_counter()
+    primary = asyncio.ensure_future(func(**kwargs))
+    tasks = [primary]
+    try:
+        hedge_after = router.hedge_after(tier) if hedge else None
+        if hedge_after is not None:
+            await asyncio.wait(tasks, timeout=hedge_after)
+            if not primary.done():
+                router.hedges[tier] += 1
+                tasks.append(asyncio.ensure_future(hedge_request()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        router.hedge_wins[tier] += 1
+                    router.record_latency(tier, time.perf_counter() - start)
+                    return task.result()
+        # Every request failed: surface the original one's error to the retry policy
+        return primary.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(_discard_result)
+
+_backoff = wait_exponential(multiplier=1, min=4, max=10)
+
+def _retry_wait(retry_state) -> float:
+    """Honours the server's retry-after when given, otherwise backs off exponentially."""
+    retry_after = get_retry_after(retry_state.outcome.exception())
+    return retry_after if retry_after is not None else _backoff(retry_state)
+
+def _record_retry(retry_state):
+    RETRIES.inc(reason=classify_error(retry_state.outcome.exception()))
+
 @retry(
     stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
+    wait=_retry_wait,
+    retry=retry_if_exception(lambda e: classify_error(e) != INVALID),
+    before_sleep=_record_retry,
     reraise=True
 )
-async def generate_with_retry(client: genai.Client, model_id: str, contents, config: types.GenerateContentConfig):
-    return await client.aio.models.generate_content(
-        model=model_id,
-        contents=contents,
-        config=config
+async def _call_with_retry(rate: AdaptiveRate | None, func, **kwargs):
+    """Calls the SDK, taking a slot from `rate` per attempt and feeding the outcome back to it.
+    Throttling and server errors are retried; validation errors are not."""
+    if rate is not None:
+        await rate.acquire()
+    try:
+        result = await func(**kwargs)
+    except Exception as e:
+        if rate is not None and classify_error(e) == THROTTLED:
+            rate.record_throttle(get_retry_after(e))
+        raise
+    if rate is not None:
+        rate.record_success()
+    return result
+
+async def _generate_streamed(client: genai.Client, on_event: Callable[[str, dict], Awaitable[None]], **kwargs):
+    """Streams a generation, forwarding each chunk as a "token" event, and returns the
+    assembled response. `offset` lets a listener discard text from a failed earlier attempt."""
+    stage = current_stage_name()
+    text = ""
+    usage = None
+    async for chunk in await client.aio.models.generate_content_stream(**kwargs):
+        if chunk.text:
+            await on_event("token", {"stage": stage, "offset": len(text), "text": chunk.text})
+            text += chunk.text
+        usage = chunk.usage_metadata or usage
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+        usage_metadata=usage,
+    )
+
+async def generate_with_retry(
+    client: genai.Client, model_id: str, contents, config: types.GenerateContentConfig,
+    limiter: AdaptiveLimiter | None = None, on_event: Callable[[str, dict], Awaitable[None]] | None = None,
+    router: ModelRouter | None = None,
+):
+    """Generates with retries and rate limiting. With `on_event`, the response is
+    streamed and its text is forwarded chunk by chunk as it arrives.
+
+    With a `router`, `model_id` is replaced by the model of the call's tier, and slow
+    calls may be hedged (streamed calls never are, as both requests would stream tokens).
+    """
+    rate = limiter.generate if limiter else None
+    if on_event is not None:
+        func = partial(_generate_streamed, client, on_event)
+    else:
+        func = client.aio.models.generate_content
+    if router is not None:
+        tier, model_id = router.route(model_id, config)
+        func = partial(_routed_call, router, tier, rate, func, on_event is None)
+    with span("generate", model=model_id, stage=current_stage_name() or "summary"):
+        response = await _call_with_retry(
+            rate,
+            func,
+            model=model_id,
+            contents=contents,
+            config=config
+        )
+    record_usage(response)
+    usage = response.usage_metadata
+    if usage is not None:
+        TOKENS.inc(usage.prompt_token_count or 0, model=model_id, direction="input")
+        TOKENS.inc(usage.candidates_token_count or 0, model=model_id, direction="output")
+    return response
+
+async def upload_with_retry(client: genai.Client, pdf_path: str, limiter: AdaptiveLimiter | None = None):
+    with span("upload", path=pdf_path):
+        return await _call_with_retry(limiter.upload if limiter else None, client.aio.files.upload, file=pdf_path)
+
+async def embed_with_retry(client: genai.Client, model_id: str, contents: List[str], config: types.EmbedContentConfig):
+    """Embeds a batch of texts with retries. Embeddings have their own quota, so no limiter slot is taken."""
+    with span("embed", model=model_id, texts=len(contents)):
+        return await _call_with_retry(None, client.aio.models.embed_content, model=model_id, contents=contents, config=config)
+
+def _format_timings(filename: str, timings: dict) -> str:
+    stages = " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in timings.items())
+    return f"Timings for {filename}: {stages}"
+
+def _memoise_summary(file_hash: str, model_id: str, summary: PaperSummary):
+    _summary_memo[(file_hash, model_id)] = summary
+    _summary_memo.move_to_end((file_hash, model_id))
+    if len(_summary_memo) > SUMMARY_MEMO_SIZE:
+        _summary_memo.popitem(last=False)
+
+async def load_summaries(file_hashes: List[str], model_id: str) -> Dict[str, PaperSummary]:
+    """Returns the cached summaries of the given hashes made by `model_id` from the current
+    summary prompt, validating each JSON row only once per process."""
+    found = {}
+    for file_hash in file_hashes:
+        if (file_hash, model_id) in _summary_memo:
+            _summary_memo.move_to_end((file_hash, model_id))
+            found[file_hash] = _summary_memo[(file_hash, model_id)]
+    await touch_summaries(list(found), model_id, SUMMARY_PROMPT_VERSION)
+    missing = [h for h in file_hashes if h not in found]
+    for file_hash, json_data in (await get_cached_summaries(missing, model_id, SUMMARY_PROMPT_VERSION)).items():
+        found[file_hash] = PaperSummary.model_validate_json(json_data)
+        _memoise_summary(file_hash, model_id, found[file_hash])
+    return found
+
+async def resolve_cached_papers(
+    pdf_paths: List[str], model_id: str, file_hashes: List[str | None] | None = None,
+    filenames: List[str] | None = None,
+) -> Tuple[List[SummarySuccess], List[Tuple[str, str]]]:
+    """Cache pre-pass run before any API work is scheduled.
+
+    Hashes every PDF in parallel and resolves all hits with a single query. Returns the
+    summaries cached for the summary model `model_id` and the `(pdf_path, file_hash)` pairs
+    that still need summarising. Byte-identical PDFs are only returned once.
+
+    Hashes already known (e.g. computed while ingesting an upload) can be passed as
+    `file_hashes`; only the PDFs whose entry is None are read, so a cached paper's file
+    need not exist at all. `filenames` default to the PDFs' basenames.
+    """
+    start = time.perf_counter()
+    file_hashes = list(file_hashes or [None] * len(pdf_paths))
+    filenames = filenames or [os.path.basename(pdf_path) for pdf_path in pdf_paths]
+    unknown = [i for i, file_hash in enumerate(file_hashes) if file_hash is None]
+    for i, file_hash in zip(unknown, await hash_files([pdf_paths[i] for i in unknown])):
+        file_hashes[i] = file_hash
+    cached = await load_summaries(file_hashes, model_id)
+    record_cache("summary", len(cached), len(set(file_hashes)) - len(cached))
+
+    cached_summaries = []
+    misses = []
+    seen = set()
+    for pdf_path, file_hash, filename in zip(pdf_paths, file_hashes, filenames):
+        if file_hash in seen:
+            logger.info(f"Skipping {filename}: identical to another PDF in this batch.")
+            continue
+        seen.add(file_hash)
+        if file_hash in cached:
+            cached_summaries.append(
+                SummarySuccess(filename=filename, file_hash=file_hash, summary=cached[file_hash], cached=True)
+            )
+        else:
+            misses.append((pdf_path, file_hash))
+
+    logger.info(
+        f"Cache pre-pass: {len(cached_summaries)} cached, {len(misses)} to summarise "
+        f"({time.perf_counter() - start:.2f}s)."
     )
+    return cached_summaries, misses
+
+async def run_prepasses(
+    pdf_paths: List[str], model_id: str, file_hashes: List[str | None], filenames: List[str] | None = None,
+    dedup: bool = False, on_done: Callable[[List[str]], Awaitable[None]] | None = None,
+) -> Tuple[List[SummarySuccess], List[Tuple[str, str]], List[DuplicateDecision]]:
+    """Resolves cache hits (see resolve_cached_papers) and, with `dedup`, collapses
+    near-duplicates (see collapse_duplicates) up front, so only the papers left to summarise
+    take a semaphore/limiter slot.
+
+    `on_done` is awaited with the PDFs resolved without summarising: the cache hits, then the
+    collapsed near-duplicates. Returns the summaries found, the `(pdf_path, file_hash)` pairs
+    still to summarise, and the near-duplicate decisions.
+    """
+    # dedup loads summaries through this module, so it is imported here rather than at the top
+    from modules.dedup import collapse_duplicates
+
+    paper_summaries, misses = await resolve_cached_papers(pdf_paths, model_id, file_hashes, filenames)
+    pending = {pdf for pdf, _ in misses}
+    if on_done:
+        await on_done([pdf for pdf in pdf_paths if pdf not in pending])
+    duplicates = []
+    if dedup:
+        paths = {file_hash: pdf for pdf, file_hash in misses}
+        paper_summaries, misses, duplicates = await collapse_duplicates(
+            paper_summaries, misses, model_id, dict(zip(pdf_paths, filenames)) if filenames else None,
+            cached_paths={file_hash: pdf for pdf, file_hash in zip(pdf_paths, file_hashes) if file_hash},
+        )
+        if on_done:
+            await on_done([paths[d.file_hash] for d in duplicates if d.file_hash in paths])
+    return paper_summaries, misses, duplicates
 
 async def summarise_paper(
-    client: genai.Client, model_id: str, pdf_path: str, limiter: AsyncLimiter
-) -> str:
-    """Uploads and uses Gemini to summarise a single paper (with SQLite caching)."""
-    filename = os.path.basename(pdf_path)
+    client: genai.Client, model_id: str, pdf_path: str, limiter: AdaptiveLimiter, file_hash: str | None = None,
+    extract_text: bool = False, filename: str | None = None, router: ModelRouter | None = None,
+) -> PaperOutcome:
+    """Uploads and uses Gemini to summarise a single paper (with SQLite caching).
+
+    Returns a SummarySuccess, or a SummaryFailure describing the error; it never raises
+    for a single bad paper.
+
+    The upload and delete go through the SDK's async client so a large PDF never stalls
+    the event loop, and the upload happens before a rate-limit slot is taken so it
+    overlaps with other papers' in-flight generate calls. Pass `file_hash` when the
+    file has already been hashed by `resolve_cached_papers`.
+
+    With `extract_text`, the paper's text is parsed locally (references and appendices
+    dropped) and sent inline instead; only scanned or unextractable PDFs are uploaded.
+
+    `filename` is the name shown to the model and stored with the summary; it defaults to
+    the PDF's basename. A `router` sends the generation to its summary tier. Summaries are
+    cached per summary model and prompt version.
+    """
+    filename = filename or os.path.basename(pdf_path)
+    summary_model = router.summary_model if router else model_id
+    timings = {}
     
     # Check cache first
-    file_hash = await asyncio.to_thread(get_file_hash, pdf_path)
-    cached_json = await get_cached_summary(file_hash)
-    if cached_json:
+    if file_hash is None:
+        start = time.perf_counter()
+        file_hash = await asyncio.to_thread(get_file_hash, pdf_path)
+        timings["hash"] = time.perf_counter() - start
+    cached = (await load_summaries([file_hash], summary_model)).get(file_hash)
+    if cached:
         logger.info(f"Loaded {filename} from SQLite cache.")
-        summary_data = PaperSummary.model_validate_json(cached_json)
-        return summary_data.to_markdown()
+        return SummarySuccess(filename=filename, file_hash=file_hash, summary=cached, cached=True)
 
-    # Wait for rate limit before calling API
-    async with limiter:
-        uploaded_file = None
-        try:
+    uploaded_file = None
+    try:
+        paper_text = None
+        if extract_text:
+            start = time.perf_counter()
+            paper_text = await get_paper_text(pdf_path, file_hash)
+            timings["extract"] = time.perf_counter() - start
+            if paper_text is None:
+                logger.info(f"No usable text layer in {filename}; falling back to upload.")
+
+        if paper_text is not None:
+            paper_content = f"Full text of {filename}:\n\n{paper_text}"
+        else:
             logger.info(f"Uploading {filename} to Gemini...")
             # Upload via File API
-            uploaded_file = client.files.upload(file=pdf_path)
-            
-            # System Instruction + Structured Output (Pydantic)
-            config = types.GenerateContentConfig(
-                system_instruction="You are an expert academic researcher.",
-                response_mime_type="application/json",
-                response_schema=PaperSummary,
-            )
-            
-            prompt = get_summary_prompt(filename)
-            logger.info(f"Generating summary for {filename}...")
-            
-            response = await generate_with_retry(
-                client, 
-                model_id, 
-                contents=[uploaded_file, prompt], 
-                config=config
-            )
-            
-            # Save to Cache 
-            await cache_summary(file_hash, filename, response.text)
-            
-            summary_data = PaperSummary.model_validate_json(response.text)
-            logger.info(f"Successfully summarised {filename}.")
-            return summary_data.to_markdown()
+            start = time.perf_counter()
+            uploaded_file = await upload_with_retry(client, pdf_path, limiter)
+            timings["upload"] = time.perf_counter() - start
+            paper_content = uploaded_file
+        
+        # System Instruction + Structured Output (Pydantic)
+        config = types.GenerateContentConfig(
+            system_instruction=SUMMARY_SYSTEM_INSTRUCTION,
+            response_mime_type="application/json",
+            response_schema=PaperSummary,
+        )
+        
+        prompt = get_summary_prompt(filename)
 
-        except Exception as e:
-            logger.error(f"Error summarising {filename}: {e}")
-            return f"Error summarising {filename}: {e}\n"
-        finally:
-            # Cleanup File strictly in finally block
-            if uploaded_file:
-                try:
-                    logger.debug(f"Cleaning up file {uploaded_file.name}...")
-                    client.files.delete(name=uploaded_file.name)
-                except Exception as cleanup_e:
-                    logger.error(f"Failed to delete file {uploaded_file.name}: {cleanup_e}")
-
-async def identify_gaps(client: genai.Client, model_id: str, summaries: List[str], subject: str, limiter: AsyncLimiter) -> str:
-    """Orchestrates the multi-agent synthesis."""
-    async with limiter:
-        try:
-            # We pass down generate_with_retry so the agents get the tenacity benefits
-            return await run_multi_agent_pipeline(client, model_id, summaries, subject, generate_with_retry)
-        except Exception as e:
-            logger.error(f"Error in multi-agent pipeline: {e}")
-            return f"Error analysing gaps: {e}"
+        # Waits for a generation slot from the adaptive limiter before each attempt
+        logger.info(f"Generating summary for {filename}...")
+        start = time.perf_counter()
+        response = await generate_with_retry(
+            client, 
+            model_id, 
+            contents=[paper_content, prompt], 
+            config=config,
+            limiter=limiter,
+            router=router,
+        )
+        timings["generate"] = time.perf_counter() - start
+        
+        # Validate before caching so a malformed response is never stored
+        summary_data = PaperSummary.model_validate_json(response.text)
+        usage = response.usage_metadata
+        await cache_summary(
+            file_hash, filename, response.text, summary_model, SUMMARY_PROMPT_VERSION,
+            input_tokens=usage.prompt_token_count if usage else None,
+            output_tokens=usage.candidates_token_count if usage else None,
+        )
+        _memoise_summary(file_hash, summary_model, summary_data)
+        logger.info(f"Successfully summarised {filename}.")
+        return SummarySuccess(filename=filename, file_hash=file_hash, summary=summary_data)
+
+    except Exception as e:
+        logger.error(f"Error summarising {filename}: {e}")
+        return SummaryFailure(filename=filename, file_hash=file_hash, error=str(e))
+    finally:
+        # Cleanup File strictly in finally block
+        if uploaded_file:
+            start = time.perf_counter()
+            try:
+                logger.debug(f"Cleaning up file {uploaded_file.name}...")
+                with span("delete", file=uploaded_file.name):
+                    # Shielded so a cancelled run still deletes the file before it exits
+                    await asyncio.shield(client.aio.files.delete(name=uploaded_file.name))
+            except Exception as cleanup_e:
+                logger.error(f"Failed to delete file {uploaded_file.name}: {cleanup_e}")
+            timings["delete"] = time.perf_counter() - start
+        logger.info(_format_timings(filename, timings))
+
+async def identify_gaps(
+    client: genai.Client, model_id: str, summaries: List[PaperSummary], subject: str, limiter: AdaptiveLimiter,
+    hierarchical: bool = False, token_budget: int = DEFAULT_STAGE_TOKEN_BUDGET, use_agent_cache: bool = True,
+    corpus_id: str | None = None, on_event: Callable[[str, dict], Awaitable[None]] | None = None,
+    context_cache: bool = False, router: ModelRouter | None = None, stream_tokens: bool = True,
+) -> str:
+    """Orchestrates the multi-agent synthesis.
+
+    Every agent call takes its own slot from the shared adaptive limiter, so throttling
+    seen by the agents slows summarisation down too (and vice versa). With `on_event`,
+    stage transitions and the agents' streamed output are reported as they happen
+    (only the stage transitions with `stream_tokens=False`, which keeps calls unstreamed
+    and hedgeable). A `router` picks each stage's model tier.
+    """
+    # We pass down generate_with_retry so the agents get the retry and rate-limit benefits
+    generate_func = partial(
+        generate_with_retry, limiter=limiter, on_event=on_event if stream_tokens else None, router=router,
+    )
+    try:
+        return await run_multi_agent_pipeline(
+            client, model_id, summaries, subject, generate_func,
+            hierarchical=hierarchical, token_budget=token_budget, use_cache=use_agent_cache,
+            corpus_id=corpus_id, on_event=on_event, context_cache=context_cache,
+            model_key=router.agent_model_key if router else None,
+        )
+    except Exception as e:
+        logger.error(f"Error in multi-agent pipeline: {e}")
+        return f"Error analysing gaps: {e}"
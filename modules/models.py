@@ -1,6 +1,15 @@
-from typing import List
+from typing import List, Sequence
 from pydantic import BaseModel, Field
 
+# Short labels used when a summary is rendered into an agent prompt
+SUMMARY_PROMPT_LABELS = {
+    "title": "Title",
+    "core_research_question": "Question",
+    "methodology": "Methods",
+    "key_findings": "Findings",
+    "limitations": "Limitations",
+}
+
 class PaperSummary(BaseModel):
     title: str = Field(description="The title or topic of the paper (infer if not explicit).")
     core_research_question: str = Field(description="What problem does this paper solve?")
@@ -17,6 +26,41 @@ class PaperSummary(BaseModel):
             f"5. **Limitations & Future Work**: {self.limitations}\n"
         )
 
+    def to_prompt(self, fields: Sequence[str] | None = None) -> str:
+        """Compact plain-text form used in agent prompts (no markdown scaffolding),
+        optionally restricted to some fields. Empty fields are left out."""
+        return "\n".join(
+            f"{SUMMARY_PROMPT_LABELS[field]}: {getattr(self, field)}"
+            for field in fields or SUMMARY_PROMPT_LABELS
+            if getattr(self, field).strip()
+        )
+
+class SummarySuccess(BaseModel):
+    """A paper that was summarised, or whose summary was found in the cache."""
+    filename: str
+    file_hash: str
+    summary: PaperSummary
+    cached: bool = False
+
+class SummaryFailure(BaseModel):
+    """A paper that could not be summarised."""
+    filename: str
+    file_hash: str | None = None
+    error: str
+
+PaperOutcome = SummarySuccess | SummaryFailure
+
+class DuplicateDecision(BaseModel):
+    """A paper collapsed into a near-duplicate (e.g. the preprint of a published version)."""
+    filename: str
+    file_hash: str
+    duplicate_of: str
+    duplicate_of_hash: str
+    similarity: float
+
+    def to_markdown(self) -> str:
+        return f"- {self.filename} → {self.duplicate_of} (estimated similarity {self.similarity:.2f})"
+
 # --- Multi-Agent Architecture Models ---
 
 class SynthesisResult(BaseModel):
@@ -28,6 +72,9 @@ class CriticResult(BaseModel):
     methodological_limitations: str = Field(description="Widespread flaws, limitations, or technologies that should be applied.")
     contradictions: str = Field(description="Conflicting findings between the papers that need resolution.")
 
+class CriticAspectResult(BaseModel):
+    analysis: str = Field(description="The requested part of the research-gap analysis.")
+
 class ResearchProposal(BaseModel):
     title: str = Field(description="A professional, academic title.")
     targeted_gap: str = Field(description="Which specific gap this proposal addresses.")
@@ -35,4 +82,4 @@ class ResearchProposal(BaseModel):
     expected_impact: str = Field(description="Why solving this gap is important to the broader field.")
 
 class InnovatorResult(BaseModel):
-    proposals: List[ResearchProposal] = Field(description="3 novel, highly specific research studies.")
+    proposals: List[ResearchProposal] = Field(description="Novel, highly specific research studies, one per research gap aspect.")
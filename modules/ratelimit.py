@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Deque, Dict, Iterator, Set
+
+import httpx
+from google.genai import errors
+
+from modules.telemetry import THROTTLES, span
+
+logger = logging.getLogger(__name__)
+
+# Error classes used to decide whether (and how) a failed call is retried
+THROTTLED = "throttled"
+SERVER_ERROR = "server_error"
+INVALID = "invalid"
+
+# Rates probe upward to at most this multiple of the configured rate
+MAX_RATE_MULTIPLIER = 4
+# Multiplicative decrease applied on throttling (the "MD" in AIMD)
+DECREASE_FACTOR = 0.5
+# The File API has its own quota, separate from generation
+DEFAULT_UPLOAD_RATE = 60
+# Scheduler defaults: in-flight summarisations across all of a process's jobs, and the
+# largest priority weight a job may ask for
+DEFAULT_MAX_CONCURRENT = 16
+MAX_PRIORITY = 10
+# Jobs with at most this many papers left to summarise get SMALL_JOB_BOOST times their
+# weight, so a small job (or the tail of a large one) is not stuck behind large backlogs
+SMALL_JOB_PAPERS = 10
+SMALL_JOB_BOOST = 4
+
+def classify_error(error: BaseException) -> str:
+    """Sorts an exception into THROTTLED (429/quota), SERVER_ERROR (5xx/network) or INVALID."""
+    if isinstance(error, errors.APIError):
+        if error.code == 429 or error.status == "RESOURCE_EXHAUSTED":
+            return THROTTLED
+        if error.code and error.code >= 500:
+            return SERVER_ERROR
+        return INVALID
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+        return SERVER_ERROR
+    return INVALID
+
+def get_retry_after(error: BaseException) -> float | None:
+    """Extracts the server's requested delay (Retry-After header or RetryInfo detail), if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []):
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if delay:
+                match = re.fullmatch(r"([\d.]+)s", delay)
+                if match:
+                    return float(match.group(1))
+    return None
+
+class AdaptiveRate:
+    """A token bucket whose rate adapts AIMD-style: it grows by roughly one request per
+    period while calls succeed, halves on throttling, and pauses for any retry-after."""
+
+    def __init__(self, name: str, rate: float, period: float = 60, min_rate: float = 1, max_rate: float | None = None):
+        self.name = name
+        self.rate = float(rate)
+        self.period = period
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * MAX_RATE_MULTIPLIER
+        self._tokens = self.rate
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        # The bucket holds at least one token, so a rate below one per period still grants slots
+        self._tokens = min(max(self.rate, 1), self._tokens + (now - self._last_refill) * self.rate / self.period)
+        self._last_refill = now
+
+    async def acquire(self):
+        with span(f"limiter_wait.{self.name}"):
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self._blocked_until:
+                        await asyncio.sleep(self._blocked_until - now)
+                        continue
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    def rescale(self, factor: float):
+        """Scales the rate and its bounds, keeping what the adaptation has learnt so far."""
+        self.rate *= factor
+        self.min_rate *= factor
+        self.max_rate *= factor
+        self._tokens = min(self._tokens, max(self.rate, 1))
+
+    def refund(self):
+        """Returns an acquired slot that went unused."""
+        self._tokens = min(self.rate, self._tokens + 1)
+
+    def record_success(self):
+        """Additive increase: about +1 request per period once a full period's worth has succeeded."""
+        self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def record_throttle(self, retry_after: float | None = None):
+        """Multiplicative decrease, applied at most once per slot interval so a burst of
+        concurrent 429s counts as a single congestion signal."""
+        THROTTLES.inc(limiter=self.name)
+        now = time.monotonic()
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+        if now - self._last_decrease < self.period / self.rate:
+            return
+        self._last_decrease = now
+        old_rate = self.rate
+        self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+        self._tokens = min(self._tokens, 0)
+        logger.warning(
+            f"Throttled: {self.name} rate {old_rate:.1f} -> {self.rate:.1f} per {self.period:.0f}s"
+            + (f", pausing {retry_after:.0f}s" if retry_after else "")
+        )
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+class AdaptiveLimiter:
+    """Separate adaptive budgets for generations and File API uploads.
+
+    Used as an async context manager it acquires a generation slot, so it is a drop-in
+    replacement for `aiolimiter.AsyncLimiter` at existing call sites.
+    """
+
+    def __init__(self, rate_limit: float, period: float = 60, upload_rate_limit: float | None = None):
+        self.generate = AdaptiveRate("generate", rate_limit, period)
+        self.upload = AdaptiveRate("upload", upload_rate_limit or DEFAULT_UPLOAD_RATE, period)
+
+    async def __aenter__(self):
+        await self.generate.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+class FairRate:
+    """Hands out the slots of one key-wide AdaptiveRate to jobs by weighted fair queuing.
+
+    Each job has a virtual time that advances by 1/weight per slot it is granted, and
+    every slot goes to the waiting job with the lowest virtual time; a job that starts
+    waiting again joins at the current virtual time rather than with saved-up credit.
+    """
+
+    def __init__(self, rate: AdaptiveRate):
+        self.rate = rate
+        self._waiters: Dict["JobLimiter", Deque[asyncio.Future]] = {}
+        self._vtime: Dict["JobLimiter", float] = {}
+        self._clock = 0.0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    async def acquire(self, job: "JobLimiter"):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        queue = self._waiters.setdefault(job, deque())
+        if not self._live(queue):
+            self._vtime[job] = max(self._vtime.get(job, 0.0), self._clock)
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future in queue:
+                queue.remove(future)
+            raise
+
+    def release(self, job: "JobLimiter"):
+        """Forgets a finished job."""
+        self._waiters.pop(job, None)
+        self._vtime.pop(job, None)
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+
+    @staticmethod
+    def _live(queue: Deque[asyncio.Future]) -> bool:
+        # Drop waiters cancelled while queued
+        while queue and queue[0].done():
+            queue.popleft()
+        return bool(queue)
+
+    async def _dispatch(self):
+        while True:
+            if not any(self._live(queue) for queue in self._waiters.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.rate.acquire()
+            backlogged = [job for job, queue in self._waiters.items() if self._live(queue)]
+            if not backlogged:
+                # Every waiter was cancelled while the slot was awaited: keep it for the next one
+                self.rate.refund()
+                continue
+            job = min(backlogged, key=self._vtime.__getitem__)
+            self._clock = self._vtime[job]
+            self._vtime[job] += 1 / job.weight
+            self._waiters[job].popleft().set_result(None)
+
+class _JobRate:
+    """A job's side of a FairRate: its own cap (the job's rate hint) and then a fair share
+    of the key's slots. Throttling and successes are fed back to the key-wide rate."""
+
+    def __init__(self, job: "JobLimiter", fair: FairRate, cap: AdaptiveRate | None = None):
+        self._job = job
+        self._fair = fair
+        self._cap = cap
+
+    async def acquire(self):
+        with span(f"scheduler_wait.{self._fair.rate.name}"):
+            if self._cap is not None:
+                await self._cap.acquire()
+            await self._fair.acquire(self._job)
+
+    def record_success(self):
+        self._fair.rate.record_success()
+
+    def record_throttle(self, retry_after: float | None = None):
+        self._fair.rate.record_throttle(retry_after)
+
+class JobLimiter:
+    """One job's view of a Scheduler, usable wherever an AdaptiveLimiter is.
+
+    `priority` weights the job's fair share. `rate_limit` and `concurrent_requests` are
+    hints: they can only lower the job's rate and concurrency below the scheduler's limits.
+    """
+
+    def __init__(
+        self, scheduler: "Scheduler", job_id: str, papers: int, priority: int = 1,
+        rate_limit: float | None = None, concurrent_requests: int | None = None,
+    ):
+        self.job_id = job_id
+        self.remaining = papers
+        self.priority = min(max(1, priority), MAX_PRIORITY)
+        self.rate_limit = min(max(1, rate_limit or scheduler.rate_limit), scheduler.rate_limit)
+        self.concurrent_requests = min(max(1, concurrent_requests or scheduler.max_concurrent), scheduler.max_concurrent)
+        cap = AdaptiveRate("job_generate", self.rate_limit, scheduler.period, max_rate=self.rate_limit)
+        self.generate = _JobRate(self, scheduler.generate, cap)
+        self.upload = _JobRate(self, scheduler.upload)
+        self._scheduler = scheduler
+        self._semaphore = asyncio.Semaphore(self.concurrent_requests)
+
+    @property
+    def weight(self) -> float:
+        return self.priority * (SMALL_JOB_BOOST if self.remaining <= SMALL_JOB_PAPERS else 1)
+
+    def paper_done(self):
+        """Counts down the papers left to summarise (which decides the small-job boost)."""
+        self.remaining = max(0, self.remaining - 1)
+
+    @asynccontextmanager
+    async def slot(self):
+        """A concurrency slot: one of the job's own and one of the scheduler's."""
+        async with self._semaphore, self._scheduler.slots:
+            yield
+
+    async def __aenter__(self):
+        await self.generate.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+class _Slots:
+    """A semaphore whose limit can be changed while it is held."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._held = 0
+        self._condition = asyncio.Condition()
+
+    async def resize(self, limit: int):
+        async with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._held < self.limit)
+            self._held += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self._held -= 1
+            self._condition.notify_all()
+
+class Scheduler:
+    """Owns the API key's quota within a process and shares it across concurrent jobs.
+
+    Generation and upload slots come from key-wide adaptive rates and are granted to jobs
+    by weighted fair queuing (FairRate); in-flight summarisations are capped by
+    `max_concurrent` across all jobs. Register each job with `job()`.
+
+    Processes sharing one key each run a Scheduler configured with the key's whole quota,
+    and use `set_share` to scale it to their part of the pool's `demand` (see worker.py);
+    `changed` is set whenever a job starts or finishes.
+    """
+
+    def __init__(
+        self, rate_limit: float, upload_rate_limit: float | None = None,
+        max_concurrent: int = DEFAULT_MAX_CONCURRENT, period: float = 60,
+    ):
+        self.rate_limit = rate_limit
+        self.period = period
+        self.max_concurrent = max_concurrent
+        self.generate = FairRate(AdaptiveRate("generate", rate_limit, period))
+        self.upload = FairRate(AdaptiveRate("upload", upload_rate_limit or DEFAULT_UPLOAD_RATE, period))
+        self.slots = _Slots(max_concurrent)
+        self.share = 1.0
+        self.changed = asyncio.Event()
+        self._jobs: Set[JobLimiter] = set()
+
+    @property
+    def demand(self) -> float:
+        """The summed weights of the running jobs: this process's claim on the key's quota."""
+        return sum(job.weight for job in self._jobs)
+
+    async def set_share(self, share: float):
+        """Scales the rates and the concurrency cap to `share` (0-1] of the key's quota."""
+        if share == self.share:
+            return
+        self.generate.rate.rescale(share / self.share)
+        self.upload.rate.rescale(share / self.share)
+        await self.slots.resize(max(1, round(self.max_concurrent * share)))
+        self.share = share
+
+    @contextmanager
+    def job(
+        self, job_id: str, papers: int, priority: int = 1,
+        rate_limit: float | None = None, concurrent_requests: int | None = None,
+    ) -> Iterator[JobLimiter]:
+        """Registers a job with `papers` left to summarise for the duration of the block."""
+        limiter = JobLimiter(self, job_id, papers, priority, rate_limit, concurrent_requests)
+        logger.info(
+            f"Scheduling job {job_id}: {papers} papers, priority {limiter.priority}, "
+            f"at most {limiter.rate_limit:.0f} requests per {self.period:.0f}s and {limiter.concurrent_requests} concurrent."
+        )
+        self._jobs.add(limiter)
+        self.changed.set()
+        try:
+            yield limiter
+        finally:
+            self._jobs.discard(limiter)
+            self.changed.set()
+            self.generate.release(limiter)
+            self.upload.release(limiter)
+
+    def close(self):
+        self.generate.close()
+        self.upload.close()
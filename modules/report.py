@@ -0,0 +1,23 @@
+import logging
+from typing import List
+
+from modules.models import DuplicateDecision, PaperSummary
+
+def write_report(
+    path: str, subject: str, report: str, summaries: List[PaperSummary], duplicates: List[DuplicateDecision] = (),
+):
+    """Writes the agents' report as Markdown, followed by the collapsed near-duplicates and the source summaries."""
+    with open(path, "w") as f:
+        f.write(f"# Research Gap Analysis: {subject}\n\n")
+        f.write(report)
+        if duplicates:
+            f.write("\n\n## Near-Duplicate Papers\n\n")
+            f.write("These papers were collapsed into the paper they duplicate and analysed once:\n\n")
+            f.write("\n".join(duplicate.to_markdown() for duplicate in duplicates))
+        f.write("\n\n## Source Paper Summaries\n\n")
+        for i, summary in enumerate(summaries):
+            f.write(f"### Paper {i + 1}\n{summary.to_markdown()}\n\n")
+
+def silence_ssl_errors():
+    """Hides the asyncio SSL teardown errors logged when a CLI exits with connections still open."""
+    logging.getLogger('asyncio').setLevel(logging.CRITICAL)
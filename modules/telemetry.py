@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+try:
+    from opentelemetry import trace
+except ImportError:  # Spans are optional; metrics are always recorded
+    trace = None
+
+METRIC_PREFIX = "research_gaps"
+# Histogram buckets in seconds, from a cache lookup up to a slow generation or limiter wait
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# How often worker processes publish their snapshot for the API's /metrics endpoint. A snapshot
+# not refreshed for METRICS_MAX_AGE comes from a worker that has exited, and is no longer merged.
+METRICS_INTERVAL = 15
+METRICS_MAX_AGE = 4 * METRICS_INTERVAL
+
+_tracer = trace.get_tracer(METRIC_PREFIX) if trace is not None else None
+_registry: Dict[str, "_Metric"] = {}
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = f"{METRIC_PREFIX}_{name}"
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, object] = {}
+        # Hashing runs in threads, so updates are locked
+        self._lock = threading.Lock()
+        _registry[self.name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Per-bucket (non-cumulative) counts, the last one for values above every bucket
+            state = self.values.setdefault(key, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0})
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            state["counts"][index] += 1
+            state["sum"] += value
+
+OPERATION_SECONDS = Histogram(
+    "operation_seconds", "Latency of instrumented operations (hashing, caches, uploads, generations, agent stages, limiter waits)",
+    ["operation"],
+)
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups by cache and result (hit/miss)", ["cache", "result"])
+TOKENS = Counter("tokens_total", "Gemini tokens by model and direction (input/output)", ["model", "direction"])
+RETRIES = Counter("retries_total", "Retried Gemini calls by error class", ["reason"])
+THROTTLES = Counter("throttles_total", "Throttling responses seen by each adaptive rate", ["limiter"])
+JOBS = Gauge("jobs", "Jobs in the job store by status (pending jobs are the queue depth)", ["status"])
+
+@contextmanager
+def span(operation: str, **attributes) -> Iterator[None]:
+    """Times a block as an OpenTelemetry span named `operation` (when opentelemetry is
+    installed and configured) and records it in the operation latency histogram.
+
+    `attributes` go on the span only; the histogram is labelled by operation alone so
+    its cardinality stays bounded.
+    """
+    start = time.perf_counter()
+    scope = _tracer.start_as_current_span(operation, attributes=attributes) if _tracer else nullcontext()
+    try:
+        with scope:
+            yield
+    finally:
+        OPERATION_SECONDS.observe(time.perf_counter() - start, operation=operation)
+
+def record_cache(cache: str, hits: int, misses: int):
+    if hits:
+        CACHE_REQUESTS.inc(hits, cache=cache, result="hit")
+    if misses:
+        CACHE_REQUESTS.inc(misses, cache=cache, result="miss")
+
+def snapshot() -> str:
+    """This process's metric values as JSON, for merging into another process's /metrics."""
+    with_values = {}
+    for name, metric in _registry.items():
+        with metric._lock:
+            with_values[name] = [[list(key), value] for key, value in metric.values.items()]
+    return json.dumps(with_values)
+
+def _merge(snapshots: Iterable[str]) -> Dict[str, Dict[tuple, object]]:
+    """Sums the metric values of several live processes. Counters and histogram buckets add up;
+    a gauge adds each process' current value (e.g. its own in-flight calls), so only the
+    snapshots of running processes may be passed in."""
+    merged: Dict[str, Dict[tuple, object]] = {name: {} for name in _registry}
+    for data in snapshots:
+        for name, entries in json.loads(data).items():
+            if name not in merged:
+                continue
+            values = merged[name]
+            for key, value in entries:
+                key = tuple(key)
+                if isinstance(value, dict):
+                    state = values.setdefault(key, {"counts": [0] * len(value["counts"]), "sum": 0.0})
+                    state["counts"] = [a + b for a, b in zip(state["counts"], value["counts"])]
+                    state["sum"] += value["sum"]
+                else:
+                    values[key] = values.get(key, 0) + value
+    return merged
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render_metrics(other_snapshots: Iterable[str] = ()) -> str:
+    """Prometheus text exposition of this process's metrics plus `other_snapshots` (those of
+    live processes, see METRICS_MAX_AGE)."""
+    merged = _merge([snapshot(), *other_snapshots])
+    lines: List[str] = []
+    for name, metric in _registry.items():
+        lines += [f"# HELP {name} {metric.help}", f"# TYPE {name} {metric.kind}"]
+        for key, value in sorted(merged[name].items()):
+            if metric.kind != "histogram":
+                lines.append(f"{name}{_format_labels(metric.labels, key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, "+Inf"), value["counts"]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_format_labels(metric.labels, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric.labels, key)} {value['sum']}")
+            lines.append(f"{name}_count{_format_labels(metric.labels, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import logging
+import re
+from typing import List, Sequence, Tuple
+
+from google import genai
+
+from modules.models import PaperSummary
+from modules.db import get_token_counts, cache_token_counts
+from modules.telemetry import record_cache
+
+logger = logging.getLogger(__name__)
+
+# Rough characters-per-token ratio, used where exact counts are not available
+CHARS_PER_TOKEN = 4
+# Concurrent count_tokens calls (they have their own, much higher quota than generation)
+COUNT_TOKENS_CONCURRENCY = 8
+# Field values that carry no information (the summary prompt asks for 'N/A' on unreadable papers)
+EMPTY_VALUES = {"", "na", "none", "notapplicable"}
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def summary_hash(summary: str) -> str:
+    return hashlib.sha256(summary.encode("utf-8")).hexdigest()
+
+def _normalise(text: str) -> str:
+    return re.sub(r"[\W_]+", "", text.lower())
+
+async def count_summary_tokens(client: genai.Client, model_id: str, summaries: List[str]) -> List[int]:
+    """Exact token counts of the rendered summaries, from Gemini's count_tokens.
+
+    Counts are cached in SQLite per summary hash and model, so each summary is counted
+    once. A failed count falls back to a character-based estimate (which is not cached).
+    """
+    hashes = [summary_hash(s) for s in summaries]
+    counts = await get_token_counts(hashes, model_id)
+    missing = {h: s for h, s in zip(hashes, summaries) if h not in counts}
+    record_cache("token_count", len(set(hashes)) - len(missing), len(missing))
+    if missing:
+        semaphore = asyncio.Semaphore(COUNT_TOKENS_CONCURRENCY)
+
+        async def count(text: str) -> int | None:
+            async with semaphore:
+                try:
+                    response = await client.aio.models.count_tokens(model=model_id, contents=text)
+                    return response.total_tokens
+                except Exception as e:
+                    logger.warning(f"count_tokens failed, estimating instead: {e}")
+                    return None
+
+        results = await asyncio.gather(*(count(text) for text in missing.values()))
+        new_counts = {h: tokens for h, tokens in zip(missing, results) if tokens is not None}
+        if new_counts:
+            await cache_token_counts(new_counts, model_id)
+        counts.update(new_counts)
+        logger.info(f"Counted tokens for {len(missing)} new summaries ({len(new_counts)} exact).")
+    return [counts.get(h) or estimate_tokens(s) for h, s in zip(hashes, summaries)]
+
+def _truncate(text: str, ratio: float) -> str:
+    """Keeps the leading `ratio` of a field, cut at a word boundary."""
+    if ratio >= 1:
+        return text
+    cut = text[:int(len(text) * ratio)]
+    if " " in cut:
+        cut = cut[:cut.rindex(" ")]
+    return cut + " [...]" if cut else ""
+
+def _fair_caps(counts: List[int], budget: int) -> List[int]:
+    """Max-min fair token caps: texts under the equal share keep everything, and the
+    remaining budget is split evenly among the longer ones."""
+    caps = [0] * len(counts)
+    remaining = budget
+    order = sorted(range(len(counts)), key=lambda i: (counts[i], i))
+    for position, i in enumerate(order):
+        caps[i] = min(counts[i], remaining // (len(order) - position))
+        remaining -= caps[i]
+    return caps
+
+class StageInput:
+    """The summary texts sent to one agent stage, with the token accounting behind them."""
+
+    def __init__(
+        self, stage: str, texts: List[str], full_tokens: int, sent_tokens: int, duplicates: int = 0, truncated: int = 0,
+        cached: bool = False,
+    ):
+        self.stage = stage
+        self.texts = texts
+        self.full_tokens = full_tokens
+        self.sent_tokens = sent_tokens
+        self.duplicates = duplicates
+        self.truncated = truncated
+        # True when the stage reads the whole corpus from a Gemini context cache instead
+        self.cached = cached
+
+    def __str__(self) -> str:
+        if self.cached:
+            return f"Stage input {self.stage}: {self.full_tokens} summary tokens read from the context cache"
+        return (
+            f"Stage input {self.stage}: {self.sent_tokens} of {self.full_tokens} summary tokens "
+            f"({len(self.texts)} papers, {self.duplicates} near-duplicates dropped, {self.truncated} truncated)"
+        )
+
+def compact_stage_input(
+    stage: str, papers: List[PaperSummary], full_texts: List[str], full_counts: List[int],
+    fields: Sequence[str], token_budget: int | None,
+) -> StageInput:
+    """Builds a stage's prompt texts from only the summary fields it needs.
+
+    Empty/'N/A' fields are dropped (and papers with none of the fields left are skipped),
+    papers whose selected non-title fields are near-identical (equal up to case, whitespace
+    and punctuation) to an earlier paper's are sent once, and with a
+    `token_budget` the remaining texts are truncated deterministically to max-min fair
+    shares of it. Token counts of the views are scaled from the exact counts of the full
+    texts by length.
+    """
+    views, view_counts, seen = [], [], set()
+    duplicates = 0
+    for paper, full_text, full_count in zip(papers, full_texts, full_counts):
+        kept = [f for f in fields if _normalise(getattr(paper, f)) not in EMPTY_VALUES]
+        if not kept:
+            # Nothing this stage reads; an empty field list would render every field instead
+            continue
+        key = tuple(_normalise(getattr(paper, f)) for f in kept if f != "title")
+        # Papers with nothing but a title have no content to compare, so are never merged
+        if key:
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+        view = paper.model_copy(update={f: "" for f in fields if f not in kept})
+        views.append((view, kept))
+        view_counts.append(max(1, round(full_count * len(view.to_prompt(kept)) / max(1, len(full_text)))))
+
+    caps = view_counts
+    if token_budget is not None and sum(view_counts) > token_budget:
+        caps = _fair_caps(view_counts, token_budget)
+
+    texts = []
+    truncated = 0
+    for (view, kept), count, cap in zip(views, view_counts, caps):
+        if cap < count:
+            truncated += 1
+            ratio = cap / count
+            view = view.model_copy(update={f: _truncate(getattr(view, f), ratio) for f in kept if f != "title"})
+        text = view.to_prompt(kept)
+        if text:
+            texts.append(text)
+    return StageInput(stage, texts, sum(full_counts), sum(caps), duplicates, truncated)
+
+def log_token_savings(stage_inputs: List[StageInput]) -> Tuple[int, int]:
+    """Logs each stage's accounting and the run's total saving; returns (full, sent) tokens."""
+    for stage_input in stage_inputs:
+        logger.info(str(stage_input))
+    # Context-cached inputs are billed at the cached rate rather than compacted, so they are not counted here
+    inline_inputs = [s for s in stage_inputs if not s.cached]
+    full = sum(s.full_tokens for s in inline_inputs)
+    sent = sum(s.sent_tokens for s in inline_inputs)
+    if full:
+        logger.info(
+            f"Prompt compaction saved {full - sent} of {full} summary tokens "
+            f"({100 * (full - sent) / full:.0f}%) across {len(inline_inputs)} stage inputs."
+        )
+    return full, sent
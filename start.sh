@@ -7,6 +7,9 @@ echo "Starting Backend (FastAPI)..."
 source .venv/bin/activate
 uvicorn api:app --host 0.0.0.0 --port 8000 &
 
+echo "Starting Job Workers..."
+python worker.py --workers 2 &
+
 echo "Starting Frontend (Vite)..."
 cd frontend
 npm run dev -- --host 0.0.0.0 --port 5173 &
@@ -0,0 +1,18 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Run from anywhere: the tests import the top-level `modules` package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def fake_db(tmp_path, monkeypatch):
+    """A fresh research_cache.db in a temporary directory, closed after the test."""
+    from modules import db
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "research_cache.db"))
+    monkeypatch.setattr(db, "_last_touched", {})
+    monkeypatch.setattr(db, "_pending_touches", {})
+    yield
+    asyncio.run(db.close_db())
@@ -0,0 +1,43 @@
+import asyncio
+import random
+from functools import partial
+
+from modules import db
+from modules.agents import DEFAULT_STAGE_TOKEN_BUDGET, _stage_keys, corpus_cache_key, run_multi_agent_pipeline
+from modules.fake_llm import VOCABULARY, FakeClient
+from modules.llm import generate_with_retry
+from modules.models import PaperSummary
+
+def _papers(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    text = lambda: " ".join(rng.choice(VOCABULARY) for _ in range(20))
+    return [
+        PaperSummary(
+            title=f"Paper {seed}-{i}", core_research_question=text(), methodology=text(),
+            key_findings=text(), limitations=text(),
+        )
+        for i in range(count)
+    ]
+
+def test_incremental_results_are_not_served_to_full_runs(fake_db):
+    papers = _papers(3) + _papers(2, seed=1)
+    run = partial(
+        run_multi_agent_pipeline, FakeClient(latency=0.001), "fake-model",
+        subject="soil", generate_func=partial(generate_with_retry),
+    )
+    corpus_key = corpus_cache_key([paper.to_prompt() for paper in papers], "soil", "fake-model")
+    full_keys = _stage_keys(corpus_key, f"flat:{DEFAULT_STAGE_TOKEN_BUDGET}")
+
+    async def scenario():
+        await db.init_db()
+        await run(papers=papers[:3], corpus_id="soil")
+        # The two added papers are analysed on top of the corpus' stored analysis
+        await run(papers=papers, corpus_id="soil")
+        incremental = [await db.get_cached_agent_output(key) for key in full_keys]
+        await run(papers=papers)
+        full = [await db.get_cached_agent_output(key) for key in full_keys]
+        return incremental, full
+
+    incremental, full = asyncio.run(scenario())
+    assert incremental == [None, None, None]
+    assert all(full)
@@ -0,0 +1,123 @@
+import asyncio
+import random
+from functools import partial
+
+import pytest
+from google.genai import types
+
+from modules import db
+from modules.agents import run_multi_agent_pipeline
+from modules.context_cache import corpus_context_cache, with_cached_content
+from modules.fake_llm import VOCABULARY, FakeClient
+from modules.llm import generate_with_retry
+from modules.models import PaperSummary
+
+def _papers(count: int, words: int, seed: int = 0):
+    rng = random.Random(seed)
+    text = lambda: " ".join(rng.choice(VOCABULARY) for _ in range(words))
+    return [
+        PaperSummary(
+            title=f"Paper {i}", core_research_question=text(), methodology=text(),
+            key_findings=text(), limitations=text(),
+        )
+        for i in range(count)
+    ]
+
+class _RecordingCaches:
+    """Wraps the fake's caches, recording deletions and optionally failing creation."""
+
+    def __init__(self, caches, fail_create: bool = False):
+        self._caches = caches
+        self.fail_create = fail_create
+        self.deleted = []
+
+    async def create(self, **kwargs):
+        if self.fail_create:
+            raise RuntimeError("Fake cache creation failure.")
+        return await self._caches.create(**kwargs)
+
+    async def delete(self, *, name: str, config=None):
+        self.deleted.append(name)
+        await self._caches.delete(name=name)
+
+def _client(fail_create: bool = False):
+    client = FakeClient(latency=0.001, upload_latency=0.001)
+    client.aio.caches = _RecordingCaches(client.aio.caches, fail_create)
+    return client
+
+def test_cache_is_deleted_after_the_block():
+    async def scenario():
+        client = _client()
+        async with corpus_context_cache(client, "fake-model", "summaries", "a" * 64) as name:
+            assert name is not None and name.startswith("cachedContents/")
+            assert client.aio.caches.deleted == []
+        return name, client
+
+    name, client = asyncio.run(scenario())
+    assert client.aio.caches.deleted == [name]
+
+def test_cache_is_deleted_when_the_block_raises():
+    client = _client()
+
+    async def scenario():
+        async with corpus_context_cache(client, "fake-model", "summaries", "a" * 64) as name:
+            raise ValueError(name)
+
+    with pytest.raises(ValueError) as raised:
+        asyncio.run(scenario())
+    assert client.aio.caches.deleted == [str(raised.value)]
+
+def test_failed_creation_falls_back_to_inline():
+    client = _client(fail_create=True)
+
+    async def scenario():
+        async with corpus_context_cache(client, "fake-model", "summaries", "a" * 64) as name:
+            return name
+
+    assert asyncio.run(scenario()) is None
+    assert client.aio.caches.deleted == []
+
+def test_system_instruction_moves_into_the_contents():
+    calls = []
+
+    async def generate_func(client, model_id, contents, config):
+        calls.append((contents, config))
+
+    config = types.GenerateContentConfig(system_instruction="Be rigorous.", temperature=0.2)
+    generate = with_cached_content(generate_func, "cachedContents/corpus")
+    asyncio.run(generate(None, "fake-model", "The prompt.", config))
+
+    ((contents, sent_config),) = calls
+    assert contents == ["Be rigorous.", "The prompt."]
+    assert sent_config.system_instruction is None
+    assert sent_config.cached_content == "cachedContents/corpus"
+    assert sent_config.temperature == 0.2
+    # The stage's own config is left untouched
+    assert config.system_instruction == "Be rigorous." and config.cached_content is None
+
+def _run_pipeline(client, papers):
+    async def scenario():
+        await db.init_db()
+        return await run_multi_agent_pipeline(
+            client, "fake-model", papers, "causal inference", partial(generate_with_retry),
+            use_cache=False, context_cache=True,
+        )
+    return asyncio.run(scenario())
+
+def test_small_corpus_is_sent_inline(fake_db):
+    client = _client()
+    _run_pipeline(client, _papers(3, 5))
+    assert client.calls["cache"] == 0
+    assert client.aio.caches.deleted == []
+
+def test_large_corpus_is_cached_once_and_deleted(fake_db):
+    client = _client()
+    _run_pipeline(client, _papers(40, 150))
+    assert client.calls["cache"] == 1
+    assert len(client.aio.caches.deleted) == 1
+
+def test_pipeline_completes_when_cache_creation_fails(fake_db):
+    client = _client(fail_create=True)
+    report = _run_pipeline(client, _papers(40, 150))
+    assert "State of the Field Synthesis" in report
+    assert client.aio.caches.deleted == []
@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+from modules import db
+
+async def _event_jobs() -> set:
+    conn = await db.get_connection()
+    async with conn.execute('SELECT DISTINCT job_id FROM job_events') as cursor:
+        return {job_id for (job_id,) in await cursor.fetchall()}
+
+def test_events_of_long_finished_jobs_are_deleted(fake_db):
+    async def scenario():
+        await db.init_db()
+        for job_id in ("old", "recent", "running"):
+            await db.create_job(job_id, {}, [])
+            await db.add_job_event(job_id, "token", {"text": "..."})
+        await db.finish_job("old", "completed", result={})
+        async with db.transaction() as conn:
+            await conn.execute(
+                'UPDATE jobs SET updated_at = ? WHERE job_id = ?', (time.time() - 2 * db.JOB_EVENTS_MAX_AGE, "old")
+            )
+        await db.finish_job("recent", "failed", error="boom")
+        return await _event_jobs()
+
+    assert asyncio.run(scenario()) == {"recent", "running"}
@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+from modules.ratelimit import AdaptiveRate, FairRate
+
+class _Job:
+    weight = 1
+
+def test_slot_of_a_cancelled_waiter_is_returned():
+    async def scenario():
+        rate = AdaptiveRate("test", 1, period=0.5)
+        fair = FairRate(rate)
+        job = _Job()
+        await fair.acquire(job)
+        # The dispatcher takes the next slot for this waiter, which is cancelled meanwhile
+        waiter = asyncio.create_task(fair.acquire(job))
+        await asyncio.sleep(0.1)
+        waiter.cancel()
+        await asyncio.sleep(0.6)
+        start = time.monotonic()
+        await fair.acquire(job)
+        fair.close()
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) < 0.1
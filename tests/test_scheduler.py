@@ -0,0 +1,34 @@
+import asyncio
+
+from modules.ratelimit import Scheduler
+
+def test_share_scales_rates_and_slots():
+    async def scenario():
+        scheduler = Scheduler(rate_limit=60, upload_rate_limit=30, max_concurrent=8)
+        with scheduler.job("a", papers=20, priority=2):
+            assert scheduler.changed.is_set()
+            assert scheduler.demand == 2
+            await scheduler.set_share(0.25)
+            scaled = (scheduler.generate.rate.rate, scheduler.upload.rate.rate, scheduler.slots.limit)
+            await scheduler.set_share(1.0)
+            restored = (scheduler.generate.rate.rate, scheduler.upload.rate.rate, scheduler.slots.limit)
+        scheduler.close()
+        return scaled, restored, scheduler.demand
+
+    scaled, restored, demand = asyncio.run(scenario())
+    assert scaled == (15, 7.5, 2)
+    assert restored == (60, 30, 8)
+    assert demand == 0
+
+def test_small_share_still_grants_slots():
+    async def scenario():
+        scheduler = Scheduler(rate_limit=2, period=0.2)
+        await scheduler.set_share(0.1)
+        with scheduler.job("a", papers=1) as limiter:
+            # Below one request per period, the bucket still refills to a whole slot
+            for _ in range(2):
+                async with limiter:
+                    pass
+        scheduler.close()
+
+    asyncio.run(asyncio.wait_for(scenario(), 3))
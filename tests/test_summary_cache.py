@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+from modules import db
+
+async def _last_used(file_hash: str) -> float:
+    conn = await db.get_connection()
+    async with conn.execute('SELECT last_used_at FROM summaries WHERE file_hash = ?', (file_hash,)) as cursor:
+        (last_used,) = await cursor.fetchone()
+    return last_used
+
+async def _cache(file_hash: str, last_used: float):
+    await db.cache_summary(file_hash, f"{file_hash}.pdf", '{"title": "t"}', "fake-model", "v1")
+    await db.flush_pending_writes()
+    async with db.transaction() as conn:
+        await conn.execute('UPDATE summaries SET last_used_at = ? WHERE file_hash = ?', (last_used, file_hash))
+
+def test_reads_queue_last_use_for_the_batched_writer(fake_db):
+    async def scenario():
+        await db.init_db()
+        old = time.time() - 2 * db.SUMMARY_TOUCH_INTERVAL
+        await _cache("a", old)
+        assert await db.get_cached_summaries(["a"], "fake-model", "v1") == {"a": '{"title": "t"}'}
+        # The read itself does not write
+        assert await _last_used("a") == old
+        await db.flush_pending_writes()
+        return old, await _last_used("a")
+
+    old, last_used = asyncio.run(scenario())
+    assert last_used > old
+
+def test_recently_used_summaries_are_not_touched(fake_db):
+    async def scenario():
+        await db.init_db()
+        await _cache("a", time.time() - 60)
+        await db.get_cached_summaries(["a"], "fake-model", "v1")
+        # Memo hits are reported directly and are throttled the same way
+        await db.touch_summaries(["a"], "fake-model", "v1")
+        return dict(db._pending_touches)
+
+    assert asyncio.run(scenario()) == {}
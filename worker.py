@@ -0,0 +1,309 @@
+import os
+import uuid
+import signal
+import socket
+import argparse
+import asyncio
+import logging
+import multiprocessing
+from functools import partial
+from typing import List, Set, Tuple
+
+from dotenv import load_dotenv
+
+from modules.ratelimit import Scheduler, DEFAULT_MAX_CONCURRENT, DEFAULT_UPLOAD_RATE
+from modules.llm import ModelRouter, get_client, run_prepasses, summarise_paper, identify_gaps
+from modules.agents import DEFAULT_STAGE_TOKEN_BUDGET
+from modules.index import find_relevant_papers
+from modules.models import PaperOutcome, SummarySuccess
+from modules.db import (
+    init_db, close_db, claim_job, heartbeat_job, requeue_job, requeue_stale_jobs, update_job_papers, finish_job,
+    add_job_event, release_job_files, save_metrics_snapshot, save_worker_demand, remove_worker_demand,
+)
+from modules.telemetry import METRICS_INTERVAL, METRICS_MAX_AGE, snapshot
+from modules.extract import shutdown_extraction_pool
+
+# Load environment variables
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# The worker pool's default quota for the API key, shared by all worker processes
+DEFAULT_RATE_LIMIT = 10
+DEFAULT_MAX_JOBS = 4
+HEARTBEAT_INTERVAL = 15
+# A processing job whose worker has not sent a heartbeat for this long is handed to another worker
+STALE_AFTER = 60
+# Workers rebalance their shares of the key's quota this often, and whenever one of their jobs starts or finishes
+QUOTA_INTERVAL = 5
+
+async def run_analysis(
+    job_id: str, papers: List[Tuple[str, str | None, str | None]], scheduler: Scheduler, subject: str, model: str,
+    rate_limit: int | None = None, concurrent_requests: int | None = None,
+    hierarchical: bool = False, token_budget: int = DEFAULT_STAGE_TOKEN_BUDGET, no_agent_cache: bool = False,
+    corpus: str | None = None, extract_text: bool = False, context_cache: bool = False,
+    summary_model: str | None = None, reasoning_model: str | None = None, hedge: bool = False, priority: int = 1,
+    top_k: int | None = None, dedup: bool = False,
+):
+    """Runs one analysis job, recording per-paper progress in the job store.
+
+    The job's requests go through the worker's `scheduler`, which shares the API key's
+    quota fairly with the other running jobs, in this worker and the others (see
+    `_balance_quota`); `priority` weights its share, and `rate_limit`/`concurrent_requests`
+    can only lower its rate and concurrency.
+
+    Progress is also published as job events (see `GET /events/{task_id}`): one "paper"
+    event per paper, "stage" events for agent-stage transitions and "token" events with
+    the agents' streamed output, and a final "routing" event with the model routing and
+    hedging statistics (see `ModelRouter.stats`).
+
+    `papers` are `(file_path, file_hash, filename)` tuples as stored by the API. Their
+    hashes were computed during upload, so cached papers are resolved without reading
+    (or even having) their files.
+
+    With `dedup`, near-duplicate papers are collapsed before summarisation (see
+    `collapse_duplicates`); each decision is published as a "duplicate" event, and the
+    collapsed papers count as done.
+
+    A job with `top_k` has no papers of its own: it analyses the `top_k` cached summaries
+    most relevant to `subject` (see `find_relevant_papers`), reported as cached "paper"
+    events with their similarity score.
+
+    A job resumed after a restart re-runs from the top, but papers that were already
+    summarised come straight from the summary cache. Its events start over with a new
+    "status" event, so clients reset their progress when one arrives.
+    """
+    file_paths = [file_path for file_path, _, _ in papers]
+    filenames = {file_path: filename or os.path.basename(file_path) for file_path, _, filename in papers}
+    file_hashes = [file_hash for _, file_hash, _ in papers]
+    client = get_client()
+    router = ModelRouter(model, summary_model, reasoning_model, hedge=hedge)
+    emit = partial(add_job_event, job_id)
+    duplicates = []
+    if top_k:
+        retrieved = await find_relevant_papers(client, subject, router.summary_model, top_k)
+        await emit("status", {"status": "processing", "papers": len(retrieved)})
+        paper_summaries, misses = [paper for paper, _ in retrieved], []
+        for paper, score in retrieved:
+            await emit("paper", {"file": paper.filename, "status": "done", "cached": True, "score": round(score, 3)})
+    else:
+        await emit("status", {"status": "processing", "papers": len(file_paths)})
+
+        async def papers_done(paths: List[str]):
+            await update_job_papers(job_id, paths, "done")
+            for pdf_path in paths:
+                await emit("paper", {"file": filenames[pdf_path], "status": "done", "cached": True})
+
+        paper_summaries, misses, duplicates = await run_prepasses(
+            file_paths, router.summary_model, file_hashes, list(filenames.values()), dedup=dedup, on_done=papers_done,
+        )
+        for duplicate in duplicates:
+            await emit("duplicate", duplicate.model_dump())
+
+    with scheduler.job(job_id, len(misses), priority, rate_limit, concurrent_requests) as limiter:
+        async def bounded_summarise(pdf_path: str, file_hash: str) -> PaperOutcome:
+            async with limiter.slot():
+                outcome = await summarise_paper(
+                    client, model, pdf_path, limiter, file_hash, extract_text=extract_text,
+                    filename=filenames[pdf_path], router=router,
+                )
+            limiter.paper_done()
+            status = "done" if isinstance(outcome, SummarySuccess) else "failed"
+            await update_job_papers(job_id, [pdf_path], status)
+            await emit("paper", {"file": filenames[pdf_path], "status": status, "cached": False})
+            return outcome
+
+        # Process all uncached PDFs
+        process_tasks = [asyncio.create_task(bounded_summarise(pdf, file_hash)) for pdf, file_hash in misses]
+
+        try:
+            for f in asyncio.as_completed(process_tasks):
+                paper_summaries.append(await f)
+        finally:
+            # A cancelled job (worker shutdown) waits for its summarisations to clean up their uploads
+            for task in process_tasks:
+                task.cancel()
+            await asyncio.gather(*process_tasks, return_exceptions=True)
+
+        valid_summaries = [s.summary for s in paper_summaries if isinstance(s, SummarySuccess)]
+
+        if not valid_summaries:
+            await emit("routing", router.stats())
+            await finish_job(job_id, "failed", error="No valid summaries generated.")
+            return
+
+        logger.info(f"Job {job_id}: Analysing research gaps...")
+        report = await identify_gaps(
+            client, model, valid_summaries, subject, limiter,
+            hierarchical=hierarchical, token_budget=token_budget, use_agent_cache=not no_agent_cache,
+            corpus_id=corpus, on_event=emit, context_cache=context_cache, router=router,
+        )
+    router.log_stats()
+    await emit("routing", router.stats())
+
+    await finish_job(job_id, "completed", result={
+        "report": report,
+        "summaries": [summary.to_markdown() for summary in valid_summaries],
+        "duplicates": [duplicate.model_dump() for duplicate in duplicates],
+    })
+
+async def _heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await heartbeat_job(job_id)
+
+async def run_claimed_job(job: dict, scheduler: Scheduler):
+    job_id = job["job_id"]
+    logger.info(f"Running job {job_id} ({len(job['papers'])} papers)...")
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    finished = False
+    try:
+        await run_analysis(job_id, job["papers"], scheduler, **job["params"])
+        finished = True
+    except asyncio.CancelledError:
+        # Shutting down mid-job: hand it back to the queue so another worker resumes it
+        await requeue_job(job_id)
+        raise
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        await finish_job(job_id, "failed", error=str(e))
+        finished = True
+    finally:
+        heartbeat.cancel()
+        if finished:
+            # Cleanup temp files, except those another queued job shares
+            for path in await release_job_files(job_id):
+                if os.path.exists(path):
+                    os.remove(path)
+
+async def _publish_metrics(worker_id: str):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        await save_metrics_snapshot(worker_id, snapshot(), METRICS_MAX_AGE)
+
+async def _balance_quota(worker_id: str, scheduler: Scheduler):
+    """Keeps this worker's share of the key's quota proportional to its jobs' weights.
+
+    Every worker publishes its scheduler's demand to the job store and scales its scheduler
+    to its part of the live workers' total, so the key's quota is shared by weight across
+    all jobs of the pool, and a job running alone gets all of it.
+    """
+    while True:
+        scheduler.changed.clear()
+        demands = await save_worker_demand(worker_id, scheduler.demand, STALE_AFTER)
+        total = sum(demands.values())
+        if total:
+            await scheduler.set_share(demands[worker_id] / total if demands[worker_id] else 1 / len(demands))
+        try:
+            await asyncio.wait_for(scheduler.changed.wait(), QUOTA_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def worker_loop(worker_id: str, poll_interval: float, scheduler: Scheduler, max_jobs: int):
+    """Claims jobs and runs up to `max_jobs` of them at once, sharing one `scheduler`, until cancelled.
+
+    The worker's metrics are published to the job store every METRICS_INTERVAL seconds
+    (and on exit), where the API's /metrics endpoint merges them.
+    """
+    # SIGTERM (sent by the pool on Ctrl+C) cancels the loop, so the current jobs are requeued
+    # instead of left to go stale
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    await init_db()
+    logger.info(f"Worker {worker_id} started.")
+    metrics = asyncio.create_task(_publish_metrics(worker_id))
+    quota = asyncio.create_task(_balance_quota(worker_id, scheduler))
+    running: Set[asyncio.Task] = set()
+    try:
+        while True:
+            if len(running) >= max_jobs:
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            await requeue_stale_jobs(STALE_AFTER)
+            job = await claim_job(worker_id)
+            if job is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            task = asyncio.create_task(run_claimed_job(job, scheduler))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        # A second signal must not cancel the cleanup: queued summary writes would be lost, and
+        # the database's thread left running would keep the process from exiting
+        loop.remove_signal_handler(signal.SIGTERM)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        scheduler.close()
+        metrics.cancel()
+        quota.cancel()
+        await remove_worker_demand(worker_id)
+        await save_metrics_snapshot(worker_id, snapshot(), METRICS_MAX_AGE)
+        shutdown_extraction_pool()
+        await close_db()
+
+def _run_worker(worker_id: str, poll_interval: float, max_jobs: int, scheduler_args: dict):
+    # Ctrl+C reaches the whole process group; the pool turns it into a single SIGTERM per worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(worker_loop(worker_id, poll_interval, Scheduler(**scheduler_args), max_jobs))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info(f"Worker {worker_id} stopped.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Research Gap Identifier job worker pool")
+    parser.add_argument("--workers", help="Number of worker processes", type=int, default=2)
+    parser.add_argument(
+        "--poll-interval", help="Seconds between queue polls when idle", type=float, default=2.0
+    )
+    parser.add_argument(
+        "--max-jobs", help="Jobs each worker process runs concurrently", type=int, default=DEFAULT_MAX_JOBS
+    )
+    parser.add_argument(
+        "--rate-limit", help="Generation requests per minute allowed for the API key, across all workers",
+        type=int, default=DEFAULT_RATE_LIMIT,
+    )
+    parser.add_argument(
+        "--upload-rate-limit", help="File API uploads per minute allowed for the API key, across all workers",
+        type=int, default=DEFAULT_UPLOAD_RATE,
+    )
+    parser.add_argument(
+        "--max-concurrent-requests", help="Max in-flight summarisations across all workers",
+        type=int, default=DEFAULT_MAX_CONCURRENT,
+    )
+    args = parser.parse_args()
+
+    # The pool owns the key's quota; each worker process schedules its share of it (rebalanced
+    # by the weights of every worker's jobs) across its own jobs
+    scheduler_args = {
+        "rate_limit": args.rate_limit,
+        "upload_rate_limit": args.upload_rate_limit,
+        "max_concurrent": args.max_concurrent_requests,
+    }
+    processes = [
+        multiprocessing.Process(
+            target=_run_worker,
+            args=(f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}", args.poll_interval, args.max_jobs, scheduler_args),
+        )
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers ignore Ctrl+C and requeue their current jobs on SIGTERM; ignore further Ctrl+C while they do
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    main()